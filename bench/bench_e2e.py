@@ -0,0 +1,284 @@
+"""
+Сквозной бенчмарк бота без Gmail и без Telegram.
+
+Поднимает локальный IMAP-сервер (fake_imap) с письмами Kwork / Work-Zilla /
+Freelance.ru и заглушку Bot API (fake_telegram), направляет на них бота через
+IMAP_HOST/IMAP_PORT/IMAP_SSL=0 и TG_API_URL и прогоняет:
+
+- watcher_loop: письма приходят с заданной частотой, меряется задержка
+  от появления письма на сервере до sendMessage в каждый чат (p50/p99),
+  пропускная способность и IMAP-команд на письмо;
+- list_last_emails и get_email_by_uid: холодный и тёплый вызов;
+- send_email_pretty: время отправки одного письма в чат.
+
+С --engine asyncio то же самое гоняется через bot_async.py (нужен aiohttp).
+С --digest N у всех чатов включается дайджест с окном N секунд.
+
+    python bench/bench_e2e.py --chats 50 --emails 200 --rate 20 --rtt 0.02
+"""
+
+import argparse
+import asyncio
+import contextlib
+import io
+import os
+import random
+import re
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from email.mime.image import MIMEImage
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from email.utils import formatdate
+from typing import Dict, List, Tuple
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+sys.path.insert(0, os.path.join(HERE, ".."))
+
+from fake_imap import FakeImapServer  # noqa: E402
+from fake_telegram import FakeTelegramServer  # noqa: E402
+
+SENDERS = {
+    "kwork": ("Kwork", "news@kwork.ru"),
+    "workzilla": ("Work-Zilla", "info@work-zilla.com"),
+    "freelancejob": ("Freelance.ru", "noreply@robot.freelance.ru"),
+}
+
+PHRASES = [
+    "Нужно сделать лендинг на Tilda",
+    "Парсер объявлений на Python",
+    "Telegram-бот для записи клиентов",
+    "Перевод статьи с английского",
+    "Дизайн логотипа для кофейни",
+    "Доработка интернет-магазина на WordPress",
+]
+
+_UID_RE = re.compile(r"uid=(\d+)")
+
+
+def make_email(rnd: random.Random, source: str, with_image: bool) -> bytes:
+    name, addr = SENDERS[source]
+    title = rnd.choice(PHRASES)
+    rows = "".join(
+        f"<tr><td style='padding:8px'>{rnd.choice(PHRASES)}</td><td>{rnd.randint(500, 50000)} ₽</td></tr>"
+        for _ in range(rnd.randint(3, 15))
+    )
+    html = (
+        "<html><head><style>td{font-family:Arial}</style></head><body>"
+        f"<h1>{title}</h1><p>Новый проект в вашей категории.<br>Бюджет: "
+        f"{rnd.randint(1000, 100000)} ₽</p><table>{rows}</table>"
+        "<div>Чтобы отписаться, перейдите в настройки.</div></body></html>"
+    )
+
+    msg = MIMEMultipart("related")
+    alt = MIMEMultipart("alternative")
+    alt.attach(MIMEText(html, "html", "utf-8"))
+    msg.attach(alt)
+    if with_image:
+        # Рассылки любят картинки в письме — их бот качать не должен
+        msg.attach(MIMEImage(b"\x89PNG\r\n\x1a\n" + rnd.randbytes(40_000), "png"))
+
+    msg["Subject"] = f"{name}: {title}"
+    msg["From"] = f"{name} <{addr}>"
+    msg["Date"] = formatdate(localtime=True)
+    return msg.as_bytes().replace(b"\r\n", b"\n").replace(b"\n", b"\r\n")
+
+
+def percentile(values: List[float], pct: float) -> float:
+    if not values:
+        return float("nan")
+    ordered = sorted(values)
+    idx = min(len(ordered) - 1, max(0, round(pct / 100 * (len(ordered) - 1))))
+    return ordered[idx]
+
+
+def imap_commands(srv: FakeImapServer) -> int:
+    with srv.lock:
+        return sum(srv.commands.values())
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--chats", type=int, default=20, help="подписанных чатов")
+    parser.add_argument("--groups", type=float, default=0.5, help="доля групп среди чатов")
+    parser.add_argument("--emails", type=int, default=60, help="писем в фазе вотчера")
+    parser.add_argument("--rate", type=float, default=10.0, help="писем в секунду")
+    parser.add_argument("--history", type=int, default=30, help="писем в ящике до старта")
+    parser.add_argument("--rtt", type=float, default=0.0, help="задержка IMAP-ответа, сек")
+    parser.add_argument("--tg-latency", type=float, default=0.0, help="задержка ответа Bot API, сек")
+    parser.add_argument("--tg-throttle", type=int, default=0, help="каждый N-й sendMessage получает 429")
+    parser.add_argument("--tg-limits", action="store_true",
+                        help="настоящие лимиты Telegram (по умолчанию сняты, чтобы мерить сам бот)")
+    parser.add_argument("--no-idle", action="store_true", help="вотчер опросом вместо IDLE")
+    parser.add_argument("--poll", type=float, default=1.0, help="период опроса, сек")
+    parser.add_argument("--images", type=float, default=0.5, help="доля писем с картинкой")
+    parser.add_argument("--timeout", type=float, default=120.0, help="сколько ждать доставки, сек")
+    parser.add_argument("--engine", choices=("threads", "asyncio"), default="threads",
+                        help="bot.py (потоки) или bot_async.py (один event loop)")
+    parser.add_argument("--digest", type=int, default=0, help="окно дайджеста у всех чатов, сек (0 — выкл)")
+    parser.add_argument("--verbose", action="store_true", help="не глушить логи бота")
+    args = parser.parse_args()
+
+    rnd = random.Random(1337)
+    imap_srv = FakeImapServer(rtt=args.rtt).start()
+    tg_srv = FakeTelegramServer(latency=args.tg_latency, throttle_every=args.tg_throttle).start()
+    workdir = tempfile.mkdtemp(prefix="bench_e2e_")
+
+    os.environ.update({
+        "BOT_TOKEN": "0:bench",
+        "GMAIL_USER": "bench@example.com",
+        "GMAIL_APP_PASSWORD": "bench",
+        "IMAP_HOST": imap_srv.host,
+        "IMAP_PORT": str(imap_srv.port),
+        "IMAP_SSL": "0",
+        "TG_API_URL": tg_srv.api_url,
+        "SETTINGS_FILE": os.path.join(workdir, "chat_settings.json"),
+        "WATCHER_STATE_FILE": os.path.join(workdir, "watcher_state.json"),
+        "MAIL_STORE_FILE": os.path.join(workdir, "mail_store.sqlite3"),
+        "OUTBOX_FILE": os.path.join(workdir, "outbox.sqlite3"),
+    })
+    if not args.tg_limits:
+        os.environ.update({"TG_GLOBAL_RATE": "100000", "TG_GROUP_RATE": "6000000", "TG_PRIVATE_RATE": "100000"})
+
+    sources = list(SENDERS)
+    for _ in range(args.history):
+        imap_srv.add_raw(make_email(rnd, rnd.choice(sources), rnd.random() < args.images))
+
+    quiet = io.StringIO()
+    logs = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(quiet)
+    with logs:
+        import bot
+
+        chat_ids = [
+            -(1_000_000_000_000 + i) if i < args.chats * args.groups else 100_000 + i
+            for i in range(args.chats)
+        ]
+        for chat_id in chat_ids:
+            bot.set_chat_notifications(chat_id, True)
+            if args.digest:
+                bot.chat_registry.update(chat_id, lambda old: old.replace(digest=args.digest))
+
+        list_last_emails = bot.list_last_emails
+        get_email_by_uid = bot.get_email_by_uid
+        send_email_pretty = bot.send_email_pretty
+        if args.engine == "asyncio":
+            import bot_async
+
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, daemon=True).start()
+
+            def run(coro):
+                return asyncio.run_coroutine_threadsafe(coro, loop).result()
+
+            asyncio.run_coroutine_threadsafe(
+                bot_async.watcher_loop_async(poll_interval=args.poll, use_idle=not args.no_idle), loop
+            )
+            list_last_emails = lambda sender, limit: run(bot_async.list_last_emails_async(sender, limit))
+            get_email_by_uid = lambda uid: run(bot_async.get_email_by_uid_async(uid))
+            send_email_pretty = lambda chat_id, *a: run(
+                bot_async.send_rendered_async(chat_id, bot.render_email(*a))
+            )
+        else:
+            # ---------- вотчер ----------
+            threading.Thread(
+                target=bot.watcher_loop,
+                kwargs={"poll_interval": args.poll, "use_idle": not args.no_idle},
+                daemon=True,
+            ).start()
+        deadline = time.monotonic() + 10
+        while any(v is None for v in bot.last_uids.values()) and time.monotonic() < deadline:
+            time.sleep(0.01)
+        time.sleep(0.2)
+
+        imap_srv.reset_stats()
+        tg_srv.reset()
+        started = time.perf_counter()
+        new_uids: List[int] = []
+        for i in range(args.emails):
+            target = started + i / args.rate
+            delay = target - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            new_uids.append(imap_srv.add_raw(make_email(rnd, rnd.choice(sources), rnd.random() < args.images)))
+
+        expected = len(new_uids) * len(chat_ids)
+        deadline = time.monotonic() + args.timeout
+        delivered: Dict[Tuple[int, int], float] = {}
+        while time.monotonic() < deadline:
+            for msg in tg_srv.snapshot():
+                if "Новое письмо" not in msg.text and "Новые письма" not in msg.text:
+                    continue
+                # В дайджесте — по ссылке на каждое письмо
+                for m in _UID_RE.finditer(msg.text):
+                    delivered.setdefault((msg.chat_id, int(m.group(1))), msg.at)
+            if len(delivered) >= expected:
+                break
+            time.sleep(0.05)
+
+        watcher_cmds = imap_commands(imap_srv)
+        watcher_bytes = imap_srv.bytes_sent
+        latencies = [at - imap_srv.arrivals[uid] for (_, uid), at in delivered.items()]
+        first_seen: Dict[int, float] = {}
+        for (_, uid), at in delivered.items():
+            first_seen[uid] = min(first_seen.get(uid, at), at)
+        detect = [first_seen[uid] - imap_srv.arrivals[uid] for uid in first_seen]
+        elapsed = (max(delivered.values()) - started) if delivered else float("nan")
+        sends = len(tg_srv.snapshot())
+
+        # ---------- /mails и открытие письма ----------
+        def timed(func, *a):
+            before = imap_commands(imap_srv)
+            t0 = time.perf_counter()
+            func(*a)
+            return (time.perf_counter() - t0) * 1000, imap_commands(imap_srv) - before
+
+        sender = SENDERS["kwork"][1]
+        bot.email_cache.invalidate_lists(sender)
+        list_cold = timed(list_last_emails, sender, bot.MAILS_LIMIT)
+        list_warm = timed(list_last_emails, sender, bot.MAILS_LIMIT)
+
+        history_uids = [str(uid) for uid in range(1, args.history + 1)]
+        cold = [timed(get_email_by_uid, uid) for uid in history_uids]
+        warm = [timed(get_email_by_uid, uid) for uid in history_uids]
+
+        # ---------- send_email_pretty ----------
+        subject, from_, date, body = get_email_by_uid(history_uids[0]) if history_uids else ("", "", "", "")
+        pretty: List[float] = []
+        for i in range(20):
+            t0 = time.perf_counter()
+            send_email_pretty(-(2_000_000_000_000 + i), "kwork", subject or "", from_ or "", date or "", body or "", "1")
+            pretty.append((time.perf_counter() - t0) * 1000)
+        if args.engine == "asyncio":
+            run(bot_async.abot.close_session())
+
+    print(f"chats: {len(chat_ids)}  emails: {len(new_uids)} @ {args.rate}/s  imap rtt: {args.rtt * 1000:.0f} ms"
+          f"  watcher: {'poll' if args.no_idle else 'IDLE'}  engine: {args.engine}"
+          f"  telegram limits: {'on' if args.tg_limits else 'off'}  digest: {args.digest or 'off'}")
+    print("\n[watcher]")
+    print(f"  delivered:        {len(delivered)}/{expected} notifications, {sends} sendMessage calls, "
+          f"{tg_srv.throttled} x 429")
+    print(f"  throughput:       {len(first_seen) / elapsed:.1f} emails/s, {len(delivered) / elapsed:.1f} notifications/s")
+    print(f"  IMAP per email:   {watcher_cmds / max(1, len(new_uids)):.2f} commands, "
+          f"{watcher_bytes / max(1, len(new_uids)) / 1024:.1f} KiB body data")
+    print(f"  detect (1st chat): p50 {percentile(detect, 50) * 1000:.0f} ms  p99 {percentile(detect, 99) * 1000:.0f} ms")
+    print(f"  arrival->send:    p50 {percentile(latencies, 50) * 1000:.0f} ms  p99 {percentile(latencies, 99) * 1000:.0f} ms")
+    print("\n[mails]")
+    print(f"  list_last_emails cold: {list_cold[0]:.1f} ms, {list_cold[1]} IMAP commands")
+    print(f"  list_last_emails warm: {list_warm[0]:.1f} ms, {list_warm[1]} IMAP commands")
+    if cold:
+        print(f"  get_email_by_uid cold: p50 {statistics.median(c[0] for c in cold):.1f} ms, "
+              f"{sum(c[1] for c in cold) / len(cold):.1f} IMAP commands")
+        print(f"  get_email_by_uid warm: p50 {statistics.median(w[0] for w in warm):.2f} ms, "
+              f"{sum(w[1] for w in warm) / len(warm):.1f} IMAP commands")
+    print(f"  send_email_pretty:     p50 {statistics.median(pretty):.1f} ms  p99 {percentile(pretty, 99):.1f} ms")
+
+    imap_srv.stop()
+    tg_srv.stop()
+
+
+if __name__ == "__main__":
+    main()
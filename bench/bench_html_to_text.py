@@ -0,0 +1,169 @@
+"""
+html_to_text(): скорость нового токенизатора против старой версии на 13 re.sub
+и сверка результатов (golden) на том же корпусе.
+
+    python bench/bench_html_to_text.py [папка_с_.html ...]
+
+Без аргументов корпус генерируется: рассылки с таблицами, стилями, скриптами,
+комментариями и сущностями. Код выхода 1, если выводы разошлись где-то,
+кроме известных намеренных отличий (см. KNOWN_DIVERGENCES).
+"""
+
+import os
+import random
+import re
+import sys
+import time
+from html import unescape
+
+os.environ.setdefault("BOT_TOKEN", "0:bench")
+os.environ.setdefault("GMAIL_USER", "bench@example.com")
+os.environ.setdefault("GMAIL_APP_PASSWORD", "bench")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import bot  # noqa: E402
+
+
+def legacy_html_to_text(html: str) -> str:
+    """html_to_text() до перехода на токенизатор — эталон для сверки."""
+    html = re.sub(r"(?is)<(script|style).*?>.*?(</\1>)", "", html)
+
+    html = re.sub(r"(?is)<br\s*/?>", "\n", html)
+    html = re.sub(r"(?is)</p>", "\n\n", html)
+    html = re.sub(r"(?is)</div>", "\n", html)
+    html = re.sub(r"(?is)</li>", "\n", html)
+    html = re.sub(r"(?is)</h[1-6]>", "\n\n", html)
+    html = re.sub(r"(?is)</tr>", "\n", html)
+
+    html = re.sub(r"(?is)<t[dh][^>]*>", " ", html)
+
+    text = re.sub(r"(?s)<.*?>", "", html)
+    text = unescape(text)
+
+    text = re.sub(r"[ \t]+", " ", text)
+    text = re.sub(r"\r", "", text)
+    text = re.sub(r"\n\s+", "\n", text)
+    text = re.sub(r"\n{3,}", "\n\n", text)
+
+    return text.strip()
+
+
+# Где новая версия сознательно отличается от старой
+KNOWN_DIVERGENCES = [
+    # <br> с атрибутами старая версия не превращала в перенос строки
+    '<p>Строка<br class="x">вторая</p>',
+    # Комментарий с ">" внутри старая версия обрезала по первому ">"
+    "<!-- [if mso]> outlook <![endif] -->Текст",
+    # Закрывающий тег с пробелом перед ">" старая версия не узнавала
+    "<h2>Заголовок</h2 >текст",
+    # "<" с пробелом после — текст, старая версия резала до следующего ">"
+    "<p>1 < 2</p><p>3 > 2</p>",
+]
+
+WORDS = (
+    "заказ проект срочно бюджет дизайн логотип сайт верстка бот telegram python "
+    "парсер отклик клиент оплата задача исполнитель срок отзыв рейтинг категория "
+    "работа фриланс текст перевод &nbsp; &laquo;цитата&raquo; &#8212;"
+).split()
+
+
+def words(rnd: random.Random, n: int) -> str:
+    return " ".join(rnd.choice(WORDS) for _ in range(n))
+
+
+def make_email(rnd: random.Random, blocks: int) -> str:
+    parts = [
+        "<!DOCTYPE html><html><head><meta charset='utf-8'>",
+        "<style type='text/css'>td { padding: 0; } .btn > a { color: red; }</style>",
+        "<script>var a = '<div>' + 1 < 2;</script>",
+        "</head><body>\r\n<!-- preheader -->",
+    ]
+    for i in range(blocks):
+        kind = rnd.randrange(6)
+        if kind == 0:
+            parts.append(f"<h{rnd.randint(1, 6)} style='margin:0'>{words(rnd, 5)}</h{rnd.randint(1, 6)}>")
+        elif kind == 1:
+            parts.append(f"<p class=\"text\">\n    {words(rnd, 30)}<br>{words(rnd, 10)}<br/>\n</p>")
+        elif kind == 2:
+            rows = "".join(
+                f"<tr>\n  <td width='50%' style='padding:8px'>{words(rnd, 4)}</td>"
+                f"<td>{words(rnd, 3)}</td></tr>"
+                for _ in range(rnd.randint(2, 6))
+            )
+            parts.append(f"<table cellpadding='0' cellspacing='0'><tr><th>{words(rnd, 2)}</th></tr>{rows}</table>")
+        elif kind == 3:
+            items = "".join(f"<li>{words(rnd, 6)}</li>\n" for _ in range(rnd.randint(2, 5)))
+            parts.append(f"<ul>\n{items}</ul>")
+        elif kind == 4:
+            parts.append(
+                f"<div style='font-family:Arial'><a href='https://kwork.ru/projects/{i}?utm=1&amp;x=2'>"
+                f"{words(rnd, 3)}</a>\t\t<span>{words(rnd, 8)}</span></div>"
+            )
+        else:
+            parts.append(f"<div><img src='https://x/{i}.png' alt='{words(rnd, 2)}'>&nbsp;&nbsp;{words(rnd, 12)}</div>\n\n\n")
+    parts.append("</body></html>")
+    return "".join(parts)
+
+
+def load_corpus(paths: list) -> list:
+    corpus = []
+    for path in paths:
+        for name in sorted(os.listdir(path)):
+            if name.endswith((".html", ".htm")):
+                with open(os.path.join(path, name), encoding="utf-8", errors="ignore") as f:
+                    corpus.append(f.read())
+    return corpus
+
+
+def timeit(func, corpus: list, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for doc in corpus:
+            func(doc)
+        best = min(best, time.perf_counter() - started)
+    return best
+
+
+def main() -> None:
+    if len(sys.argv) > 1:
+        corpus = load_corpus(sys.argv[1:])
+    else:
+        rnd = random.Random(42)
+        corpus = [make_email(rnd, blocks) for blocks in (5, 20, 80, 300) for _ in range(25)]
+
+    size = sum(len(doc) for doc in corpus)
+    print(f"corpus: {len(corpus)} docs, {size / 1024:.0f} KiB")
+
+    mismatches = 0
+    for idx, doc in enumerate(corpus):
+        if bot.html_to_text(doc) != legacy_html_to_text(doc):
+            mismatches += 1
+            if mismatches <= 3:
+                print(f"golden mismatch in doc #{idx}")
+    print(f"golden: {len(corpus) - mismatches}/{len(corpus)} identical")
+
+    for doc in KNOWN_DIVERGENCES:
+        print(f"known divergence: {doc!r}\n  legacy: {legacy_html_to_text(doc)!r}\n  new:    {bot.html_to_text(doc)!r}")
+
+    legacy = timeit(legacy_html_to_text, corpus, 5)
+    new = timeit(bot.html_to_text, corpus, 5)
+    print(f"legacy: {legacy * 1000:8.1f} ms  {size / legacy / 2**20:6.1f} MiB/s")
+    print(f"new:    {new * 1000:8.1f} ms  {size / new / 2**20:6.1f} MiB/s  (x{legacy / new:.1f})")
+
+    # Худший случай для старой версии: много "<" без ">" — каждый re.sub
+    # с (?is) заново сканирует хвост документа
+    evil = "<p>" + "a < b " * 5000 + "</p>"
+    if bot.html_to_text(evil) != legacy_html_to_text(evil):
+        mismatches += 1
+        print("golden mismatch in unclosed '<' case")
+    for name, func in (("legacy", legacy_html_to_text), ("new", bot.html_to_text)):
+        started = time.perf_counter()
+        func(evil)
+        print(f"unclosed '<' x5000, {name}: {(time.perf_counter() - started) * 1000:.1f} ms")
+
+    sys.exit(1 if mismatches else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+"""
+Сколько памяти занимают настройки N чатов: старая схема (dict на чат +
+set chat_ids + индекс подписок) против ChatRegistry.
+
+    python bench/bench_registry_memory.py [chats]
+"""
+
+import os
+import sys
+import time
+import tracemalloc
+
+# bot.py требует токены при импорте — для замера хватит заглушек
+os.environ.setdefault("BOT_TOKEN", "0:bench")
+os.environ.setdefault("GMAIL_USER", "bench@example.com")
+os.environ.setdefault("GMAIL_APP_PASSWORD", "bench")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import bot  # noqa: E402
+
+TITLES = ["Фриланс заказы", "Заказы kwork", "Мои уведомления", ""]
+TYPES = ["private", "group", "supergroup"]
+
+
+def make_config(i: int) -> dict:
+    sources = [src for idx, src in enumerate(bot.SOURCES) if (i >> idx) & 1 or idx == 0]
+    return {
+        "sources": sources,
+        "notifications": i % 5 != 0,
+        # Как после json.load: строки одинаковые, но разные объекты
+        "title": "".join(list(TITLES[i % len(TITLES)])),
+        "type": "".join(list(TYPES[i % len(TYPES)])),
+    }
+
+
+def measure(build) -> tuple:
+    tracemalloc.start()
+    started = time.perf_counter()
+    keep = build()
+    elapsed = time.perf_counter() - started
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del keep
+    return size, elapsed
+
+
+def build_legacy(n: int):
+    chat_settings = {}
+    chat_ids = set()
+    subscribers = {src: set() for src in bot.SOURCES}
+    for i in range(n):
+        cfg = make_config(i)
+        chat_settings[-1000000000000 - i] = cfg
+        if cfg["notifications"]:
+            chat_ids.add(-1000000000000 - i)
+            for src in cfg["sources"]:
+                subscribers[src].add(-1000000000000 - i)
+    return chat_settings, chat_ids, {src: frozenset(ids) for src, ids in subscribers.items()}
+
+
+def build_registry(n: int):
+    registry = bot.ChatRegistry()
+    registry.replace_all({-1000000000000 - i: bot.parse_chat_config(make_config(i)) for i in range(n)})
+    return registry
+
+
+def main() -> None:
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+
+    legacy_size, legacy_time = measure(lambda: build_legacy(n))
+    registry_size, registry_time = measure(lambda: build_registry(n))
+
+    print(f"chats: {n}")
+    print(f"legacy dict:   {legacy_size / 2**20:8.1f} MiB  {legacy_size / n:6.0f} B/chat  build {legacy_time:.1f}s")
+    print(f"ChatRegistry:  {registry_size / 2**20:8.1f} MiB  {registry_size / n:6.0f} B/chat  build {registry_time:.1f}s")
+    print(f"saved: {(1 - registry_size / legacy_size) * 100:.0f}%")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,202 @@
+"""
+Бенчмарк приёма апдейтов: long polling против вебхука.
+
+Заглушка Bot API (fake_telegram) выдаёт апдейты /chatid от --chats чатов с
+частотой --rate: в режиме polling — через getUpdates, в режиме webhook —
+POST-ами на встроенный сервер бота с --connections соединений (как Telegram
+с max_connections). Меряется задержка от появления апдейта до ответа бота
+(sendMessage) и пропускная способность. В режиме webhook дополнительно
+проверяется, что запросы с чужим секретом, не тем путём и мусором в теле
+отклоняются. Если ответов меньше, чем апдейтов, или статус отказа не тот,
+скрипт завершается с кодом 1 — его можно гонять как тест.
+
+    python bench/bench_webhook.py --mode polling --updates 500 --rate 100 --tg-latency 0.05
+    python bench/bench_webhook.py --mode webhook --updates 500 --rate 100 --tg-latency 0.05
+"""
+
+import argparse
+import contextlib
+import io
+import os
+import queue
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from typing import Dict, List
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+sys.path.insert(0, os.path.join(HERE, ".."))
+
+from fake_telegram import FakeTelegramServer, WebhookClient, make_message_update  # noqa: E402
+
+SECRET = "bench-secret"
+PATH = "/tg/bench"
+
+
+def percentile(values: List[float], pct: float) -> float:
+    if not values:
+        return float("nan")
+    ordered = sorted(values)
+    idx = min(len(ordered) - 1, max(0, round(pct / 100 * (len(ordered) - 1))))
+    return ordered[idx]
+
+
+# Какой статус вебхук должен вернуть на каждый плохой запрос
+EXPECTED_REJECTS = {"wrong secret": 403, "no secret": 403, "wrong path": 404, "bad json": 400}
+
+
+def check_rejects(url: str) -> Dict[str, int]:
+    """Запросы, которые вебхук должен отклонить: {что: HTTP-статус}."""
+    update = make_message_update(10**9, 1, "/chatid")
+    statuses = {}
+    client = WebhookClient(url, "wrong-secret")
+    statuses["wrong secret"] = client.post(update)
+    client.close()
+    client = WebhookClient(url, None)
+    statuses["no secret"] = client.post(update)
+    client.close()
+    client = WebhookClient(url.replace(PATH, "/other"), SECRET)
+    statuses["wrong path"] = client.post(update)
+    client.close()
+    client = WebhookClient(url, SECRET)
+    client._conn.request("POST", PATH, body=b"{not json", headers={"X-Telegram-Bot-Api-Secret-Token": SECRET})
+    resp = client._conn.getresponse()
+    resp.read()
+    statuses["bad json"] = resp.status
+    client.close()
+    return statuses
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mode", choices=("polling", "webhook"), default="webhook")
+    parser.add_argument("--chats", type=int, default=50, help="чатов, из которых приходят апдейты")
+    parser.add_argument("--updates", type=int, default=300, help="всего апдейтов")
+    parser.add_argument("--rate", type=float, default=100.0, help="апдейтов в секунду")
+    parser.add_argument("--tg-latency", type=float, default=0.05, help="задержка ответа Bot API, сек")
+    parser.add_argument("--workers", type=int, default=8, help="WEBHOOK_WORKERS")
+    parser.add_argument("--connections", type=int, default=40, help="параллельных POST-ов (max_connections)")
+    parser.add_argument("--timeout", type=float, default=60.0, help="сколько ждать ответов, сек")
+    parser.add_argument("--verbose", action="store_true", help="не глушить логи бота")
+    args = parser.parse_args()
+
+    tg_srv = FakeTelegramServer(latency=args.tg_latency).start()
+    workdir = tempfile.mkdtemp(prefix="bench_webhook_")
+    os.environ.update({
+        "BOT_TOKEN": "0:bench",
+        "GMAIL_USER": "bench@example.com",
+        "GMAIL_APP_PASSWORD": "bench",
+        "TG_API_URL": tg_srv.api_url,
+        "SETTINGS_FILE": os.path.join(workdir, "chat_settings.json"),
+        "WATCHER_STATE_FILE": os.path.join(workdir, "watcher_state.json"),
+        "MAIL_STORE_FILE": os.path.join(workdir, "mail_store.sqlite3"),
+        "OUTBOX_FILE": os.path.join(workdir, "outbox.sqlite3"),
+        "TG_GLOBAL_RATE": "100000",
+        "TG_PRIVATE_RATE": "100000",
+        "WEBHOOK_SECRET": SECRET,
+        "WEBHOOK_PATH": PATH,
+        "WEBHOOK_WORKERS": str(args.workers),
+    })
+
+    quiet = io.StringIO()
+    logs = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(quiet)
+    with logs:
+        import bot
+
+        chat_ids = [100_000 + i for i in range(args.chats)]
+        updates = [
+            make_message_update(tg_srv.next_update_id(), chat_ids[i % len(chat_ids)], "/chatid")
+            for i in range(args.updates)
+        ]
+
+        rejects: Dict[str, int] = {}
+        if args.mode == "webhook":
+            server = bot.make_webhook_server("127.0.0.1", 0)
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            url = f"http://127.0.0.1:{server.server_address[1]}{PATH}"
+            rejects = check_rejects(url)
+
+            outbox: "queue.Queue[dict]" = queue.Queue()
+            statuses: Dict[int, int] = defaultdict(int)
+            status_lock = threading.Lock()
+
+            def deliver() -> None:
+                # Как Telegram: не получил 200 — повторяет тот же апдейт
+                client = WebhookClient(url, SECRET)
+                while True:
+                    update = outbox.get()
+                    while True:
+                        status = client.post(update)
+                        with status_lock:
+                            statuses[status] += 1
+                        if status == 200:
+                            break
+                        time.sleep(0.1)
+
+            for _ in range(args.connections):
+                threading.Thread(target=deliver, daemon=True).start()
+            push = outbox.put
+        else:
+            bot.bot.remove_webhook()
+            threading.Thread(
+                target=bot.bot.infinity_polling, kwargs={"skip_pending": True, "timeout": 10}, daemon=True
+            ).start()
+            time.sleep(0.3)
+            push = tg_srv.push_update
+
+        tg_srv.reset()
+        pushed_at: Dict[int, List[float]] = defaultdict(list)
+        started = time.perf_counter()
+        for i, update in enumerate(updates):
+            delay = started + i / args.rate - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            pushed_at[update["message"]["chat"]["id"]].append(time.perf_counter())
+            push(update)
+
+        deadline = time.monotonic() + args.timeout
+        while len(tg_srv.snapshot()) < args.updates and time.monotonic() < deadline:
+            time.sleep(0.02)
+        sent = tg_srv.snapshot()
+        if args.mode == "polling":
+            bot.bot.stop_polling()
+
+    # k-й ответ в чат — на k-й апдейт из этого чата
+    replies: Dict[int, List[float]] = defaultdict(list)
+    for msg in sent:
+        replies[msg.chat_id].append(msg.at)
+    latencies = [
+        (at - pushed) * 1000
+        for chat_id, times in replies.items()
+        for pushed, at in zip(pushed_at[chat_id], times)
+    ]
+    elapsed = (max(m.at for m in sent) - started) if sent else float("nan")
+
+    print(f"mode={args.mode} chats={args.chats} updates={args.updates} rate={args.rate}/s "
+          f"tg_latency={args.tg_latency * 1000:.0f}ms")
+    print(f"  answered        {len(sent)}/{args.updates} in {elapsed:.2f}s "
+          f"({len(sent) / elapsed if sent else 0:.1f} updates/s)")
+    print(f"  latency         p50={percentile(latencies, 50):.0f}ms "
+          f"p99={percentile(latencies, 99):.0f}ms max={percentile(latencies, 100):.0f}ms")
+    if args.mode == "webhook":
+        print(f"  webhook replies {dict(statuses)}")
+        print("  rejected        " + ", ".join(f"{k}: {v}" for k, v in rejects.items()))
+    tg_srv.stop()
+
+    failures = [
+        f"{what}: got {rejects.get(what)}, expected {status}"
+        for what, status in EXPECTED_REJECTS.items()
+        if args.mode == "webhook" and rejects.get(what) != status
+    ]
+    if len(sent) < args.updates:
+        failures.append(f"answered {len(sent)} of {args.updates} updates")
+    for failure in failures:
+        print(f"FAIL {failure}")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,402 @@
+"""
+Минимальный IMAP4rev1-сервер в памяти для бенчмарков.
+
+Умеет ровно то, чем пользуется бот: LOGIN, SELECT, NOOP, STATUS, IDLE,
+UID SEARCH (UID-диапазоны, FROM, OR, ALL) и UID FETCH (UID, INTERNALDATE,
+RFC822, BODYSTRUCTURE, BODY.PEEK[...] с HEADER.FIELDS, номерами секций
+и <partial>). TLS нет — бот подключается к нему с IMAP_SSL=0.
+"""
+
+import email
+import email.utils
+import imaplib
+import re
+import select
+import socketserver
+import threading
+import time
+from collections import Counter
+from email.message import Message
+from typing import Dict, List, Optional, Tuple
+
+
+UIDVALIDITY = 1
+
+
+class StoredMessage:
+    __slots__ = ("uid", "raw", "msg", "internaldate", "from_addr")
+
+    def __init__(self, uid: int, raw: bytes, internaldate: float) -> None:
+        self.uid = uid
+        self.raw = raw
+        self.msg = email.message_from_bytes(raw)
+        self.internaldate = internaldate
+        self.from_addr = email.utils.parseaddr(self.msg.get("From", ""))[1].lower()
+
+
+def _quote(value: Optional[str]) -> str:
+    if value is None:
+        return "NIL"
+    return '"' + value.replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+
+def _split_raw(raw: bytes) -> Tuple[bytes, bytes]:
+    idx = raw.find(b"\r\n\r\n")
+    if idx < 0:
+        return raw, b""
+    return raw[: idx + 4], raw[idx + 4:]
+
+
+def _part_bytes(msg: Message) -> bytes:
+    raw = msg.as_bytes().replace(b"\r\n", b"\n").replace(b"\n", b"\r\n")
+    return raw
+
+
+def _bodystructure(msg: Message) -> str:
+    if msg.is_multipart():
+        inner = "".join(_bodystructure(p) for p in msg.get_payload())
+        return f"({inner} {_quote(msg.get_content_subtype().upper())})"
+
+    maintype = msg.get_content_maintype().upper()
+    subtype = msg.get_content_subtype().upper()
+    params = msg.get_params()[1:] if msg.get_params() else []
+    params_str = (
+        "(" + " ".join(f"{_quote(k.upper())} {_quote(v)}" for k, v in params) + ")"
+        if params else "NIL"
+    )
+    encoding = (msg.get("Content-Transfer-Encoding") or "7BIT").upper()
+    _, body = _split_raw(_part_bytes(msg))
+    size = len(body)
+    disposition = msg.get("Content-Disposition")
+    if disposition:
+        dtype = disposition.split(";")[0].strip().upper()
+        filename = msg.get_filename()
+        dparams = f"({_quote('FILENAME')} {_quote(filename)})" if filename else "NIL"
+        disp = f"({_quote(dtype)} {dparams})"
+    else:
+        disp = "NIL"
+    if maintype == "TEXT":
+        lines = body.count(b"\r\n")
+        return (
+            f"({_quote(maintype)} {_quote(subtype)} {params_str} NIL NIL "
+            f"{_quote(encoding)} {size} {lines} NIL {disp} NIL)"
+        )
+    return (
+        f"({_quote(maintype)} {_quote(subtype)} {params_str} NIL NIL "
+        f"{_quote(encoding)} {size} NIL {disp} NIL)"
+    )
+
+
+def _section_part(msg: Message, section: str) -> Optional[Message]:
+    part = msg
+    for num in section.split("."):
+        idx = int(num) - 1
+        if part.is_multipart():
+            payload = part.get_payload()
+            if idx >= len(payload):
+                return None
+            part = payload[idx]
+        elif idx != 0:
+            return None
+    return part
+
+
+def _section_bytes(stored: StoredMessage, spec: str) -> bytes:
+    header, body = _split_raw(stored.raw)
+    spec_up = spec.upper()
+    if spec_up == "":
+        return stored.raw
+    if spec_up == "HEADER":
+        return header
+    if spec_up == "TEXT":
+        return body
+    m = re.match(r"HEADER\.FIELDS\s*\(([^)]*)\)", spec_up)
+    if m:
+        wanted = {f.lower() for f in m.group(1).split()}
+        out = b""
+        for line in re.split(rb"\r\n(?![ \t])", header):
+            name = line.split(b":", 1)[0].decode("ascii", "ignore").lower()
+            if name in wanted and line.strip():
+                out += line + b"\r\n"
+        return out + b"\r\n"
+    part = _section_part(stored.msg, spec)
+    if part is None:
+        return b""
+    if part is stored.msg and not stored.msg.is_multipart():
+        return body
+    _, pbody = _split_raw(_part_bytes(part))
+    return pbody
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    server: "FakeImapServer._Server"
+    # Ответы пишутся по строке — без этого Nagle + delayed ACK дают ~40 мс на команду
+    disable_nagle_algorithm = True
+
+    def send(self, line: str) -> None:
+        self.wfile.write(line.encode("utf-8") + b"\r\n")
+
+    def handle(self) -> None:
+        srv = self.server.owner
+        self.selected = False
+        self.known_exists = 0
+        self.send("* OK [CAPABILITY IMAP4rev1 IDLE] fake ready")
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            line = line.rstrip(b"\r\n").decode("utf-8", "replace")
+            if not line:
+                continue
+            tag, _, rest = line.partition(" ")
+            cmd, _, args = rest.partition(" ")
+            cmd = cmd.upper()
+            with srv.lock:
+                srv.commands[cmd] += 1
+            if srv.rtt:
+                time.sleep(srv.rtt)
+            try:
+                if cmd == "CAPABILITY":
+                    caps = "IMAP4rev1" + (" IDLE" if srv.idle_supported else "")
+                    self.send(f"* CAPABILITY {caps}")
+                    self.send(f"{tag} OK CAPABILITY completed")
+                elif cmd == "LOGIN":
+                    with srv.lock:
+                        srv.logins += 1
+                    self.send(f"{tag} OK LOGIN completed")
+                elif cmd in ("SELECT", "EXAMINE"):
+                    self.selected = True
+                    msgs = srv.snapshot()
+                    self.known_exists = len(msgs)
+                    self.send(f"* {len(msgs)} EXISTS")
+                    self.send(f"* OK [UIDVALIDITY {srv.uidvalidity}] UIDs valid")
+                    self.send(f"* OK [UIDNEXT {srv.next_uid}] next")
+                    self.send(f"{tag} OK [READ-WRITE] SELECT completed")
+                elif cmd == "STATUS":
+                    self.send(
+                        f'* STATUS "INBOX" (UIDNEXT {srv.next_uid} '
+                        f"UIDVALIDITY {srv.uidvalidity} MESSAGES {len(srv.snapshot())})"
+                    )
+                    self.send(f"{tag} OK STATUS completed")
+                elif cmd == "NOOP":
+                    self._announce()
+                    self.send(f"{tag} OK NOOP completed")
+                elif cmd == "IDLE":
+                    self._idle(tag)
+                elif cmd == "UID":
+                    sub, _, subargs = args.partition(" ")
+                    sub = sub.upper()
+                    self._announce()
+                    if sub == "SEARCH":
+                        uids = self._search(subargs)
+                        self.send("* SEARCH" + "".join(f" {u}" for u in uids))
+                        self.send(f"{tag} OK SEARCH completed")
+                    elif sub == "FETCH":
+                        self._fetch(tag, subargs)
+                    else:
+                        self.send(f"{tag} BAD unknown UID command")
+                elif cmd == "CLOSE":
+                    self.selected = False
+                    self.send(f"{tag} OK CLOSE completed")
+                elif cmd == "LOGOUT":
+                    self.send("* BYE logging out")
+                    self.send(f"{tag} OK LOGOUT completed")
+                    return
+                else:
+                    self.send(f"{tag} BAD unknown command {cmd}")
+            except (ConnectionError, OSError):
+                return
+            except Exception as e:  # ошибки разбора — как BAD
+                self.send(f"{tag} BAD {type(e).__name__}: {e}")
+
+    def _announce(self) -> None:
+        count = len(self.server.owner.snapshot())
+        if count != self.known_exists:
+            self.known_exists = count
+            self.send(f"* {count} EXISTS")
+
+    def _idle(self, tag: str) -> None:
+        srv = self.server.owner
+        self.send("+ idling")
+        sock = self.connection
+        while True:
+            with srv.new_mail:
+                srv.new_mail.wait_for(
+                    lambda: len(srv.messages) != self.known_exists, timeout=0.02
+                )
+            self._announce()
+            ready, _, _ = select.select([sock], [], [], 0)
+            if ready:
+                line = self.rfile.readline()
+                if not line:
+                    raise ConnectionError("client gone")
+                if line.strip().upper() == b"DONE":
+                    self.send(f"{tag} OK IDLE terminated")
+                    return
+
+    # -------- SEARCH --------
+
+    def _search(self, args: str) -> List[int]:
+        tokens = _tokenize(args)
+        msgs = self.server.owner.snapshot()
+        keys = []
+        while tokens:
+            keys.append(_parse_key(tokens))
+        return [m.uid for m in msgs if all(k(m, msgs) for k in keys)]
+
+    # -------- FETCH --------
+
+    def _fetch(self, tag: str, args: str) -> None:
+        srv = self.server.owner
+        seq, _, items = args.partition(" ")
+        items = items.strip()
+        if items.startswith("(") and items.endswith(")"):
+            items = items[1:-1]
+        wanted = re.findall(
+            r"BODY(?:\.PEEK)?\[[^\]]*\](?:<\d+\.\d+>)?|[A-Z0-9.]+", items, re.I
+        )
+        msgs = srv.snapshot()
+        max_uid = msgs[-1].uid if msgs else 0
+        selected = [m for m in msgs if _in_set(m.uid, seq, max_uid)]
+        with srv.lock:
+            srv.fetched_messages += len(selected)
+        for seqno, m in ((msgs.index(m) + 1, m) for m in selected):
+            parts: List[bytes] = [f"* {seqno} FETCH (UID {m.uid}".encode()]
+            for item in wanted:
+                up = item.upper()
+                if up == "UID":
+                    continue
+                if up == "FLAGS":
+                    parts.append(b" FLAGS ()")
+                elif up == "INTERNALDATE":
+                    stamp = imaplib.Time2Internaldate(m.internaldate)
+                    parts.append(f" INTERNALDATE {stamp}".encode())
+                elif up == "RFC822":
+                    parts.append(f" RFC822 {{{len(m.raw)}}}\r\n".encode() + m.raw)
+                elif up == "BODYSTRUCTURE":
+                    parts.append(b" BODYSTRUCTURE " + _bodystructure(m.msg).encode())
+                elif up.startswith("BODY"):
+                    mm = re.match(r"BODY(?:\.PEEK)?\[([^\]]*)\](?:<(\d+)\.(\d+)>)?", item, re.I)
+                    spec = mm.group(1)
+                    data = _section_bytes(m, spec)
+                    origin = ""
+                    if mm.group(2) is not None:
+                        start, length = int(mm.group(2)), int(mm.group(3))
+                        data = data[start:start + length]
+                        origin = f"<{start}>"
+                    with srv.lock:
+                        srv.bytes_sent += len(data)
+                    parts.append(
+                        f" BODY[{spec}]{origin} {{{len(data)}}}\r\n".encode() + data
+                    )
+            parts.append(b")\r\n")
+            self.wfile.write(b"".join(parts))
+        self.send(f"{tag} OK FETCH completed")
+
+
+def _tokenize(text: str) -> List[str]:
+    return re.findall(r'"(?:[^"\\]|\\.)*"|\(|\)|[^\s()]+', text)
+
+
+def _unquote(tok: str) -> str:
+    if tok.startswith('"'):
+        return tok[1:-1].replace('\\"', '"').replace("\\\\", "\\")
+    return tok
+
+
+def _in_set(uid: int, seq: str, max_uid: int) -> bool:
+    for chunk in seq.split(","):
+        if ":" in chunk:
+            a, b = chunk.split(":")
+            lo = max_uid if a == "*" else int(a)
+            hi = max_uid if b == "*" else int(b)
+            if lo > hi:
+                lo, hi = hi, lo
+            if lo <= uid <= hi:
+                return True
+        elif (max_uid if chunk == "*" else int(chunk)) == uid:
+            return True
+    return False
+
+
+def _parse_key(tokens: List[str]):
+    tok = tokens.pop(0)
+    up = tok.upper()
+    if tok == "(":
+        keys = []
+        while tokens[0] != ")":
+            keys.append(_parse_key(tokens))
+        tokens.pop(0)
+        return lambda m, msgs: all(k(m, msgs) for k in keys)
+    if up == "ALL":
+        return lambda m, msgs: True
+    if up == "OR":
+        a = _parse_key(tokens)
+        b = _parse_key(tokens)
+        return lambda m, msgs: a(m, msgs) or b(m, msgs)
+    if up == "NOT":
+        a = _parse_key(tokens)
+        return lambda m, msgs: not a(m, msgs)
+    if up == "FROM":
+        needle = _unquote(tokens.pop(0)).lower()
+        return lambda m, msgs: needle in m.msg.get("From", "").lower()
+    if up == "UID":
+        seq = tokens.pop(0)
+        return lambda m, msgs: _in_set(m.uid, seq, msgs[-1].uid if msgs else 0)
+    raise ValueError(f"unsupported search key {tok}")
+
+
+class FakeImapServer:
+    """Запускает сервер в фоне; письма добавляются через add_message()."""
+
+    class _Server(socketserver.ThreadingTCPServer):
+        daemon_threads = True
+        allow_reuse_address = True
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, rtt: float = 0.0,
+                 idle_supported: bool = True) -> None:
+        self.lock = threading.Lock()
+        self.new_mail = threading.Condition(self.lock)
+        self.messages: List[StoredMessage] = []
+        self.next_uid = 1
+        self.uidvalidity = UIDVALIDITY
+        self.rtt = rtt
+        self.idle_supported = idle_supported
+        self.commands: Counter = Counter()
+        self.logins = 0
+        self.fetched_messages = 0
+        self.bytes_sent = 0
+        self.arrivals: Dict[int, float] = {}
+        self._server = self._Server((host, port), _Handler)
+        self._server.owner = self
+        self.host, self.port = self._server.server_address[:2]
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    def start(self) -> "FakeImapServer":
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def snapshot(self) -> List[StoredMessage]:
+        with self.lock:
+            return list(self.messages)
+
+    def add_raw(self, raw: bytes, internaldate: Optional[float] = None) -> int:
+        with self.new_mail:
+            uid = self.next_uid
+            self.next_uid += 1
+            now = time.time()
+            self.messages.append(StoredMessage(uid, raw, internaldate or now))
+            self.arrivals[uid] = time.perf_counter()
+            self.new_mail.notify_all()
+        return uid
+
+    def reset_stats(self) -> None:
+        with self.lock:
+            self.commands.clear()
+            self.logins = 0
+            self.fetched_messages = 0
+            self.bytes_sent = 0
@@ -0,0 +1,243 @@
+"""
+Заглушка Telegram Bot API для бенчмарков.
+
+Отвечает на любой метод как настоящий Bot API (ok + правдоподобный result),
+запоминает каждый sendMessage/sendDocument с временем прихода и по желанию
+отвечает 429 с retry_after. Бот направляется сюда через TG_API_URL.
+
+Входящие апдейты: push_update() кладёт апдейт в очередь для getUpdates
+(long polling с offset/timeout), а WebhookClient шлёт те же апдейты POST-ом
+на вебхук бота — как это делает Telegram.
+"""
+
+import http.client
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, NamedTuple, Optional
+from urllib.parse import parse_qs, urlsplit
+
+
+class SentMessage(NamedTuple):
+    at: float  # time.perf_counter() в момент прихода запроса
+    method: str
+    chat_id: int
+    text: str
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Заголовки и тело уходят разными write — без этого ~40 мс на запрос
+    disable_nagle_algorithm = True
+    server: "FakeTelegramServer._Server"
+
+    def log_message(self, format: str, *args: Any) -> None:
+        pass
+
+    def do_GET(self) -> None:
+        self._handle()
+
+    def do_POST(self) -> None:
+        self._handle()
+
+    def _params(self) -> Dict[str, str]:
+        url = urlsplit(self.path)
+        params = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else b""
+        ctype = self.headers.get("Content-Type", "")
+        if body and ctype.startswith("application/x-www-form-urlencoded"):
+            params.update({k: v[-1] for k, v in parse_qs(body.decode()).items()})
+        elif body and ctype.startswith("application/json"):
+            params.update({k: str(v) for k, v in json.loads(body).items()})
+        elif body and ctype.startswith("multipart/form-data"):
+            # Для sendDocument достаточно chat_id и размера тела
+            marker = b'name="chat_id"\r\n\r\n'
+            idx = body.find(marker)
+            if idx >= 0:
+                params["chat_id"] = body[idx + len(marker):].split(b"\r\n", 1)[0].decode()
+            params.setdefault("caption", f"<{len(body)} bytes>")
+        return params
+
+    def _reply(self, status: int, payload: Dict[str, Any]) -> None:
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _handle(self) -> None:
+        srv = self.server.owner
+        method = self.path.split("?", 1)[0].rsplit("/", 1)[-1]
+        params = self._params()
+        if srv.latency:
+            time.sleep(srv.latency)
+
+        if method in ("sendMessage", "sendDocument") and srv.should_throttle():
+            self._reply(429, {
+                "ok": False,
+                "error_code": 429,
+                "description": "Too Many Requests: retry after 1",
+                "parameters": {"retry_after": srv.retry_after},
+            })
+            return
+
+        chat_id = int(params.get("chat_id") or 0)
+        result: Any = True
+        if method in ("sendMessage", "sendDocument"):
+            text = params.get("text") or params.get("caption") or ""
+            srv.record(SentMessage(time.perf_counter(), method, chat_id, text))
+            result = {
+                "message_id": srv.next_message_id(),
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private" if chat_id > 0 else "supergroup"},
+                "text": text,
+            }
+        elif method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+        elif method == "getUpdates":
+            result = srv.get_updates(int(params.get("offset") or 0), float(params.get("timeout") or 0))
+        elif method == "setWebhook":
+            srv.webhook = dict(params)
+        elif method == "deleteWebhook":
+            srv.webhook = None
+        self._reply(200, {"ok": True, "result": result})
+
+
+class FakeTelegramServer:
+    """Запускается в фоне; отправленные ботом сообщения копятся в .sent."""
+
+    class _Server(ThreadingHTTPServer):
+        daemon_threads = True
+        allow_reuse_address = True
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, latency: float = 0.0,
+                 throttle_every: int = 0, retry_after: int = 1) -> None:
+        self.lock = threading.Lock()
+        self.sent: List[SentMessage] = []
+        self.latency = latency
+        # Каждый N-й sendMessage получает 429 (0 — никогда)
+        self.throttle_every = throttle_every
+        self.retry_after = retry_after
+        self.throttled = 0
+        self._requests = 0
+        self._message_id = 0
+        # Очередь апдейтов для getUpdates и последний setWebhook
+        self.updates_cond = threading.Condition(self.lock)
+        self.updates: List[Dict[str, Any]] = []
+        self._update_id = 0
+        self.webhook: Optional[Dict[str, str]] = None
+        self._server = self._Server((host, port), _Handler)
+        self._server.owner = self
+        self.host, self.port = self._server.server_address[:2]
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def api_url(self) -> str:
+        return f"http://{self.host}:{self.port}/bot{{0}}/{{1}}"
+
+    def start(self) -> "FakeTelegramServer":
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        with self.lock:
+            # Будим висящие getUpdates, иначе shutdown ждёт их timeout
+            self.updates_cond.notify_all()
+        self._server.shutdown()
+        self._server.server_close()
+
+    def should_throttle(self) -> bool:
+        with self.lock:
+            self._requests += 1
+            if self.throttle_every and self._requests % self.throttle_every == 0:
+                self.throttled += 1
+                return True
+        return False
+
+    def next_message_id(self) -> int:
+        with self.lock:
+            self._message_id += 1
+            return self._message_id
+
+    def record(self, message: SentMessage) -> None:
+        with self.lock:
+            self.sent.append(message)
+
+    def snapshot(self, since: Optional[int] = None) -> List[SentMessage]:
+        with self.lock:
+            return list(self.sent[since or 0:])
+
+    def reset(self) -> None:
+        with self.lock:
+            self.sent.clear()
+            self.throttled = 0
+            self._requests = 0
+
+    def next_update_id(self) -> int:
+        with self.lock:
+            self._update_id += 1
+            return self._update_id
+
+    def push_update(self, update: Dict[str, Any]) -> None:
+        with self.lock:
+            self.updates.append(update)
+            self.updates_cond.notify_all()
+
+    def get_updates(self, offset: int, timeout: float) -> List[Dict[str, Any]]:
+        """getUpdates: подтверждает всё до offset и ждёт новые не дольше timeout."""
+        deadline = time.monotonic() + timeout
+        with self.lock:
+            self.updates = [u for u in self.updates if u["update_id"] >= offset]
+            while not self.updates:
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    break
+                self.updates_cond.wait(left)
+            return list(self.updates[:100])
+
+
+def make_message_update(update_id: int, chat_id: int, text: str) -> Dict[str, Any]:
+    """Апдейт с текстовым сообщением из личного чата."""
+    entities = []
+    if text.startswith("/"):
+        entities.append({"type": "bot_command", "offset": 0, "length": len(text.split()[0])})
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private", "username": f"user{chat_id}"},
+            "from": {"id": chat_id, "is_bot": False, "first_name": "bench"},
+            "text": text,
+            "entities": entities,
+        },
+    }
+
+
+class WebhookClient:
+    """Доставка апдейтов на вебхук бота по одному keep-alive соединению."""
+
+    def __init__(self, url: str, secret: Optional[str]) -> None:
+        parts = urlsplit(url)
+        self.path = parts.path or "/"
+        self.secret = secret
+        self._conn = http.client.HTTPConnection(parts.hostname, parts.port or 80, timeout=10)
+
+    def post(self, update: Dict[str, Any]) -> int:
+        """POST апдейта; возвращает HTTP-статус ответа."""
+        body = json.dumps(update).encode()
+        headers = {"Content-Type": "application/json"}
+        if self.secret is not None:
+            headers["X-Telegram-Bot-Api-Secret-Token"] = self.secret
+        self._conn.request("POST", self.path, body=body, headers=headers)
+        resp = self._conn.getresponse()
+        resp.read()
+        if resp.will_close:
+            self._conn.close()
+        return resp.status
+
+    def close(self) -> None:
+        self._conn.close()
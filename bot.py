@@ -1,16 +1,40 @@
 import os
+import io
+import sys
+import queue
 import re
 import time
 import threading
 import imaplib
+import select
+import ssl
+from collections import OrderedDict, deque
 import email
 import json
+import bisect
+import heapq
+import codecs
+import base64
+import binascii
+import quopri
+import atexit
+import hmac
+import secrets
+import sqlite3
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import partial
 from email.header import decode_header
+from email.message import Message
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from email.utils import parseaddr
+from urllib.parse import urlsplit
 from html import unescape
-from typing import Optional, Tuple, List, Dict, Set, Any
+from typing import Optional, Tuple, List, Dict, Set, FrozenSet, Any, Iterator, Callable, NamedTuple
 
 from dotenv import load_dotenv
 import telebot
+from telebot.apihelper import ApiTelegramException
 from telebot.types import (
     InlineKeyboardMarkup,
     InlineKeyboardButton,
@@ -37,11 +61,396 @@ WEBAPP_BASE_URL = os.getenv(
 ).rstrip("?")
 
 SETTINGS_FILE = os.getenv("SETTINGS_FILE", "chat_settings.json")
+# Журнал изменений настроек поверх снимка SETTINGS_FILE
+SETTINGS_JOURNAL_FILE = os.getenv("SETTINGS_JOURNAL_FILE", SETTINGS_FILE + ".log")
+# Изменения копятся столько секунд и пишутся в журнал одной пачкой
+SETTINGS_FLUSH_INTERVAL = float(os.getenv("SETTINGS_FLUSH_INTERVAL", "1"))
+# После скольких записей журнал сворачивается в новый снимок
+SETTINGS_COMPACT_EVERY = int(os.getenv("SETTINGS_COMPACT_EVERY", "1000"))
+# Чекпоинт вотчера: (UIDVALIDITY, последний UID) по каждому источнику
+WATCHER_STATE_FILE = os.getenv("WATCHER_STATE_FILE", "watcher_state.json")
+# Локальное хранилище уже разобранных писем (SQLite)
+MAIL_STORE_FILE = os.getenv("MAIL_STORE_FILE", "mail_store.sqlite3")
+# Кэш писем в памяти: предел по суммарному размеру текстов (байт)
+EMAIL_CACHE_BYTES = int(os.getenv("EMAIL_CACHE_BYTES", str(16 * 1024 * 1024)))
+# Сколько секунд живёт закэшированный список писем для /mails
+MAIL_LIST_TTL = int(os.getenv("MAIL_LIST_TTL", "30"))
+# Сколько байт текста письма качать для уведомления (0 — письмо целиком)
+NOTIFY_PREVIEW_BYTES = int(os.getenv("NOTIFY_PREVIEW_BYTES", "3000"))
+
+IMAP_HOST = os.getenv("IMAP_HOST", "imap.gmail.com")
+IMAP_PORT = int(os.getenv("IMAP_PORT", "993"))
+# IMAP поверх TLS (0 — без шифрования, только для локального тестового сервера)
+IMAP_SSL = os.getenv("IMAP_SSL", "1") != "0"
+# Сколько IMAP-сессий одновременно держим открытыми (Gmail режет после ~15)
+IMAP_POOL_SIZE = int(os.getenv("IMAP_POOL_SIZE", "3"))
+# Через сколько секунд простоя сессия закрывается
+IMAP_MAX_IDLE = int(os.getenv("IMAP_MAX_IDLE", "600"))
+# Через сколько секунд простоя перед выдачей сессии проверяем её NOOP-ом
+IMAP_NOOP_AFTER = int(os.getenv("IMAP_NOOP_AFTER", "30"))
+# Вотчер на IMAP IDLE вместо опроса (0 — только опрос)
+IMAP_USE_IDLE = os.getenv("IMAP_USE_IDLE", "1") != "0"
+# Через сколько секунд перевыставлять IDLE (сервер рвёт его через 29 минут)
+IMAP_IDLE_RENEW = int(os.getenv("IMAP_IDLE_RENEW", "600"))
+
+# Рассылка уведомлений: число потоков-отправителей и лимиты Telegram
+SEND_WORKERS = int(os.getenv("SEND_WORKERS", "8"))
+TG_GLOBAL_RATE = float(os.getenv("TG_GLOBAL_RATE", "30"))  # сообщений в секунду на бота
+TG_GROUP_RATE = float(os.getenv("TG_GROUP_RATE", "20"))  # сообщений в минуту в одну группу
+TG_PRIVATE_RATE = float(os.getenv("TG_PRIVATE_RATE", "1"))  # сообщений в секунду в личку
+TG_MAX_RETRIES = int(os.getenv("TG_MAX_RETRIES", "5"))
+# Сколько сообщений максимум на одно письмо; длиннее — первое сообщение и полный текст .txt-файлом
+TG_MAX_EMAIL_MESSAGES = int(os.getenv("TG_MAX_EMAIL_MESSAGES", "3"))
+# Потоков для IMAP-запросов кнопок /mails (больше IMAP_POOL_SIZE смысла нет)
+CALLBACK_WORKERS = int(os.getenv("CALLBACK_WORKERS", str(IMAP_POOL_SIZE)))
+# Потоков для ответов на кнопки /mails (отдельно от рассылки уведомлений)
+REPLY_WORKERS = int(os.getenv("REPLY_WORKERS", "4"))
+# Свой адрес Bot API (локальный telegram-bot-api или заглушка для бенчмарка),
+# формат telebot: http://host:port/bot{0}/{1}
+TG_API_URL = os.getenv("TG_API_URL")
+
+# Метрики в формате Prometheus на http://METRICS_HOST:METRICS_PORT/metrics (0 — выключено)
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+
+# Вебхук вместо long polling: публичный HTTPS-адрес, который отдаёт reverse proxy
+# (пусто — работаем через getUpdates)
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+# Где слушает встроенный HTTP-сервер (за proxy — локальный адрес)
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "127.0.0.1")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+# Путь, на который proxy пересылает апдейты (по умолчанию — путь из WEBHOOK_URL)
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH") or urlsplit(WEBHOOK_URL).path or "/"
+# Секрет для заголовка X-Telegram-Bot-Api-Secret-Token (пусто — случайный на каждый запуск)
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or secrets.token_urlsafe(32)
+# Потоков обработки апдейтов и сколько апдейтов может ждать в очередях
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "8"))
+WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", "1000"))
+# Сколько одновременных соединений разрешить Telegram (1-100)
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
+
+# Трассировка доставки: сколько последних доставок держать в памяти для /lag
+# и необязательный JSON-лог (по строке на доставку)
+TRACE_BUFFER_SIZE = int(os.getenv("TRACE_BUFFER_SIZE", "10000"))
+TRACE_LOG_FILE = os.getenv("TRACE_LOG_FILE", "")
+# Telegram user id админов через запятую (для /lag)
+ADMIN_IDS: Set[int] = {int(x) for x in os.getenv("ADMIN_IDS", "").replace(" ", "").split(",") if x}
+
+# Постоянная очередь уведомлений (переживает падения и перезапуски)
+OUTBOX_FILE = os.getenv("OUTBOX_FILE", "outbox.sqlite3")
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "8"))
+OUTBOX_RETRY_BASE = float(os.getenv("OUTBOX_RETRY_BASE", "5"))  # секунд до первого повтора
+OUTBOX_RETRY_MAX = float(os.getenv("OUTBOX_RETRY_MAX", "600"))
+
+# Дайджест: письма, пришедшие в чат за окно склейки, уходят одним сообщением.
+# Окна в секундах, кнопка в /settings переключает их по кругу (0 — дайджест выключен)
+DIGEST_WINDOWS = sorted({0} | {int(x) for x in os.getenv("DIGEST_WINDOWS", "0,30,60,300").replace(" ", "").split(",") if x})
+# Сколько писем максимум в одном сообщении-дайджесте
+DIGEST_MAX_ITEMS = int(os.getenv("DIGEST_MAX_ITEMS", "20"))
 
 if not BOT_TOKEN or not GMAIL_USER or not GMAIL_APP_PASSWORD:
     raise RuntimeError("Не заданы BOT_TOKEN / GMAIL_USER / GMAIL_APP_PASSWORD в .env")
 
 bot = telebot.TeleBot(BOT_TOKEN, parse_mode="HTML")
+if TG_API_URL:
+    telebot.apihelper.API_URL = TG_API_URL
+
+# ======================= МЕТРИКИ =======================
+
+# Границы корзин гистограмм по умолчанию, секунды
+DEFAULT_BUCKETS: Tuple[float, ...] = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+LabelValues = Tuple[str, ...]
+
+
+class Metric:
+    """Базовая метрика в формате Prometheus: имя, описание, имена меток."""
+
+    kind = "untyped"
+
+    def __init__(self, name: str, help_text: str, labels: Tuple[str, ...] = ()) -> None:
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self._lock = threading.Lock()
+        METRICS.append(self)
+
+    def _key(self, labels: Dict[str, str]) -> LabelValues:
+        return tuple(str(labels.get(name, "")) for name in self.labels)
+
+    def _fmt_labels(self, values: LabelValues, extra: str = "") -> str:
+        pairs = [
+            f'{name}="{value}"'
+            for name, value in zip(self.labels, values)
+        ]
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    def samples(self) -> List[str]:
+        return []
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self.samples())
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help_text: str, labels: Tuple[str, ...] = ()) -> None:
+        super().__init__(name, help_text, labels)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            items = list(self._values.items())
+        return [f"{self.name}{self._fmt_labels(key)} {value}" for key, value in items]
+
+
+class CallbackMetric(Metric):
+    """Значение считается в момент запроса /metrics (глубина очереди, счётчики кэша)."""
+
+    def __init__(self, name: str, help_text: str, kind: str, func: Callable[[], float]) -> None:
+        super().__init__(name, help_text)
+        self.kind = kind
+        self.func = func
+
+    def samples(self) -> List[str]:
+        try:
+            return [f"{self.name} {self.func()}"]
+        except Exception as e:
+            print(f"[metrics] {self.name} error:", e)
+            return []
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help_text: str,
+        labels: Tuple[str, ...] = (),
+        buckets: Tuple[float, ...] = DEFAULT_BUCKETS,
+    ) -> None:
+        super().__init__(name, help_text, labels)
+        self.buckets = buckets
+        # метки -> [счётчики по корзинам..., сумма, количество]
+        self._values: Dict[LabelValues, List[float]] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        idx = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            row = self._values.get(key)
+            if row is None:
+                row = self._values[key] = [0.0] * (len(self.buckets) + 2)
+            if idx < len(self.buckets):
+                row[idx] += 1
+            row[-2] += value
+            row[-1] += 1
+
+    @contextmanager
+    def time(self, **labels: str) -> Iterator[None]:
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            items = [(key, list(row)) for key, row in self._values.items()]
+        lines = []
+        for key, row in items:
+            cumulative = 0.0
+            for bound, count in zip(self.buckets, row):
+                cumulative += count
+                le = self._fmt_labels(key, 'le="%s"' % bound)
+                lines.append(f"{self.name}_bucket{le} {cumulative}")
+            le = self._fmt_labels(key, 'le="+Inf"')
+            lines.append(f"{self.name}_bucket{le} {row[-1]}")
+            lines.append(f"{self.name}_sum{self._fmt_labels(key)} {row[-2]}")
+            lines.append(f"{self.name}_count{self._fmt_labels(key)} {row[-1]}")
+        return lines
+
+
+METRICS: List[Metric] = []
+
+IMAP_LOGIN_SECONDS = Histogram("bot_imap_login_seconds", "IMAP connect + LOGIN time")
+IMAP_COMMAND_SECONDS = Histogram("bot_imap_command_seconds", "IMAP command round trip time", ("command",))
+IMAP_BROKEN_SESSIONS = Counter("bot_imap_broken_sessions_total", "IMAP sessions closed after an error")
+WATCHER_TICK_SECONDS = Histogram("bot_watcher_tick_seconds", "Duration of one check_new_mail() run")
+WATCHER_ERRORS = Counter("bot_watcher_errors_total", "check_new_mail() runs that failed")
+NEW_EMAILS = Counter("bot_new_emails_total", "New emails detected by the watcher", ("source",))
+TG_SEND_SECONDS = Histogram("bot_tg_send_seconds", "sendMessage request time")
+TG_SEND_ERRORS = Counter("bot_tg_send_errors_total", "Failed sendMessage requests (429 included)", ("code",))
+CALLBACK_FETCHES_MERGED = Counter(
+    "bot_callback_fetches_merged_total", "Button taps served by an IMAP fetch already in flight", ("kind",)
+)
+
+
+def render_metrics() -> str:
+    """Все метрики в текстовом формате Prometheus."""
+    return "\n".join(metric.render() for metric in METRICS) + "\n"
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self) -> None:
+        if self.path.split("?", 1)[0] != "/metrics":
+            self.send_error(404)
+            return
+        data = render_metrics().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format: str, *args: Any) -> None:
+        # Prometheus ходит каждые 15 секунд — не засоряем вывод
+        pass
+
+
+def start_metrics_server(host: str = METRICS_HOST, port: int = METRICS_PORT) -> Optional[ThreadingHTTPServer]:
+    """HTTP-сервер с /metrics в фоновом потоке (port 0 — выключено)."""
+    if not port:
+        return None
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    print(f"[metrics] http://{host}:{port}/metrics")
+    return server
+
+
+# ======================= ТРАССИРОВКА ДОСТАВКИ =======================
+
+DELIVERY_LAG_SECONDS = Histogram(
+    "bot_delivery_lag_seconds",
+    "Time from email INTERNALDATE to sendMessage completion",
+    buckets=(0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0, 1800.0),
+)
+
+
+class EmailTrace:
+    """Отметки времени (time.time()) по одному письму: от прихода в ящик до рендера."""
+
+    __slots__ = ("source", "uid", "internaldate", "detected", "parsed", "rendered")
+
+    def __init__(self, source: str, uid: str, internaldate: Optional[float], detected: float) -> None:
+        self.source = source
+        self.uid = uid
+        self.internaldate = internaldate
+        self.detected = detected
+        self.parsed: Optional[float] = None
+        self.rendered: Optional[float] = None
+
+
+class DeliveryTrace(NamedTuple):
+    """Доставка письма в один чат — одна запись кольцевого буфера и JSON-лога."""
+
+    source: str
+    uid: str
+    chat_id: int
+    internaldate: Optional[float]
+    detected: float
+    parsed: Optional[float]
+    rendered: Optional[float]
+    sent: float
+    attempts: int
+
+
+class DeliveryTracer:
+    """
+    Последние TRACE_BUFFER_SIZE доставок в памяти (для /lag) и, если задан
+    TRACE_LOG_FILE, построчный JSON-лог тех же записей.
+    """
+
+    def __init__(self, size: int, log_file: str) -> None:
+        self._lock = threading.Lock()
+        self._records: "deque[DeliveryTrace]" = deque(maxlen=size)
+        self.log_file = log_file
+        self._log: Optional[Any] = None
+
+    def record(self, trace: EmailTrace, chat_id: int, attempts: int) -> None:
+        rec = DeliveryTrace(
+            trace.source,
+            trace.uid,
+            chat_id,
+            trace.internaldate,
+            trace.detected,
+            trace.parsed,
+            trace.rendered,
+            time.time(),
+            attempts,
+        )
+        if rec.internaldate is not None:
+            DELIVERY_LAG_SECONDS.observe(max(0.0, rec.sent - rec.internaldate))
+
+        with self._lock:
+            self._records.append(rec)
+            if not self.log_file:
+                return
+            try:
+                if self._log is None:
+                    self._log = open(self.log_file, "a", encoding="utf-8")
+                self._log.write(json.dumps(rec._asdict()) + "\n")
+                self._log.flush()
+            except OSError as e:
+                print("trace log error:", e)
+
+    def recent(self, seconds: float) -> List[DeliveryTrace]:
+        """Доставки за последние seconds секунд."""
+        since = time.time() - seconds
+        with self._lock:
+            return [rec for rec in self._records if rec.sent >= since]
+
+
+tracer = DeliveryTracer(TRACE_BUFFER_SIZE, TRACE_LOG_FILE)
+
+
+def percentile(values: List[float], pct: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    idx = min(len(ordered) - 1, max(0, int(round(pct / 100 * (len(ordered) - 1)))))
+    return ordered[idx]
+
+
+def build_lag_text(minutes: int) -> str:
+    """Текст для /lag: задержки доставки по этапам за последние minutes минут."""
+    records = tracer.recent(minutes * 60)
+    if not records:
+        return f"📉 За последние {minutes} мин. доставок не было."
+
+    def stage(name: str, values: List[float]) -> str:
+        p50, p95 = percentile(values, 50), percentile(values, 95)
+        if p50 is None or p95 is None:
+            return f"{name}: нет данных"
+        return f"{name}: p50 <b>{p50:.2f}</b> с, p95 <b>{p95:.2f}</b> с"
+
+    with_date = [r for r in records if r.internaldate is not None]
+    lines = [
+        f"📈 <b>Задержка доставки за {minutes} мин.</b>",
+        f"Доставок: <b>{len(records)}</b>, писем: <b>{len({(r.source, r.uid) for r in records})}</b>\n",
+        stage("Всего (приход → отправка)", [r.sent - r.internaldate for r in with_date]),
+        stage("Приход → вотчер", [r.detected - r.internaldate for r in with_date]),
+        stage("Вотчер → письмо скачано", [r.parsed - r.detected for r in records if r.parsed]),
+        stage("Скачано → собрано", [r.rendered - r.parsed for r in records if r.rendered and r.parsed]),
+        stage("Собрано → отправлено", [r.sent - r.rendered for r in records if r.rendered]),
+    ]
+    retried = sum(1 for r in records if r.attempts)
+    if retried:
+        lines.append(f"\nС повторами: <b>{retried}</b>")
+    return "\n".join(lines)
+
 
 # ======================= ИСТОЧНИКИ =======================
 
@@ -59,142 +468,346 @@ SOURCE_META: Dict[str, Dict[str, str]] = {
 
 SOURCE_ORDER: List[str] = ["kwork", "workzilla", "freelancejob"]
 
+# Адрес отправителя -> источник (для разбора общего поиска вотчера)
+SENDER_TO_SOURCE: Dict[str, str] = {addr.lower(): src for src, addr in SOURCES.items()}
+
 # Последний UID по каждому источнику (для вотчера)
 last_uids: Dict[str, Optional[int]] = {src: None for src in SOURCES}
+# UIDVALIDITY ящика, к которой относятся last_uids
+mailbox_uidvalidity: Optional[int] = None
 
 # ======================= СОСТОЯНИЕ ЧАТОВ =======================
 
-chat_ids: Set[int] = set()
-chat_ids_lock = threading.Lock()
+# Бит каждого источника в ChatRecord.sources_mask
+SOURCE_BITS: Dict[str, int] = {src: 1 << idx for idx, src in enumerate(SOURCES)}
+ALL_SOURCES_MASK = sum(SOURCE_BITS.values())
+
+
+def sources_to_mask(sources: List[str]) -> int:
+    mask = 0
+    for src in sources:
+        mask |= SOURCE_BITS.get(src, 0)
+    return mask
+
+
+def mask_to_sources(mask: int) -> List[str]:
+    return [src for src, bit in SOURCE_BITS.items() if mask & bit]
+
+
+class ChatRecord:
+    """
+    Настройки одного чата. Запись не меняется после создания: любое изменение
+    кладёт в реестр новую, поэтому читать можно без блокировок.
+    """
+
+    __slots__ = ("sources_mask", "notifications", "title", "type", "digest")
+
+    def __init__(
+        self, sources_mask: int, notifications: bool, title: str, chat_type: str, digest: int = 0
+    ) -> None:
+        self.sources_mask = sources_mask
+        self.notifications = notifications
+        # Окно склейки уведомлений в дайджест, сек (0 — каждое письмо отдельно)
+        self.digest = digest
+        # Названия и типы повторяются у тысяч чатов — храним по одной копии строки
+        self.title = sys.intern(title)
+        self.type = sys.intern(chat_type)
+
+    @property
+    def sources(self) -> List[str]:
+        return mask_to_sources(self.sources_mask)
+
+    def has_source(self, source: str) -> bool:
+        return bool(self.sources_mask & SOURCE_BITS.get(source, 0))
+
+    def replace(self, **changes: Any) -> "ChatRecord":
+        return ChatRecord(
+            changes.get("sources_mask", self.sources_mask),
+            changes.get("notifications", self.notifications),
+            changes.get("title", self.title),
+            changes.get("chat_type", self.type),
+            changes.get("digest", self.digest),
+        )
+
+
+DEFAULT_CHAT = ChatRecord(ALL_SOURCES_MASK, True, "", "")
+
 
-chat_settings: Dict[int, Dict[str, Any]] = {}
-chat_settings_lock = threading.Lock()
+class ChatRegistry:
+    """
+    Реестр чатов: chat_id -> ChatRecord плюс обратный индекс подписок
+    (источник -> frozenset чатов, куда слать его письма).
+
+    Пишут под одной блокировкой, читают без неё: записи неизменяемые,
+    а словарь индекса подменяется целиком (copy-on-write).
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._records: Dict[int, ChatRecord] = {}
+        self._subscribers: Dict[str, FrozenSet[int]] = {src: frozenset() for src in SOURCES}
+        self._subscribed = 0
+
+    def get(self, chat_id: int) -> Optional[ChatRecord]:
+        return self._records.get(chat_id)
+
+    def __len__(self) -> int:
+        return len(self._records)
+
+    def subscribers(self, source: str) -> FrozenSet[int]:
+        """Чаты с включёнными уведомлениями и этим источником."""
+        return self._subscribers.get(source, frozenset())
+
+    def subscribed_count(self) -> int:
+        """Сколько чатов с включёнными уведомлениями."""
+        return self._subscribed
+
+    def snapshot(self) -> List[Tuple[int, ChatRecord]]:
+        with self._lock:
+            return list(self._records.items())
+
+    def update(
+        self, chat_id: int, change: Callable[[Optional[ChatRecord]], ChatRecord]
+    ) -> Tuple[Optional[ChatRecord], ChatRecord]:
+        """Атомарно заменить запись чата на change(старая). Возвращает (старая, новая)."""
+        with self._lock:
+            old = self._records.get(chat_id)
+            new = change(old)
+            if new is old:
+                return old, new
+            self._records[chat_id] = new
+
+            old_mask = old.sources_mask if old is not None and old.notifications else 0
+            new_mask = new.sources_mask if new.notifications else 0
+            if old_mask != new_mask:
+                subscribers = dict(self._subscribers)
+                for src, bit in SOURCE_BITS.items():
+                    if new_mask & bit and not old_mask & bit:
+                        subscribers[src] = subscribers[src] | {chat_id}
+                    elif old_mask & bit and not new_mask & bit:
+                        subscribers[src] = subscribers[src] - {chat_id}
+                self._subscribers = subscribers
+
+            self._subscribed += int(new.notifications) - int(old is not None and old.notifications)
+            return old, new
+
+    def replace_all(self, records: Dict[int, ChatRecord]) -> None:
+        """Подменить весь реестр (загрузка с диска) и пересобрать индекс."""
+        index: Dict[str, Set[int]] = {src: set() for src in SOURCES}
+        subscribed = 0
+        for chat_id, rec in records.items():
+            if not rec.notifications:
+                continue
+            subscribed += 1
+            for src, bit in SOURCE_BITS.items():
+                if rec.sources_mask & bit:
+                    index[src].add(chat_id)
+
+        with self._lock:
+            self._records = records
+            self._subscribers = {src: frozenset(ids) for src, ids in index.items()}
+            self._subscribed = subscribed
+
+
+chat_registry = ChatRegistry()
+
+# Чаты, изменения которых ещё не записаны в журнал
+dirty_chats: Set[int] = set()
+dirty_chats_lock = threading.Lock()
+settings_flush_event = threading.Event()
+# Запись журнала и снимка — по одному потоку за раз
+settings_io_lock = threading.Lock()
+settings_journal_records = 0
 
 
 # ======================= РАБОТА С НАСТРОЙКАМИ ЧАТОВ =======================
 
-def load_chat_settings() -> None:
-    """Загрузка настроек чатов из JSON-файла."""
-    global chat_settings, chat_ids
-    if not os.path.exists(SETTINGS_FILE):
-        print("[settings] файла настроек нет, старт с нуля")
-        return
+def parse_chat_config(cfg: Dict[str, Any]) -> ChatRecord:
+    """Конфиг чата из JSON (снимка или журнала) с дефолтами."""
+    sources = cfg.get("sources")
+    if not isinstance(sources, list):
+        sources = list(SOURCES.keys())
 
     try:
-        with open(SETTINGS_FILE, "r", encoding="utf-8") as f:
-            raw = json.load(f)
-    except Exception as e:
-        print("load_chat_settings error:", e)
-        return
+        digest = max(0, int(cfg.get("digest") or 0))
+    except (TypeError, ValueError):
+        digest = 0
+
+    return ChatRecord(
+        sources_to_mask(sources),
+        bool(cfg.get("notifications", True)),
+        cfg.get("title") or "",
+        cfg.get("type") or "",
+        digest,
+    )
 
-    loaded: Dict[int, Dict[str, Any]] = {}
 
-    for chat_id_str, cfg in raw.items():
-        try:
-            chat_id = int(chat_id_str)
-        except ValueError:
-            continue
+def dump_chat_config(rec: ChatRecord) -> Dict[str, Any]:
+    """Конфиг чата для записи в JSON."""
+    return {
+        "sources": rec.sources,
+        "notifications": rec.notifications,
+        "title": rec.title,
+        "type": rec.type,
+        "digest": rec.digest,
+    }
 
-        sources = cfg.get("sources")
-        if not isinstance(sources, list):
-            sources = list(SOURCES.keys())
 
-        notifications = bool(cfg.get("notifications", True))
-        title = cfg.get("title") or ""
-        chat_type = cfg.get("type") or ""
+def load_chat_settings() -> None:
+    """Загрузка настроек чатов: снимок из JSON-файла + журнал изменений поверх него."""
+    global settings_journal_records
+    loaded: Dict[int, ChatRecord] = {}
 
-        loaded[chat_id] = {
-            "sources": [s for s in sources if s in SOURCES],
-            "notifications": notifications,
-            "title": title,
-            "type": chat_type,
-        }
+    if os.path.exists(SETTINGS_FILE):
+        try:
+            with open(SETTINGS_FILE, "r", encoding="utf-8") as f:
+                raw = json.load(f)
+        except Exception as e:
+            print("load_chat_settings error:", e)
+            return
 
-    with chat_settings_lock:
-        chat_settings = loaded
+        for chat_id_str, cfg in raw.items():
+            try:
+                chat_id = int(chat_id_str)
+            except ValueError:
+                continue
+            loaded[chat_id] = parse_chat_config(cfg)
+    else:
+        print("[settings] файла настроек нет, старт с нуля")
+
+    # Журнал: по строке JSON на изменение, каждая строка — полный конфиг чата
+    records = 0
+    if os.path.exists(SETTINGS_JOURNAL_FILE):
+        with open(SETTINGS_JOURNAL_FILE, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                    loaded[int(record["id"])] = parse_chat_config(record)
+                except (ValueError, KeyError, TypeError):
+                    # Недописанная строка после падения — пропускаем
+                    continue
+                records += 1
+
+    chat_registry.replace_all(loaded)
 
-    with chat_ids_lock:
-        chat_ids = {cid for cid, cfg in loaded.items() if cfg.get("notifications", True)}
+    settings_journal_records = records
+    if records >= SETTINGS_COMPACT_EVERY:
+        save_chat_settings()
 
-    print(f"[settings] loaded {len(chat_settings)} chats from {SETTINGS_FILE}")
-    print(f"[settings] chats with notifications ON: {chat_ids}")
+    print(f"[settings] loaded {len(chat_registry)} chats from {SETTINGS_FILE} (+{records} journal records)")
+    print(f"[settings] chats with notifications ON: {chat_registry.subscribed_count()}")
 
 
 def save_chat_settings() -> None:
-    """Сохранение настроек чатов в JSON-файл."""
+    """
+    Полный снимок настроек чатов в JSON-файл (он же сворачивание журнала).
+    Обычные изменения пишутся в журнал через mark_chat_dirty().
+    """
+    global settings_journal_records
     try:
-        with chat_settings_lock:
-            to_save: Dict[str, Any] = {}
-            for chat_id, cfg in chat_settings.items():
-                to_save[str(chat_id)] = {
-                    "sources": [
-                        s for s in cfg.get("sources", list(SOURCES.keys()))
-                        if s in SOURCES
-                    ],
-                    "notifications": bool(cfg.get("notifications", True)),
-                    "title": cfg.get("title", ""),
-                    "type": cfg.get("type", ""),
-                }
-
-        tmp_file = SETTINGS_FILE + ".tmp"
-        with open(tmp_file, "w", encoding="utf-8") as f:
-            json.dump(to_save, f, ensure_ascii=False, indent=2)
-        os.replace(tmp_file, SETTINGS_FILE)
+        with settings_io_lock:
+            to_save: Dict[str, Any] = {
+                str(chat_id): dump_chat_config(rec)
+                for chat_id, rec in chat_registry.snapshot()
+            }
+
+            tmp_file = SETTINGS_FILE + ".tmp"
+            with open(tmp_file, "w", encoding="utf-8") as f:
+                json.dump(to_save, f, ensure_ascii=False, separators=(",", ":"))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_file, SETTINGS_FILE)
+
+            # Всё из журнала уже есть в снимке
+            open(SETTINGS_JOURNAL_FILE, "w", encoding="utf-8").close()
+            settings_journal_records = 0
         print(f"[settings] saved to {SETTINGS_FILE}")
     except Exception as e:
         print("save_chat_settings error:", e)
 
 
+def flush_chat_settings() -> None:
+    """Дописать в журнал все накопившиеся изменения одной записью."""
+    global settings_journal_records
+    with dirty_chats_lock:
+        pending = list(dirty_chats)
+        dirty_chats.clear()
+    if not pending:
+        return
+
+    try:
+        with settings_io_lock:
+            lines = []
+            for chat_id in pending:
+                rec = chat_registry.get(chat_id)
+                if rec is not None:
+                    lines.append(json.dumps({"id": chat_id, **dump_chat_config(rec)}, ensure_ascii=False))
+            with open(SETTINGS_JOURNAL_FILE, "a", encoding="utf-8") as f:
+                f.write("".join(line + "\n" for line in lines))
+                f.flush()
+                os.fsync(f.fileno())
+            settings_journal_records += len(lines)
+            need_compact = settings_journal_records >= SETTINGS_COMPACT_EVERY
+    except Exception as e:
+        print("flush_chat_settings error:", e)
+        # Не потеряем изменения: попробуем при следующем сбросе
+        with dirty_chats_lock:
+            dirty_chats.update(pending)
+        return
+
+    print(f"[settings] journal +{len(lines)} chats")
+    if need_compact:
+        save_chat_settings()
+
+
+def settings_flush_loop() -> None:
+    """Фоновый поток: сбрасывает изменения настроек не чаще раза в SETTINGS_FLUSH_INTERVAL."""
+    while True:
+        settings_flush_event.wait()
+        # Даём накопиться пачке изменений (нажатия кнопок идут сериями)
+        time.sleep(SETTINGS_FLUSH_INTERVAL)
+        settings_flush_event.clear()
+        flush_chat_settings()
+
+
+settings_flush_thread = threading.Thread(target=settings_flush_loop, name="settings-flush", daemon=True)
+atexit.register(flush_chat_settings)
+
+
+def mark_chat_dirty(chat_id: int) -> None:
+    """Запланировать запись настроек чата в журнал."""
+    with dirty_chats_lock:
+        dirty_chats.add(chat_id)
+        if not settings_flush_thread.is_alive():
+            settings_flush_thread.start()
+    settings_flush_event.set()
+
+
 def ensure_chat_config(chat_id: int, title: str = "", chat_type: str = "") -> None:
     """Убедиться, что для чата есть конфиг. Если нет — создать с дефолтами."""
-    created = False
-    with chat_settings_lock:
-        cfg = chat_settings.get(chat_id)
-        if cfg is None:
-            cfg = {
-                "sources": list(SOURCES.keys()),
-                "notifications": True,
-                "title": title,
-                "type": chat_type,
-            }
-            chat_settings[chat_id] = cfg
-            created = True
-        else:
-            if title and not cfg.get("title"):
-                cfg["title"] = title
-            if chat_type and not cfg.get("type"):
-                cfg["type"] = chat_type
-
-    if created:
-        with chat_ids_lock:
-            chat_ids.add(chat_id)
+
+    def change(old: Optional[ChatRecord]) -> ChatRecord:
+        if old is None:
+            return ChatRecord(ALL_SOURCES_MASK, True, title, chat_type)
+        if (title and not old.title) or (chat_type and not old.type):
+            return old.replace(title=old.title or title, chat_type=old.type or chat_type)
+        return old
+
+    old, new = chat_registry.update(chat_id, change)
+    if old is None:
         print(f"[settings] new chat registered: {chat_id}")
-        save_chat_settings()
+    if new is not old:
+        mark_chat_dirty(chat_id)
 
 
 def set_chat_notifications(chat_id: int, enabled: bool) -> None:
     """Включить/выключить уведомления в чате."""
-    with chat_settings_lock:
-        cfg = chat_settings.get(chat_id)
-        if cfg is None:
-            cfg = {
-                "sources": list(SOURCES.keys()),
-                "notifications": enabled,
-                "title": "",
-                "type": "",
-            }
-            chat_settings[chat_id] = cfg
-        else:
-            cfg["notifications"] = enabled
-
-    with chat_ids_lock:
-        if enabled:
-            chat_ids.add(chat_id)
-        else:
-            chat_ids.discard(chat_id)
-
+    chat_registry.update(
+        chat_id,
+        lambda old: (old or DEFAULT_CHAT).replace(notifications=enabled),
+    )
     print(f"[settings] chat {chat_id} notifications -> {enabled}")
-    save_chat_settings()
+    mark_chat_dirty(chat_id)
 
 
 def toggle_chat_source(chat_id: int, source: str) -> bool:
@@ -205,55 +818,55 @@ def toggle_chat_source(chat_id: int, source: str) -> bool:
     if source not in SOURCES:
         return False
 
-    with chat_settings_lock:
-        cfg = chat_settings.get(chat_id)
-        if cfg is None:
-            cfg = {
-                "sources": list(SOURCES.keys()),
-                "notifications": True,
-                "title": "",
-                "type": "",
-            }
-            chat_settings[chat_id] = cfg
-
-        sources: List[str] = cfg.get("sources", list(SOURCES.keys()))
-        if source in sources:
-            sources.remove(source)
-            enabled = False
-        else:
-            sources.append(source)
-            enabled = True
-        cfg["sources"] = [s for s in sources if s in SOURCES]
+    bit = SOURCE_BITS[source]
+    _, new = chat_registry.update(
+        chat_id,
+        lambda old: (old or DEFAULT_CHAT).replace(sources_mask=(old or DEFAULT_CHAT).sources_mask ^ bit),
+    )
+    enabled = new.has_source(source)
 
-    save_chat_settings()
+    mark_chat_dirty(chat_id)
     print(f"[settings] chat {chat_id} source {source} -> {enabled}")
     return enabled
 
 
-def get_chat_config(chat_id: int) -> Dict[str, Any]:
-    """Получить конфиг чата (с дефолтами)."""
-    with chat_settings_lock:
-        cfg = chat_settings.get(chat_id)
-        if cfg is None:
-            cfg = {
-                "sources": list(SOURCES.keys()),
-                "notifications": True,
-                "title": "",
-                "type": "",
-            }
-            chat_settings[chat_id] = cfg
-    return cfg
+def cycle_chat_digest(chat_id: int) -> int:
+    """Следующее окно дайджеста из DIGEST_WINDOWS (по кругу). Возвращает новое окно, сек."""
+
+    def change(old: Optional[ChatRecord]) -> ChatRecord:
+        rec = old or DEFAULT_CHAT
+        later = [w for w in DIGEST_WINDOWS if w > rec.digest]
+        return rec.replace(digest=later[0] if later else DIGEST_WINDOWS[0])
+
+    _, new = chat_registry.update(chat_id, change)
+    mark_chat_dirty(chat_id)
+    print(f"[settings] chat {chat_id} digest -> {new.digest}s")
+    return new.digest
+
+
+def format_digest_window(seconds: int) -> str:
+    """Окно дайджеста для людей: «ВЫКЛ», «30 сек», «5 мин»."""
+    if seconds <= 0:
+        return "ВЫКЛ"
+    if seconds % 60 == 0:
+        return f"{seconds // 60} мин"
+    return f"{seconds} сек"
+
+
+def get_chat_config(chat_id: int) -> ChatRecord:
+    """Получить конфиг чата (с дефолтами). Без блокировок."""
+    return chat_registry.get(chat_id) or DEFAULT_CHAT
 
 
 def build_settings_text(chat_id: int) -> str:
     """Текст настроек чата для /settings."""
     cfg = get_chat_config(chat_id)
-    enabled_sources = set(cfg.get("sources", list(SOURCES.keys())))
-    notif = bool(cfg.get("notifications", True))
+    notif = cfg.notifications
 
     lines: List[str] = [
         "⚙️ <b>Настройки этого чата</b>\n",
-        f"🔔 Уведомления: <b>{'ВКЛ' if notif else 'ВЫКЛ'}</b>\n",
+        f"🔔 Уведомления: <b>{'ВКЛ' if notif else 'ВЫКЛ'}</b>",
+        f"🗂 Дайджест: <b>{format_digest_window(cfg.digest)}</b>\n",
         "<b>Источники:</b>",
     ]
 
@@ -261,13 +874,17 @@ def build_settings_text(chat_id: int) -> str:
         meta = SOURCE_META[src]
         icon = meta["icon"]
         name = meta["name"]
-        mark = "✅" if src in enabled_sources else "❌"
+        mark = "✅" if cfg.has_source(src) else "❌"
         lines.append(f"{mark} {icon} {name}")
 
     lines.append(
         "\nНажимай на кнопки ниже, чтобы включать/выключать источники "
         "и общие уведомления для этого чата."
     )
+    lines.append(
+        "В режиме дайджеста письма, пришедшие одно за другим в пределах окна, "
+        "приходят одним сообщением — по строке на письмо."
+    )
 
     return "\n".join(lines)
 
@@ -275,8 +892,7 @@ def build_settings_text(chat_id: int) -> str:
 def build_status_text(chat_id: int) -> str:
     """Текст статуса мониторинга для /status."""
     cfg = get_chat_config(chat_id)
-    enabled_sources = set(cfg.get("sources", list(SOURCES.keys())))
-    notif = bool(cfg.get("notifications", True))
+    notif = cfg.notifications
 
     lines: List[str] = [
         "📡 <b>Статус мониторинга почты</b>\n",
@@ -285,9 +901,9 @@ def build_status_text(chat_id: int) -> str:
         "<b>Активные источники:</b>",
     ]
 
-    if enabled_sources:
+    if cfg.sources_mask:
         for src in SOURCE_ORDER:
-            if src not in enabled_sources:
+            if not cfg.has_source(src):
                 continue
             meta = SOURCE_META[src]
             icon = meta["icon"]
@@ -297,9 +913,7 @@ def build_status_text(chat_id: int) -> str:
     else:
         lines.append("• ❌ Нет включённых источников")
 
-    with chat_ids_lock:
-        subs = list(chat_ids)
-    lines.append(f"\n🧩 Подписанных чатов всего: <b>{len(subs)}</b>")
+    lines.append(f"\n🧩 Подписанных чатов всего: <b>{chat_registry.subscribed_count()}</b>")
 
     lines.append(
         "\n✅ Всё включено. Как только на этот Gmail придёт новое письмо с одного из источников — "
@@ -312,8 +926,7 @@ def build_status_text(chat_id: int) -> str:
 def make_settings_keyboard(chat_id: int) -> InlineKeyboardMarkup:
     """Инлайн-клавиатура с настройками для /settings."""
     cfg = get_chat_config(chat_id)
-    enabled_sources = set(cfg.get("sources", list(SOURCES.keys())))
-    notif = bool(cfg.get("notifications", True))
+    notif = cfg.notifications
 
     kb = InlineKeyboardMarkup(row_width=1)
 
@@ -322,7 +935,7 @@ def make_settings_keyboard(chat_id: int) -> InlineKeyboardMarkup:
         meta = SOURCE_META[src]
         icon = meta["icon"]
         name = meta["name"]
-        mark = "✅" if src in enabled_sources else "❌"
+        mark = "✅" if cfg.has_source(src) else "❌"
         kb.add(
             InlineKeyboardButton(
                 text=f"{mark} {icon} {name}",
@@ -339,6 +952,14 @@ def make_settings_keyboard(chat_id: int) -> InlineKeyboardMarkup:
         )
     )
 
+    # Окно дайджеста
+    kb.add(
+        InlineKeyboardButton(
+            text=f"🗂 Дайджест: {format_digest_window(cfg.digest)}",
+            callback_data="cfg:digest",
+        )
+    )
+
     return kb
 
 
@@ -361,27 +982,51 @@ def decode_mime_header(raw_header: Optional[str]) -> str:
     return header
 
 
-def html_to_text(html: str) -> str:
-    """Конвертация HTML в текст."""
-    html = re.sub(r"(?is)<(script|style).*?>.*?(</\1>)", "", html)
+# Один токенизатор на весь HTML: script/style целиком, комментарии, теги.
+# "<" без буквы, "/", "!" или "?" следом — это просто текст ("1 < 2").
+_HTML_TOKEN_RE = re.compile(
+    r"<(?:(script|style)\b[^>]*>.*?</\1\s*"
+    r"|!--.*?--"
+    r"|(/?[a-z][a-z0-9]*)\b[^>]*"
+    r"|[!/?][^>]*)>",
+    re.S | re.I,
+)
+
+# Чем заменить тег ("br", "/p", ...); остальные теги просто выкидываются
+_HTML_TAG_TEXT: Dict[str, str] = {
+    "br": "\n",
+    "/p": "\n\n",
+    "/div": "\n",
+    "/li": "\n",
+    "/tr": "\n",
+    "td": " ",
+    "th": " ",
+    **{f"/h{i}": "\n\n" for i in range(1, 7)},
+}
 
-    html = re.sub(r"(?is)<br\s*/?>", "\n", html)
-    html = re.sub(r"(?is)</p>", "\n\n", html)
-    html = re.sub(r"(?is)</div>", "\n", html)
-    html = re.sub(r"(?is)</li>", "\n", html)
-    html = re.sub(r"(?is)</h[1-6]>", "\n\n", html)
-    html = re.sub(r"(?is)</tr>", "\n", html)
+# Нормализация пробелов: одиночный пробел между словами не трогаем
+_SPACES_RE = re.compile(r"\t[ \t]*| [ \t]+")
+_NEWLINE_WS_RE = re.compile(r"\n\s+")
 
-    html = re.sub(r"(?is)<t[dh][^>]*>", " ", html)
 
-    text = re.sub(r"(?s)<.*?>", "", html)
-    text = unescape(text)
+def _html_token_text(m: "re.Match[str]") -> str:
+    tag = m[2]
+    if tag is None:
+        return ""
+    return _HTML_TAG_TEXT.get(tag.lower(), "")
 
-    text = re.sub(r"[ \t]+", " ", text)
-    text = re.sub(r"\r", "", text)
-    text = re.sub(r"\n\s+", "\n", text)
-    text = re.sub(r"\n{3,}", "\n\n", text)
 
+def html_to_text(html: str) -> str:
+    """Конвертация HTML в текст за один проход токенизатора."""
+    text = _HTML_TOKEN_RE.sub(_html_token_text, html)
+    if "&" in text:
+        text = unescape(text)
+
+    text = _SPACES_RE.sub(" ", text)
+    if "\r" in text:
+        text = text.replace("\r", "")
+    # \n\s+ съедает и пустые строки, так что больше двух \n подряд не бывает
+    text = _NEWLINE_WS_RE.sub("\n", text)
     return text.strip()
 
 
@@ -393,80 +1038,833 @@ def escape_html(text: str) -> str:
     )
 
 
-def get_imap_connection() -> imaplib.IMAP4_SSL:
-    imap = imaplib.IMAP4_SSL("imap.gmail.com")
-    imap.login(GMAIL_USER, GMAIL_APP_PASSWORD)
+def get_imap_connection() -> imaplib.IMAP4:
+    with IMAP_LOGIN_SECONDS.time():
+        if IMAP_SSL:
+            imap = imaplib.IMAP4_SSL(IMAP_HOST, IMAP_PORT)
+        else:
+            imap = imaplib.IMAP4(IMAP_HOST, IMAP_PORT)
+        imap.login(GMAIL_USER, GMAIL_APP_PASSWORD)
     return imap
 
 
-def list_last_emails(from_filter: str, limit: int = 10) -> List[Dict[str, str]]:
-    """Список последних писем от указанного отправителя."""
-    imap = get_imap_connection()
+def imap_uid(imap: imaplib.IMAP4, command: str, *args: Any) -> Tuple[str, List[Any]]:
+    """imap.uid() с замером времени команды (bot_imap_command_seconds)."""
+    with IMAP_COMMAND_SECONDS.time(command=command.lower()):
+        return imap.uid(command, *args)
 
-    status, _ = imap.select("INBOX")
-    if status != "OK":
-        imap.logout()
-        return []
 
-    search_criteria = f'(FROM "{from_filter}")'
-    status, data = imap.uid("search", None, search_criteria)
-    if status != "OK" or not data or not data[0]:
-        imap.close()
+def close_imap_connection(imap: imaplib.IMAP4) -> None:
+    """Аккуратно закрыть сессию, не падая на уже мёртвом сокете."""
+    try:
         imap.logout()
-        return []
+    except Exception:
+        pass
+
+
+class ImapPool:
+    """
+    Пул авторизованных IMAP-сессий с уже выбранным INBOX.
+
+    Сессии переиспользуются между вызовами, поэтому TLS-рукопожатие и LOGIN
+    делаются только при первом обращении или после обрыва соединения.
+    """
+
+    def __init__(self, size: int, max_idle: float, noop_after: float) -> None:
+        self.max_idle = max_idle
+        self.noop_after = noop_after
+        self._slots = threading.BoundedSemaphore(size)
+        self._lock = threading.Lock()
+        # Свободные сессии: (соединение, время последнего использования)
+        self._idle: List[Tuple[imaplib.IMAP4, float]] = []
+        # UIDVALIDITY из ответа на последний SELECT (меняется — UID больше не валидны)
+        self.uidvalidity: Optional[int] = None
+
+    def _open(self) -> imaplib.IMAP4:
+        imap = get_imap_connection()
+        with IMAP_COMMAND_SECONDS.time(command="select"):
+            status, _ = imap.select("INBOX")
+        if status != "OK":
+            close_imap_connection(imap)
+            raise imaplib.IMAP4.error("INBOX select failed")
+
+        validity = imap.untagged_responses.get("UIDVALIDITY")
+        if validity and validity[-1]:
+            self.uidvalidity = int(validity[-1])
+        return imap
+
+    def _evict_expired(self) -> None:
+        """Закрыть сессии, которые простаивают дольше max_idle."""
+        now = time.monotonic()
+        with self._lock:
+            expired = [imap for imap, ts in self._idle if now - ts > self.max_idle]
+            self._idle = [(imap, ts) for imap, ts in self._idle if now - ts <= self.max_idle]
+        for imap in expired:
+            close_imap_connection(imap)
+
+    def acquire(self) -> imaplib.IMAP4:
+        """Взять сессию из пула (или открыть новую). Блокирует, если все заняты."""
+        self._slots.acquire()
+        try:
+            self._evict_expired()
+            while True:
+                with self._lock:
+                    if not self._idle:
+                        break
+                    imap, last_used = self._idle.pop()
+
+                if time.monotonic() - last_used < self.noop_after:
+                    return imap
+
+                # Давно не пользовались — проверяем, что сервер нас ещё не выкинул
+                try:
+                    with IMAP_COMMAND_SECONDS.time(command="noop"):
+                        status, _ = imap.noop()
+                    if status == "OK":
+                        return imap
+                except Exception:
+                    pass
+                close_imap_connection(imap)
+
+            return self._open()
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def release(self, imap: imaplib.IMAP4, broken: bool = False) -> None:
+        """Вернуть сессию в пул. Сломанные сессии закрываются."""
+        try:
+            if broken:
+                IMAP_BROKEN_SESSIONS.inc()
+                close_imap_connection(imap)
+            else:
+                with self._lock:
+                    self._idle.append((imap, time.monotonic()))
+        finally:
+            self._slots.release()
+
+    @contextmanager
+    def session(self) -> Iterator[imaplib.IMAP4]:
+        """
+        with imap_pool.session() as imap: ...
+
+        Если внутри блока вылетело исключение, сессия считается испорченной
+        и в пул не возвращается.
+        """
+        imap = self.acquire()
+        try:
+            yield imap
+        except BaseException:
+            self.release(imap, broken=True)
+            raise
+        else:
+            self.release(imap)
+
+    def close_all(self) -> None:
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for imap, _ in idle:
+            close_imap_connection(imap)
+
 
-    uids = data[0].split()
+imap_pool = ImapPool(IMAP_POOL_SIZE, IMAP_MAX_IDLE, IMAP_NOOP_AFTER)
+
+_FETCH_UID_RE = re.compile(rb"UID (\d+)")
+
+
+def fetch_header_fields(
+    imap: imaplib.IMAP4,
+    uids: List[str],
+    fields: str,
+    internaldates: Optional[Dict[str, float]] = None,
+) -> Optional[Dict[str, Message]]:
+    """
+    Заголовки сразу для набора писем одним UID FETCH.
+    fields — список полей через пробел, например "FROM" или "SUBJECT FROM DATE".
+    Если передан словарь internaldates, в том же запросе берётся INTERNALDATE
+    (время прихода письма на сервер) и складывается туда как {uid: unix time}.
+    Возвращает {uid: Message} (письма, удалённые с сервера, в нём просто
+    отсутствуют) или None, если сервер не выполнил FETCH.
+    """
+    result: Dict[str, Message] = {}
     if not uids:
-        imap.close()
-        imap.logout()
-        return []
+        return result
+
+    items = f"BODY.PEEK[HEADER.FIELDS ({fields})]"
+    if internaldates is not None:
+        items = "INTERNALDATE " + items
+    status, data = imap_uid(imap, "fetch", ",".join(uids), f"({items})")
+    if status != "OK":
+        print("fetch_header_fields error:", status)
+        return None
+    if not data:
+        return result
+
+    def add(meta: bytes, literal: bytes) -> None:
+        m = _FETCH_UID_RE.search(meta)
+        if not m:
+            return
+        uid = m.group(1).decode()
+        result[uid] = email.message_from_bytes(literal)
+        if internaldates is not None:
+            stamp = imaplib.Internaldate2tuple(meta)
+            if stamp is not None:
+                internaldates[uid] = time.mktime(stamp)
+
+    # Ответ: (b'1 (UID 5 BODY[...] {n}', b'<заголовки>'), b')', ...
+    # UID и INTERNALDATE сервер может прислать и после литерала — в следующем куске.
+    pending: Optional[Tuple[bytes, bytes]] = None
+    for item in data:
+        if isinstance(item, tuple):
+            if pending is not None:
+                add(*pending)
+            pending = (item[0], item[1])
+        elif pending is not None and isinstance(item, bytes):
+            add(pending[0] + item, pending[1])
+            pending = None
+    if pending is not None:
+        add(*pending)
+    return result
+
+
+def get_mailbox_status(imap: imaplib.IMAP4) -> Tuple[Optional[int], Optional[int]]:
+    """(UIDVALIDITY, UIDNEXT) для INBOX одной командой STATUS."""
+    with IMAP_COMMAND_SECONDS.time(command="status"):
+        status, data = imap.status("INBOX", "(UIDVALIDITY UIDNEXT)")
+    if status != "OK" or not data or not isinstance(data[0], bytes):
+        return None, None
+
+    validity = re.search(rb"UIDVALIDITY (\d+)", data[0])
+    uidnext = re.search(rb"UIDNEXT (\d+)", data[0])
+    return (
+        int(validity.group(1)) if validity else None,
+        int(uidnext.group(1)) if uidnext else None,
+    )
+
+
+# ---------- BODYSTRUCTURE: качаем только текстовую часть письма ----------
+
+_IMAP_TOKEN_RE = re.compile(rb'\s*(?:(\()|(\))|"((?:[^"\\]|\\.)*)"|\{(\d+)\}\r\n|([^\s()"\[]+(?:\[[^\]]*\][^\s()]*)?))')
+
+
+class MimePart(NamedTuple):
+    """Текстовая часть письма, найденная по BODYSTRUCTURE."""
+    section: str        # номер секции для BODY.PEEK[...], например "1.2"
+    subtype: str        # "plain" / "html"
+    charset: str
+    encoding: str       # Content-Transfer-Encoding в нижнем регистре
+    size: int           # размер в байтах (уже закодированный)
+
+
+def join_fetch_response(data: List[Any]) -> bytes:
+    """Собирает ответ imaplib (кортежи с литералами + хвосты) обратно в одну строку."""
+    out = b""
+    for item in data:
+        if isinstance(item, tuple):
+            out += item[0] + b"\r\n" + item[1]
+        elif isinstance(item, bytes):
+            out += item
+    return out
+
+
+def parse_imap_list(raw: bytes) -> List[Any]:
+    """
+    Разбор IMAP-ответа в дерево списков: (...) -> list, "строка"/атом/литерал -> bytes,
+    NIL -> None. Атомы вида BODY[HEADER.FIELDS (FROM)] остаются одним токеном.
+    """
+    stack: List[List[Any]] = [[]]
+    pos = 0
+    while pos < len(raw):
+        m = _IMAP_TOKEN_RE.match(raw, pos)
+        if not m:
+            if raw[pos:].strip():
+                raise ValueError(f"bad IMAP token at {pos}")
+            break
+        pos = m.end()
+        if m.group(1):
+            stack.append([])
+        elif m.group(2):
+            if len(stack) == 1:
+                raise ValueError("unbalanced ')'")
+            done = stack.pop()
+            stack[-1].append(done)
+        elif m.group(3) is not None:
+            stack[-1].append(re.sub(rb"\\(.)", rb"\1", m.group(3)))
+        elif m.group(4) is not None:
+            size = int(m.group(4))
+            stack[-1].append(raw[pos:pos + size])
+            pos += size
+        else:
+            atom = m.group(5)
+            stack[-1].append(None if atom.upper() == b"NIL" else atom)
+    if len(stack) != 1:
+        raise ValueError("unbalanced '('")
+    return stack[0]
+
+
+def parse_fetch_items(data: List[Any]) -> Dict[str, Any]:
+    """Ответ UID FETCH по одному письму -> {"UID": b"5", "BODYSTRUCTURE": [...], "BODY[1]": b"..."}."""
+    tree = parse_imap_list(join_fetch_response(data))
+    # * 1 FETCH (...) — imaplib уже отрезал "* ", остаётся ["1", "FETCH"?, [...]]
+    items = next((node for node in tree if isinstance(node, list)), [])
+    result: Dict[str, Any] = {}
+    for key, value in zip(items[::2], items[1::2]):
+        if isinstance(key, bytes):
+            result[key.decode("ascii", "ignore").upper()] = value
+    return result
+
+
+def _lower(value: Any) -> str:
+    return value.decode("ascii", "ignore").lower() if isinstance(value, bytes) else ""
+
 
-    uids = uids[-limit:]  # последние N
+def _part_params(value: Any) -> Dict[str, str]:
+    if not isinstance(value, list):
+        return {}
+    return {_lower(k): (v or b"").decode("ascii", "ignore") for k, v in zip(value[::2], value[1::2])}
+
+
+def find_text_part(structure: List[Any], section: str = "") -> Tuple[Optional[MimePart], Optional[MimePart]]:
+    """
+    Обход BODYSTRUCTURE. Возвращает первую text/plain и первую text/html часть
+    (не вложения) — как раньше делал msg.walk().
+    """
+    plain: Optional[MimePart] = None
+    html: Optional[MimePart] = None
+
+    if structure and isinstance(structure[0], list):
+        # multipart: (часть)(часть)... "subtype" ...
+        idx = 0
+        for child in structure:
+            if not isinstance(child, list):
+                break
+            idx += 1
+            child_plain, child_html = find_text_part(child, f"{section}.{idx}" if section else str(idx))
+            plain = plain or child_plain
+            html = html or child_html
+            if plain:
+                break
+        return plain, html
+
+    if len(structure) < 7:
+        return None, None
+
+    maintype, subtype = _lower(structure[0]), _lower(structure[1])
+    own_section = section or "1"
+
+    if maintype == "message" and subtype == "rfc822" and len(structure) > 8 and isinstance(structure[8], list):
+        # Пересланное письмо: его части нумеруются внутри секции вложения
+        nested = structure[8]
+        if nested and isinstance(nested[0], list):
+            return find_text_part(nested, own_section)
+        return find_text_part(nested, own_section + ".1")
+
+    if maintype != "text" or subtype not in ("plain", "html"):
+        return None, None
+
+    # У text/* после size идёт число строк, потом md5 и disposition
+    disposition = structure[9] if len(structure) > 9 else None
+    if isinstance(disposition, list) and disposition and _lower(disposition[0]) == "attachment":
+        return None, None
+
+    try:
+        size = int(structure[6])
+    except (TypeError, ValueError):
+        size = 0
+    part = MimePart(
+        own_section,
+        subtype,
+        _part_params(structure[2]).get("charset") or "utf-8",
+        _lower(structure[5]) or "7bit",
+        size,
+    )
+    return (part, None) if subtype == "plain" else (None, part)
+
+
+def decode_transfer(payload: bytes, encoding: str) -> bytes:
+    """Снять Content-Transfer-Encoding (base64 / quoted-printable)."""
+    if encoding == "base64":
+        try:
+            return base64.b64decode(payload)
+        except (binascii.Error, ValueError):
+            # Битый base64 — берём то, что декодируется
+            clean = re.sub(rb"[^A-Za-z0-9+/]", b"", payload)
+            return base64.b64decode(clean[: len(clean) // 4 * 4])
+    if encoding == "quoted-printable":
+        return quopri.decodestring(payload)
+    return payload
+
+
+def decode_part_text(payload: bytes, part: MimePart, truncated: bool = False) -> str:
+    """
+    Байты части -> текст (для text/html — через html_to_text).
+    truncated — payload обрезан посередине (частичный FETCH): недописанные
+    base64-четвёрки, =XX-последовательности, многобайтовые символы и теги отбрасываются.
+    """
+    if truncated:
+        if part.encoding == "base64":
+            clean = re.sub(rb"[^A-Za-z0-9+/=]", b"", payload)
+            payload = clean[: len(clean) // 4 * 4]
+        elif part.encoding == "quoted-printable":
+            payload = re.sub(rb"=[0-9A-Fa-f\r]?$", b"", payload)
+
+    data = decode_transfer(payload, part.encoding)
+    try:
+        decoder = codecs.getincrementaldecoder(part.charset)(errors="ignore")
+    except LookupError:
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="ignore")
+    # final=False: хвост от разрезанного многобайтового символа просто не выводится
+    body = decoder.decode(data, final=not truncated)
+
+    if part.subtype == "html":
+        if truncated:
+            body = _HTML_CUT_TAIL_RE.sub("", body)
+        return html_to_text(body)
+    return body
+
+
+# Хвост обрезанного HTML: незакрытый <script>/<style> или комментарий целиком
+# (иначе CSS/JS попадёт в текст) и недописанный тег
+_HTML_CUT_TAIL_RE = re.compile(
+    r"<(script|style)\b(?:(?!</\1).)*$|<!--(?:(?!-->).)*$|<[^>]*$",
+    re.S | re.I,
+)
+
+
+class MailStore:
+    """
+    Локальное хранилище разобранных писем в SQLite.
+
+    Ключ — (UIDVALIDITY, UID): пока UIDVALIDITY ящика не сменилась, UID
+    однозначно указывает на одно и то же письмо. Для писем из списков /mails
+    хранятся только заголовки (body = NULL), для открытых и пришедших через
+    вотчер — ещё и текст.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._lock = threading.Lock()
+        self._db: Optional[sqlite3.Connection] = None
+
+    def _conn(self) -> sqlite3.Connection:
+        if self._db is None:
+            db = sqlite3.connect(self.path, check_same_thread=False)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS emails ("
+                " uidvalidity INTEGER NOT NULL,"
+                " uid INTEGER NOT NULL,"
+                " subject TEXT NOT NULL,"
+                " from_addr TEXT NOT NULL,"
+                " date TEXT NOT NULL,"
+                " body TEXT,"
+                " PRIMARY KEY (uidvalidity, uid))"
+            )
+            db.commit()
+            self._db = db
+        return self._db
+
+    def get_email(self, uidvalidity: int, uid: int) -> Optional[Tuple[str, str, str, str]]:
+        """(subject, from, date, body) или None, если текста письма в хранилище нет."""
+        try:
+            with self._lock:
+                row = self._conn().execute(
+                    "SELECT subject, from_addr, date, body FROM emails"
+                    " WHERE uidvalidity = ? AND uid = ? AND body IS NOT NULL",
+                    (uidvalidity, uid),
+                ).fetchone()
+        except sqlite3.Error as e:
+            print("mail_store get_email error:", e)
+            return None
+        return tuple(row) if row else None
+
+    def get_headers(self, uidvalidity: int, uids: List[int]) -> Dict[int, Tuple[str, str, str]]:
+        """{uid: (subject, from, date)} для тех UID, что уже есть в хранилище."""
+        if not uids:
+            return {}
+        marks = ",".join("?" * len(uids))
+        try:
+            with self._lock:
+                rows = self._conn().execute(
+                    "SELECT uid, subject, from_addr, date FROM emails"
+                    f" WHERE uidvalidity = ? AND uid IN ({marks})",
+                    (uidvalidity, *uids),
+                ).fetchall()
+        except sqlite3.Error as e:
+            print("mail_store get_headers error:", e)
+            return {}
+        return {uid: (subject, from_, date) for uid, subject, from_, date in rows}
+
+    def put_headers(self, uidvalidity: int, rows: List[Tuple[int, str, str, str]]) -> None:
+        """Сохранить заголовки (uid, subject, from, date), не трогая уже сохранённый текст."""
+        if not rows:
+            return
+        try:
+            with self._lock:
+                db = self._conn()
+                db.executemany(
+                    "INSERT OR IGNORE INTO emails (uidvalidity, uid, subject, from_addr, date)"
+                    " VALUES (?, ?, ?, ?, ?)",
+                    [(uidvalidity, *row) for row in rows],
+                )
+                db.commit()
+        except sqlite3.Error as e:
+            print("mail_store put_headers error:", e)
+
+    def put_email(
+        self, uidvalidity: int, uid: int, subject: str, from_: str, date: str, body: str
+    ) -> None:
+        try:
+            with self._lock:
+                db = self._conn()
+                db.execute(
+                    "INSERT OR REPLACE INTO emails"
+                    " (uidvalidity, uid, subject, from_addr, date, body)"
+                    " VALUES (?, ?, ?, ?, ?, ?)",
+                    (uidvalidity, uid, subject, from_, date, body),
+                )
+                db.commit()
+        except sqlite3.Error as e:
+            print("mail_store put_email error:", e)
+
+
+mail_store = MailStore(MAIL_STORE_FILE)
+
+
+class EmailCache:
+    """
+    Кэш в памяти процесса перед MailStore и IMAP.
+
+    Письма вытесняются по LRU, когда суммарный размер текстов превышает
+    max_bytes. Списки для /mails живут list_ttl секунд (и сбрасываются
+    вотчером, когда от отправителя приходит новое письмо).
+    """
+
+    def __init__(self, max_bytes: int, list_ttl: float) -> None:
+        self.max_bytes = max_bytes
+        self.list_ttl = list_ttl
+        self._lock = threading.Lock()
+        self._emails: "OrderedDict[Tuple[int, int], Tuple[str, str, str, str]]" = OrderedDict()
+        self._sizes: Dict[Tuple[int, int], int] = {}
+        self._bytes = 0
+        # (отправитель, limit, uidvalidity) -> (когда положили, список)
+        self._lists: Dict[Tuple[str, int, int], Tuple[float, List[Dict[str, str]]]] = {}
+
+        self.hits = 0
+        self.misses = 0
+        self.list_hits = 0
+        self.list_misses = 0
+
+    def get_email(self, uidvalidity: int, uid: int) -> Optional[Tuple[str, str, str, str]]:
+        key = (uidvalidity, uid)
+        with self._lock:
+            value = self._emails.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._emails.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put_email(self, uidvalidity: int, uid: int, value: Tuple[str, str, str, str]) -> None:
+        key = (uidvalidity, uid)
+        size = sum(len(part.encode("utf-8")) for part in value)
+        if size > self.max_bytes:
+            return
+
+        with self._lock:
+            if key in self._emails:
+                self._bytes -= self._sizes[key]
+            self._emails[key] = value
+            self._emails.move_to_end(key)
+            self._sizes[key] = size
+            self._bytes += size
+
+            while self._bytes > self.max_bytes:
+                old_key, _ = self._emails.popitem(last=False)
+                self._bytes -= self._sizes.pop(old_key)
+
+    def get_list(self, from_filter: str, limit: int, uidvalidity: int) -> Optional[List[Dict[str, str]]]:
+        key = (from_filter, limit, uidvalidity)
+        with self._lock:
+            entry = self._lists.get(key)
+            if entry is None or time.monotonic() - entry[0] > self.list_ttl:
+                self._lists.pop(key, None)
+                self.list_misses += 1
+                return None
+            self.list_hits += 1
+            return entry[1]
+
+    def put_list(self, from_filter: str, limit: int, uidvalidity: int, emails: List[Dict[str, str]]) -> None:
+        with self._lock:
+            self._lists[(from_filter, limit, uidvalidity)] = (time.monotonic(), emails)
+
+    def invalidate_lists(self, from_filter: Optional[str] = None) -> None:
+        """Сбросить списки отправителя (или все, если отправитель не указан)."""
+        with self._lock:
+            if from_filter is None:
+                self._lists.clear()
+            else:
+                for key in [k for k in self._lists if k[0] == from_filter]:
+                    del self._lists[key]
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "list_hits": self.list_hits,
+                "list_misses": self.list_misses,
+                "emails": len(self._emails),
+                "bytes": self._bytes,
+            }
+
+
+email_cache = EmailCache(EMAIL_CACHE_BYTES, MAIL_LIST_TTL)
+
+CallbackMetric("bot_email_cache_hits_total", "Emails served from the in-memory cache", "counter",
+               lambda: email_cache.stats()["hits"])
+CallbackMetric("bot_email_cache_misses_total", "Emails not found in the in-memory cache", "counter",
+               lambda: email_cache.stats()["misses"])
+CallbackMetric("bot_mail_list_cache_hits_total", "/mails lists served from the cache", "counter",
+               lambda: email_cache.stats()["list_hits"])
+CallbackMetric("bot_mail_list_cache_misses_total", "/mails lists fetched from IMAP", "counter",
+               lambda: email_cache.stats()["list_misses"])
+CallbackMetric("bot_email_cache_bytes", "Text bytes held by the email cache", "gauge",
+               lambda: email_cache.stats()["bytes"])
+
+
+def list_last_emails(from_filter: str, limit: int = 10) -> List[Dict[str, str]]:
+    """Список последних писем от указанного отправителя."""
+    if imap_pool.uidvalidity is not None:
+        cached = email_cache.get_list(from_filter, limit, imap_pool.uidvalidity)
+        if cached is not None:
+            return cached
+
+    with imap_pool.session() as imap:
+        search_criteria = f'(FROM "{from_filter}")'
+        status, data = imap_uid(imap, "search", None, search_criteria)
+        if status != "OK" or not data or not data[0]:
+            return []
+
+        uids = data[0].split()
+        if not uids:
+            return []
+
+        uids = [uid.decode() for uid in uids[-limit:]]  # последние N
+
+        # Что уже есть в локальном хранилище, с сервера не качаем
+        uidvalidity = imap_pool.uidvalidity
+        known: Dict[int, Tuple[str, str, str]] = {}
+        if uidvalidity is not None:
+            known = mail_store.get_headers(uidvalidity, [int(uid) for uid in uids])
+
+        # Заголовки остальных писем списка — одним запросом
+        missing = [uid for uid in uids if int(uid) not in known]
+        headers = fetch_header_fields(imap, missing, "SUBJECT FROM DATE") or {}
+
+    emails_list = build_mail_rows(uids, known, headers, uidvalidity)
+    if uidvalidity is not None:
+        email_cache.put_list(from_filter, limit, uidvalidity, emails_list)
+    return emails_list
+
+
+def build_mail_rows(
+    uids: List[str],
+    known: Dict[int, Tuple[str, str, str]],
+    headers: Dict[str, Message],
+    uidvalidity: Optional[int],
+) -> List[Dict[str, str]]:
+    """
+    Строки списка /mails (новые сверху) из заголовков, уже лежавших в mail_store
+    (known), и только что скачанных (headers — они дописываются в mail_store).
+    """
+    fetched: List[Tuple[int, str, str, str]] = []
+    for uid, msg in headers.items():
+        row = (
+            decode_mime_header(msg.get("Subject")),
+            decode_mime_header(msg.get("From")),
+            decode_mime_header(msg.get("Date")),
+        )
+        known[int(uid)] = row
+        fetched.append((int(uid), *row))
+    if uidvalidity is not None:
+        mail_store.put_headers(uidvalidity, fetched)
 
     emails_list: List[Dict[str, str]] = []
 
     for uid in reversed(uids):  # новые сверху
-        status, msg_data = imap.uid("fetch", uid, "(BODY.PEEK[HEADER])")
-        if status != "OK" or not msg_data or not msg_data[0]:
+        row = known.get(int(uid))
+        if row is None:
             continue
 
-        raw_email = msg_data[0][1]
-        msg = email.message_from_bytes(raw_email)
-
-        subject = decode_mime_header(msg.get("Subject")) or "(без темы)"
-        from_ = decode_mime_header(msg.get("From"))
-        date = decode_mime_header(msg.get("Date"))
-
+        subject, from_, date = row
         emails_list.append(
             {
-                "uid": uid.decode(),
-                "subject": subject,
+                "uid": uid,
+                "subject": subject or "(без темы)",
                 "from": from_,
                 "date": date,
             }
         )
-
-    imap.close()
-    imap.logout()
     return emails_list
 
 
 def get_email_by_uid(uid: str) -> Tuple[Optional[str], Optional[str], Optional[str], Optional[str]]:
-    """Достаёт полное письмо по UID."""
-    imap = get_imap_connection()
+    """Достаёт полное письмо по UID: из кэша в памяти, из локального хранилища или с сервера."""
+    uidvalidity = imap_pool.uidvalidity
+    if uidvalidity is not None:
+        cached = email_cache.get_email(uidvalidity, int(uid))
+        if cached is not None:
+            return cached
+
+        stored = mail_store.get_email(uidvalidity, int(uid))
+        if stored is not None:
+            email_cache.put_email(uidvalidity, int(uid), stored)
+            return stored
+
+    with imap_pool.session() as imap:
+        result = fetch_email(imap, uid)
+    store_email(uid, result)
+    return result
+
+
+def store_email(
+    uid: str,
+    result: Tuple[Optional[str], Optional[str], Optional[str], Optional[str]],
+    uidvalidity: Optional[int] = None,
+) -> None:
+    """
+    Положить результат fetch_email() в кэш и локальное хранилище.
+    uidvalidity — если не задана, берётся из imap_pool.
+    """
+    subject, from_, date, body = result
+    if uidvalidity is None:
+        uidvalidity = imap_pool.uidvalidity
+    if subject is None or uidvalidity is None:
+        return
+    value = (subject, from_ or "", date or "", body or "")
+    email_cache.put_email(uidvalidity, int(uid), value)
+    mail_store.put_email(uidvalidity, int(uid), *value)
+
+
+def fetch_email(
+    imap: imaplib.IMAP4, uid: str
+) -> Tuple[Optional[str], Optional[str], Optional[str], Optional[str]]:
+    """
+    Достаёт письмо по UID через уже открытую сессию с выбранным INBOX.
+    Сначала BODYSTRUCTURE и заголовки, потом только нужная текстовая часть —
+    вложения и картинки не скачиваются.
+    """
+    subject, from_, date, body, _ = fetch_email_text(imap, uid)
+    return subject, from_, date, body
+
+
+def fetch_email_preview(
+    imap: imaplib.IMAP4, uid: str, max_bytes: int = NOTIFY_PREVIEW_BYTES
+) -> Tuple[Optional[str], Optional[str], Optional[str], Optional[str], bool]:
+    """
+    Начало письма для уведомления: не больше max_bytes байт текстовой части
+    (BODY.PEEK[секция]<0.max_bytes>). Последний элемент — True, если текст обрезан.
+    """
+    return fetch_email_text(imap, uid, max_bytes or None)
+
+
+# Первый FETCH письма: структура и заголовки, без тела
+EMAIL_STRUCTURE_ITEMS = "(BODYSTRUCTURE BODY.PEEK[HEADER.FIELDS (SUBJECT FROM DATE)])"
 
-    status, _ = imap.select("INBOX")
-    if status != "OK":
-        imap.logout()
-        return None, None, None, None
 
-    status, msg_data = imap.uid("fetch", uid, "(RFC822)")
+def parse_email_structure(items: Dict[str, Any]) -> Tuple[str, str, str, Optional[MimePart]]:
+    """
+    Ответ на EMAIL_STRUCTURE_ITEMS (после parse_fetch_items) ->
+    (subject, from, date, текстовая часть или None). Бросает исключение,
+    если BODYSTRUCTURE разобрать не удалось.
+    """
+    structure = items["BODYSTRUCTURE"]
+    headers = next(v for k, v in items.items() if k.startswith("BODY[HEADER"))
+    plain, html = find_text_part(structure)
+
+    msg = email.message_from_bytes(headers or b"")
+    return (
+        decode_mime_header(msg.get("Subject")),
+        decode_mime_header(msg.get("From")),
+        decode_mime_header(msg.get("Date")),
+        plain or html,
+    )
+
+
+def part_fetch_items(part: MimePart, max_bytes: Optional[int] = None) -> Tuple[str, bool]:
+    """Что запросить во втором FETCH: (items, будет ли текст обрезан)."""
+    truncated = max_bytes is not None and part.size > max_bytes
+    partial = f"<0.{max_bytes}>" if truncated else ""
+    return f"(BODY.PEEK[{part.section}]{partial})", truncated
+
+
+def part_body_text(items: Dict[str, Any], part: MimePart, truncated: bool) -> str:
+    """Ответ на part_fetch_items() (после parse_fetch_items) -> текст письма."""
+    # Частичный ответ приходит как BODY[1]<0>
+    payload = next((v for k, v in items.items() if k.startswith(f"BODY[{part.section}]")), b"")
+    return decode_part_text(payload or b"", part, truncated)
+
+
+def fetch_email_text(
+    imap: imaplib.IMAP4, uid: str, max_bytes: Optional[int] = None
+) -> Tuple[Optional[str], Optional[str], Optional[str], Optional[str], bool]:
+    """Общая часть fetch_email() / fetch_email_preview()."""
+    status, msg_data = imap_uid(imap, "fetch", uid, EMAIL_STRUCTURE_ITEMS)
+    if status != "OK" or not msg_data or not msg_data[0]:
+        return None, None, None, None, False
+
+    try:
+        subject, from_, date, part = parse_email_structure(parse_fetch_items(msg_data))
+    except Exception as e:
+        # Сервер прислал что-то, что мы не понимаем — качаем письмо целиком
+        print("bodystructure parse error:", e)
+        return (*fetch_email_rfc822(imap, uid), False)
+
+    body_text = ""
+    truncated = False
+    if part is not None:
+        body = fetch_part(imap, uid, part, max_bytes)
+        if body is not None and body[1] and not body[0].strip():
+            # В начало HTML влез только <head> со стилями — качаем часть целиком
+            body = fetch_part(imap, uid, part)
+        if body is None:
+            return (*fetch_email_rfc822(imap, uid), False)
+        body_text, truncated = body
+
+    body_text = (body_text or "").strip()
+    if not body_text:
+        body_text = "[Письмо без текста]"
+
+    return subject, from_, date, body_text, truncated
+
+
+def fetch_part(
+    imap: imaplib.IMAP4, uid: str, part: MimePart, max_bytes: Optional[int] = None
+) -> Optional[Tuple[str, bool]]:
+    """Текст одной части письма: (текст, обрезан ли). None — сервер не отдал часть."""
+    items, truncated = part_fetch_items(part, max_bytes)
+    status, part_data = imap_uid(imap, "fetch", uid, items)
+    if status != "OK" or not part_data or not part_data[0]:
+        return None
+    return part_body_text(parse_fetch_items(part_data), part, truncated), truncated
+
+
+def fetch_email_rfc822(
+    imap: imaplib.IMAP4, uid: str
+) -> Tuple[Optional[str], Optional[str], Optional[str], Optional[str]]:
+    """Запасной путь: полное письмо (RFC822) и разбор через msg.walk()."""
+    status, msg_data = imap_uid(imap, "fetch", uid, "(RFC822)")
     if status != "OK" or not msg_data or not msg_data[0]:
-        imap.close()
-        imap.logout()
         return None, None, None, None
 
-    raw_email = msg_data[0][1]
+    return parse_rfc822(msg_data[0][1])
+
+
+def parse_rfc822(raw_email: bytes) -> Tuple[str, str, str, str]:
+    """Разбор полного письма: (subject, from, date, текст)."""
     msg = email.message_from_bytes(raw_email)
 
     subject = decode_mime_header(msg.get("Subject"))
@@ -518,9 +1916,6 @@ def get_email_by_uid(uid: str) -> Tuple[Optional[str], Optional[str], Optional[s
         else:
             body_text = body
 
-    imap.close()
-    imap.logout()
-
     body_text = (body_text or "").strip()
     if not body_text:
         body_text = "[Письмо без текста]"
@@ -528,13 +1923,320 @@ def get_email_by_uid(uid: str) -> Tuple[Optional[str], Optional[str], Optional[s
     return subject, from_, date, body_text
 
 
+# ======================= ОТПРАВКА В TELEGRAM =======================
+
+class TokenBucket:
+    """Token bucket: rate токенов в секунду, не больше capacity про запас."""
+
+    def __init__(self, rate: float, capacity: float) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        # До этого момента бакет заблокирован (retry_after от Telegram)
+        self.blocked_until = 0.0
+
+    def wait_time(self, now: float) -> float:
+        """Сколько секунд ждать до следующего токена (0 — можно сейчас)."""
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        wait = max(0.0, self.blocked_until - now)
+        if self.tokens < 1:
+            wait = max(wait, (1 - self.tokens) / self.rate)
+        return wait
+
+
+class TelegramRateLimiter:
+    """
+    Лимиты Telegram Bot API: общий на бота (~30 сообщений/с)
+    и на каждый чат (~20 сообщений/мин в группу, ~1 сообщение/с в личку).
+    """
+
+    def __init__(self, global_rate: float, group_per_minute: float, private_rate: float) -> None:
+        self._lock = threading.Lock()
+        self._global = TokenBucket(global_rate, global_rate)
+        self._group_rate = group_per_minute / 60.0
+        self._group_capacity = group_per_minute
+        self._private_rate = private_rate
+        self._chats: Dict[int, TokenBucket] = {}
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            # Отрицательные ID — группы и каналы
+            if chat_id < 0:
+                bucket = TokenBucket(self._group_rate, self._group_capacity)
+            else:
+                bucket = TokenBucket(self._private_rate, self._private_rate)
+            self._chats[chat_id] = bucket
+        return bucket
+
+    def try_acquire(self, chat_id: int) -> float:
+        """
+        Взять токен без ожидания. Возвращает 0, если токен взят,
+        иначе сколько секунд подождать перед следующей попыткой.
+        """
+        with self._lock:
+            now = time.monotonic()
+            chat_bucket = self._chat_bucket(chat_id)
+            wait = max(chat_bucket.wait_time(now), self._global.wait_time(now))
+            if wait <= 0:
+                chat_bucket.tokens -= 1
+                self._global.tokens -= 1
+                return 0.0
+        return wait
+
+    def acquire(self, chat_id: int) -> None:
+        """
+        Блокирует поток, пока в chat_id нельзя отправить ещё одно сообщение.
+        В потоках рассылки не спит, а бросает ChatBusy (см. NotificationDispatcher).
+        """
+        if getattr(_send_context, "park", False):
+            wait = self.try_acquire(chat_id)
+            if wait > 0:
+                raise ChatBusy(wait)
+            return
+        while True:
+            wait = self.try_acquire(chat_id)
+            if wait <= 0:
+                return
+            time.sleep(wait)
+
+    def penalize(self, chat_id: int, retry_after: float) -> None:
+        """Telegram ответил 429: не трогаем чат retry_after секунд."""
+        with self._lock:
+            bucket = self._chat_bucket(chat_id)
+            bucket.blocked_until = max(bucket.blocked_until, time.monotonic() + retry_after)
+
+
+class ChatBusy(Exception):
+    """Чату пока нельзя слать: задание рассылки откладывается на wait секунд."""
+
+    def __init__(self, wait: float) -> None:
+        super().__init__(f"chat busy for {wait:.2f}s")
+        self.wait = wait
+
+
+# park=True у потоков рассылки: вместо сна в лимитах — ChatBusy
+_send_context = threading.local()
+
+tg_limiter = TelegramRateLimiter(TG_GLOBAL_RATE, TG_GROUP_RATE, TG_PRIVATE_RATE)
+
+
+def tg_send_message(chat_id: int, text: str, **kwargs: Any) -> Any:
+    """
+    bot.send_message с учётом лимитов Telegram.
+    На 429 ждёт retry_after из ответа и повторяет (до TG_MAX_RETRIES раз).
+    """
+    return tg_request(chat_id, partial(bot.send_message, chat_id, text, **kwargs))
+
+
+def tg_send_document(chat_id: int, name: str, content: str, **kwargs: Any) -> Any:
+    """bot.send_document с теми же лимитами и повторами: content уходит файлом name."""
+
+    def send() -> Any:
+        # Файл заново на каждую попытку: прошлую telebot уже дочитал
+        return bot.send_document(chat_id, io.BytesIO(content.encode("utf-8")), visible_file_name=name, **kwargs)
+
+    return tg_request(chat_id, send)
+
+
+def tg_request(chat_id: int, send: Callable[[], Any]) -> Any:
+    """Общая часть tg_send_*: лимиты tg_limiter, повторы на 429 и метрики."""
+    for attempt in range(TG_MAX_RETRIES):
+        tg_limiter.acquire(chat_id)
+        started = time.perf_counter()
+        try:
+            return send()
+        except ApiTelegramException as e:
+            TG_SEND_ERRORS.inc(code=str(e.error_code))
+            if e.error_code != 429 or attempt == TG_MAX_RETRIES - 1:
+                raise
+            retry_after = (e.result_json.get("parameters") or {}).get("retry_after", 1)
+            print(f"[send] 429 for chat {chat_id}, retry after {retry_after}s")
+            tg_limiter.penalize(chat_id, retry_after)
+            if getattr(_send_context, "park", False):
+                # В рассылке не ждём на месте: задание вернётся, когда чат освободится
+                raise ChatBusy(retry_after) from e
+        except Exception:
+            TG_SEND_ERRORS.inc(code="network")
+            raise
+        finally:
+            TG_SEND_SECONDS.observe(time.perf_counter() - started)
+
+
+class _DispatchShard:
+    """Очереди одного потока рассылки: задания по чатам, готовые и отложенные чаты."""
+
+    def __init__(self) -> None:
+        self.cond = threading.Condition()
+        self.jobs: Dict[int, "deque[Callable[[], None]]"] = {}
+        # Чаты, которые можно обслужить сейчас (по кругу)
+        self.ready: "deque[int]" = deque()
+        # Куча (когда можно, chat_id): чаты, упёршиеся в лимит Telegram
+        self.parked: List[Tuple[float, int]] = []
+        self.unfinished = 0
+
+
+class NotificationDispatcher:
+    """
+    Стадия рассылки: вотчер только ставит задания в очередь, а пул потоков
+    их отправляет. Все задания одного чата попадают в один и тот же поток
+    и выполняются по одному, поэтому сообщения внутри чата не перемешиваются.
+
+    Поток не спит в лимитах Telegram: если чат упёрся в свой бакет (или в 429),
+    задание бросает ChatBusy, чат откладывается до нужного момента, а поток
+    тем временем обслуживает остальные чаты. Отложенное задание запускается
+    заново, поэтому продолжать с места остановки оно должно само (SendProgress).
+    """
+
+    def __init__(self, workers: int, name: str = "send") -> None:
+        self.name = name
+        self._shards = [_DispatchShard() for _ in range(max(1, workers))]
+        self._started = False
+        self._start_lock = threading.Lock()
+
+    def _ensure_started(self) -> None:
+        with self._start_lock:
+            if self._started:
+                return
+            for idx, shard in enumerate(self._shards):
+                threading.Thread(
+                    target=self._worker, args=(shard,), name=f"{self.name}-{idx}", daemon=True
+                ).start()
+            self._started = True
+
+    def _next_job(self, shard: _DispatchShard) -> Tuple[int, Callable[[], None]]:
+        with shard.cond:
+            while True:
+                now = time.monotonic()
+                while shard.parked and shard.parked[0][0] <= now:
+                    shard.ready.append(heapq.heappop(shard.parked)[1])
+                if shard.ready:
+                    chat_id = shard.ready.popleft()
+                    return chat_id, shard.jobs[chat_id][0]
+                shard.cond.wait(shard.parked[0][0] - now if shard.parked else None)
+
+    def _worker(self, shard: _DispatchShard) -> None:
+        _send_context.park = True
+        while True:
+            chat_id, job = self._next_job(shard)
+            wait = 0.0
+            try:
+                job()
+            except ChatBusy as e:
+                wait = e.wait
+            except Exception as e:
+                print(f"[dispatch] {self.name} job error for chat {chat_id}:", e)
+
+            with shard.cond:
+                if wait > 0:
+                    heapq.heappush(shard.parked, (time.monotonic() + wait, chat_id))
+                    continue
+                jobs = shard.jobs[chat_id]
+                jobs.popleft()
+                shard.unfinished -= 1
+                if jobs:
+                    shard.ready.append(chat_id)
+                else:
+                    del shard.jobs[chat_id]
+                if not shard.unfinished:
+                    shard.cond.notify_all()
+
+    def submit(self, chat_id: int, job: Callable[[], None]) -> None:
+        self._ensure_started()
+        shard = self._shards[hash(chat_id) % len(self._shards)]
+        with shard.cond:
+            shard.unfinished += 1
+            jobs = shard.jobs.get(chat_id)
+            if jobs is not None:
+                # Чат уже готов, отложен или обслуживается — встаёт в его очередь
+                jobs.append(job)
+                return
+            shard.jobs[chat_id] = deque([job])
+            shard.ready.append(chat_id)
+            shard.cond.notify_all()
+
+    def pending(self) -> int:
+        return sum(shard.unfinished for shard in self._shards)
+
+    def join(self) -> None:
+        """Дождаться, пока все поставленные задания будут отправлены."""
+        for shard in self._shards:
+            with shard.cond:
+                while shard.unfinished:
+                    shard.cond.wait()
+
+
+dispatcher = NotificationDispatcher(SEND_WORKERS)
+
+
+class Scheduler:
+    """
+    Отложенные вызовы в одном потоке: куча (когда, номер, fn).
+    Повторы уведомлений после сбоя Telegram не превращаются в тысячи спящих
+    потоков threading.Timer. fn должны быть быстрыми (поставить задание и выйти).
+    """
+
+    def __init__(self) -> None:
+        self._cond = threading.Condition()
+        self._heap: List[Tuple[float, int, Callable[[], None]]] = []
+        self._seq = 0
+        self._thread: Optional[threading.Thread] = None
+
+    def call_later(self, delay: float, fn: Callable[[], None]) -> None:
+        with self._cond:
+            self._seq += 1
+            heapq.heappush(self._heap, (time.monotonic() + max(0.0, delay), self._seq, fn))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="scheduler", daemon=True)
+                self._thread.start()
+            self._cond.notify()
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                while True:
+                    now = time.monotonic()
+                    if self._heap and self._heap[0][0] <= now:
+                        fn = heapq.heappop(self._heap)[2]
+                        break
+                    self._cond.wait(self._heap[0][0] - now if self._heap else None)
+            try:
+                fn()
+            except Exception as e:
+                print("[scheduler] error:", e)
+
+    def pending(self) -> int:
+        with self._cond:
+            return len(self._heap)
+
+
+scheduler = Scheduler()
+CallbackMetric("bot_scheduled_calls", "Delayed calls waiting in the scheduler", "gauge", scheduler.pending)
+CallbackMetric("bot_dispatch_queue_depth", "Send jobs waiting in the dispatcher queues", "gauge", dispatcher.pending)
+
+
 def build_webapp_url(source: str, uid: str) -> str:
     sep = "&" if "?" in WEBAPP_BASE_URL else "?"
     return f"{WEBAPP_BASE_URL}{sep}source={source}&uid={uid}"
 
 
-def send_email_pretty(
-    chat_id: int,
+class RenderedEmail(NamedTuple):
+    """Готовое к отправке письмо: одинаковое для всех чатов, которым оно уходит."""
+
+    header: str
+    # Клавиатура, уже сериализованная в JSON (или None)
+    reply_markup: Optional[str]
+    chunks: Tuple[str, ...]
+    # Строка письма в дайджесте и ссылка на WebApp для его кнопки
+    summary: str = ""
+    webapp_url: Optional[str] = None
+    # Слишком длинный текст: (имя файла, полный текст) — уходит документом после сообщений
+    document: Optional[Tuple[str, str]] = None
+
+
+def render_email(
     source: str,
     subject: str,
     from_: str,
@@ -542,8 +2244,12 @@ def send_email_pretty(
     body_text: str,
     uid: Optional[str] = None,
     as_notification: bool = False,
-) -> None:
-    """Красивый вывод письма + кнопки WebApp."""
+    truncated: bool = False,
+) -> RenderedEmail:
+    """
+    Красивый вывод письма + кнопки WebApp, собранный один раз.
+    truncated — в body_text только начало письма: добавляется кнопка «Показать полностью».
+    """
     meta = SOURCE_META.get(source, {"name": source.upper(), "icon": "✉️"})
     source_label = meta["name"]
     source_icon = meta["icon"]
@@ -573,8 +2279,16 @@ def send_email_pretty(
     )
 
     reply_markup = None
+    kb = InlineKeyboardMarkup()
+    if truncated and uid:
+        # Тот же callback, что и у списка /mails — письмо подтянется целиком
+        kb.row(
+            InlineKeyboardButton(
+                "📄 Показать полностью",
+                callback_data=f"mail:{source}:{uid}",
+            )
+        )
     if webapp_url:
-        kb = InlineKeyboardMarkup()
         kb.row(
             InlineKeyboardButton(
                 "🧩 Открыть WebApp (в Telegram)",
@@ -587,19 +2301,482 @@ def send_email_pretty(
                 url=webapp_url,
             )
         )
-        reply_markup = kb
+    if kb.keyboard:
+        reply_markup = kb.to_json()
+
+    text = body_text if body_text else "[Письмо без текста]"
+    if truncated:
+        text += "\n…"
+
+    messages = pack_email_messages(header, text)
+    document = None
+    if len(messages) > TG_MAX_EMAIL_MESSAGES:
+        # Длинное письмо: в чат — только начало, целиком оно придёт файлом
+        document = (f"{source}_{uid or 'email'}.txt", text)
+        messages = messages[:1]
+    header, chunks = messages[0], messages[1:]
+
+    sender = parseaddr(from_)[0] or from_
+    subject_html = escape_html(clip_text(subject or "(без темы)", 80))
+    if webapp_url:
+        subject_html = f"<a href=\"{escape_html(webapp_url)}\">{subject_html}</a>"
+    summary = f"{source_icon} {subject_html} — {escape_html(clip_text(sender, 40))}"
+
+    return RenderedEmail(header, reply_markup, tuple(chunks), summary, webapp_url, document)
+
+
+# Лимит Telegram на текст сообщения; меряем с HTML-разметкой, так что с запасом
+TG_TEXT_LIMIT = 4096
+PRE_OPEN = "<pre>"
+PRE_CLOSE = "</pre>"
+# Меньше этого места после шапки — тело письма начинаем со следующего сообщения
+MIN_BODY_PIECE = 200
+
+
+def tg_len(text: str) -> int:
+    """Длина строки так, как её считает Telegram (в UTF-16)."""
+    return len(text.encode("utf-16-le")) // 2
+
+
+def split_body_piece(text: str, limit: int) -> Tuple[str, str]:
+    """
+    Отрезать от text начало, которое после escape_html() занимает не больше limit.
+    Режем по абзацу, иначе по строке, иначе по пробелу, в крайнем случае — где пришлось.
+    Возвращает (кусок, остаток).
+    """
+    # Экранирование только удлиняет текст: длиннее limit символов — точно не влезет
+    if len(text) <= limit and tg_len(escape_html(text)) <= limit:
+        return text, ""
+
+    # Самый длинный влезающий префикс
+    lo, hi = 0, min(len(text), limit)
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if tg_len(escape_html(text[:mid])) <= limit:
+            lo = mid
+        else:
+            hi = mid - 1
+
+    fits = text[:lo]
+    for sep in ("\n\n", "\n", " "):
+        cut = fits.rfind(sep)
+        # Не режем так, чтобы кусок вышел меньше половины возможного
+        if cut > lo // 2:
+            return text[:cut], text[cut + len(sep):]
+    return fits, text[lo:]
+
+
+def pack_email_messages(header: str, body_text: str) -> List[str]:
+    """
+    Шапка и текст письма -> как можно меньше сообщений по TG_TEXT_LIMIT:
+    начало текста идёт в одно сообщение с шапкой, остаток — кусками <pre>.
+    """
+    overhead = len(PRE_OPEN + PRE_CLOSE)
+    messages: List[str] = []
+    rest = body_text
+
+    room = TG_TEXT_LIMIT - tg_len(header) - 1 - overhead
+    if room >= MIN_BODY_PIECE:
+        piece, rest = split_body_piece(rest, room)
+        messages.append(f"{header}\n{PRE_OPEN}{escape_html(piece)}{PRE_CLOSE}")
+    else:
+        messages.append(header)
+
+    while rest:
+        piece, rest = split_body_piece(rest, TG_TEXT_LIMIT - overhead)
+        if piece.strip():
+            messages.append(PRE_OPEN + escape_html(piece) + PRE_CLOSE)
+    return messages
+
+
+def clip_text(text: str, limit: int) -> str:
+    """Обрезать строку до limit символов с многоточием."""
+    text = " ".join(text.split())
+    return text if len(text) <= limit else text[:limit - 1] + "…"
+
+
+def render_digest(items: List[RenderedEmail]) -> Tuple[str, Optional[str]]:
+    """Дайджест: строка на письмо + кнопки WebApp с номерами писем. -> (текст, клавиатура)."""
+    lines = [
+        f"🔔 <b>Новые письма: {len(items)}</b>",
+        "━━━━━━━━━━━━━━━━━━━━━━",
+    ]
+    buttons: List[InlineKeyboardButton] = []
+    for num, item in enumerate(items, 1):
+        lines.append(f"{num}. {item.summary or '✉️ Новое письмо'}")
+        if item.webapp_url:
+            buttons.append(InlineKeyboardButton(f"🧩 {num}", web_app=WebAppInfo(url=item.webapp_url)))
+
+    kb = InlineKeyboardMarkup()
+    for start in range(0, len(buttons), 5):
+        kb.row(*buttons[start:start + 5])
+    return "\n".join(lines), (kb.to_json() if kb.keyboard else None)
+
+
+class SendProgress:
+    """
+    Сколько сообщений задания уже ушло. Задание рассылки, отложенное на ChatBusy,
+    запускается заново и пропускает то, что уже отправлено.
+    """
+
+    __slots__ = ("sent",)
+
+    def __init__(self) -> None:
+        self.sent = 0
+
+    def step(self, idx: int, send: Callable[[], Any]) -> None:
+        """Выполнить send() как idx-е сообщение задания, если оно ещё не ушло."""
+        if idx < self.sent:
+            return
+        send()
+        self.sent = idx + 1
+
+
+def send_rendered(chat_id: int, rendered: RenderedEmail, progress: Optional[SendProgress] = None) -> None:
+    """Отправить заранее собранное письмо в чат (с места, где остановился progress)."""
+    progress = progress or SendProgress()
+    progress.step(0, partial(tg_send_message, chat_id, rendered.header, reply_markup=rendered.reply_markup))
+    for idx, chunk_html in enumerate(rendered.chunks, 1):
+        progress.step(idx, partial(tg_send_message, chat_id, chunk_html))
+    if rendered.document is not None:
+        name, content = rendered.document
+        progress.step(
+            len(rendered.chunks) + 1,
+            partial(tg_send_document, chat_id, name, content, caption="📄 Полный текст письма"),
+        )
+
+
+def send_email_pretty(
+    chat_id: int,
+    source: str,
+    subject: str,
+    from_: str,
+    date: str,
+    body_text: str,
+    uid: Optional[str] = None,
+    as_notification: bool = False,
+    progress: Optional[SendProgress] = None,
+) -> None:
+    """Красивый вывод письма + кнопки WebApp."""
+    send_rendered(
+        chat_id,
+        render_email(source, subject, from_, date, body_text, uid, as_notification),
+        progress,
+    )
+
+
+class Outbox:
+    """
+    Постоянная очередь уведомлений в SQLite: строка на каждую пару (чат, письмо).
+
+    Уведомления пишутся сюда до того, как вотчер сдвинет last_uids, и удаляются
+    только после успешной отправки. Так письмо дойдёт до всех чатов даже если
+    процесс упал посреди рассылки или Telegram был недоступен.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._lock = threading.Lock()
+        self._db: Optional[sqlite3.Connection] = None
+
+    def _conn(self) -> sqlite3.Connection:
+        if self._db is None:
+            db = sqlite3.connect(self.path, check_same_thread=False)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS outbox ("
+                " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+                " chat_id INTEGER NOT NULL,"
+                " source TEXT NOT NULL,"
+                " uid TEXT NOT NULL,"
+                " payload TEXT NOT NULL,"
+                " attempts INTEGER NOT NULL DEFAULT 0,"
+                " next_try REAL NOT NULL DEFAULT 0)"
+            )
+            db.commit()
+            self._db = db
+        return self._db
+
+    def add(
+        self, source: str, uid: str, rendered: RenderedEmail, chat_ids: List[int]
+    ) -> List[Tuple[int, int]]:
+        """Записать уведомления одним коммитом. Возвращает [(id записи, chat_id)]."""
+        payload = json.dumps(rendered._asdict(), ensure_ascii=False)
+        items: List[Tuple[int, int]] = []
+        with self._lock:
+            db = self._conn()
+            with db:
+                for chat_id in chat_ids:
+                    cur = db.execute(
+                        "INSERT INTO outbox (chat_id, source, uid, payload) VALUES (?, ?, ?, ?)",
+                        (chat_id, source, uid, payload),
+                    )
+                    items.append((cur.lastrowid, chat_id))
+        return items
+
+    def done(self, *item_ids: int) -> None:
+        """Уведомления доставлены (или выброшены) — удаляем записи одним коммитом."""
+        with self._lock:
+            db = self._conn()
+            with db:
+                db.executemany("DELETE FROM outbox WHERE id = ?", [(item_id,) for item_id in item_ids])
+            # Очередь опустела — ужимаем WAL-журнал
+            if db.execute("SELECT 1 FROM outbox LIMIT 1").fetchone() is None:
+                db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+    def retry_later(self, item_id: int, attempts: int, next_try: float) -> None:
+        with self._lock:
+            db = self._conn()
+            with db:
+                db.execute(
+                    "UPDATE outbox SET attempts = ?, next_try = ? WHERE id = ?",
+                    (attempts, next_try, item_id),
+                )
+
+    def pending(self) -> List[Tuple[int, int, RenderedEmail, int, float]]:
+        """Все недоставленные уведомления: (id, chat_id, письмо, попыток, когда повторить)."""
+        with self._lock:
+            rows = self._conn().execute(
+                "SELECT id, chat_id, payload, attempts, next_try FROM outbox ORDER BY id"
+            ).fetchall()
+
+        items = []
+        for item_id, chat_id, payload, attempts, next_try in rows:
+            data = json.loads(payload)
+            rendered = RenderedEmail(
+                data["header"],
+                data["reply_markup"],
+                tuple(data["chunks"]),
+                data.get("summary", ""),
+                data.get("webapp_url"),
+                tuple(data["document"]) if data.get("document") else None,
+            )
+            items.append((item_id, chat_id, rendered, attempts, next_try))
+        return items
+
+    def depth(self) -> int:
+        with self._lock:
+            return self._conn().execute("SELECT COUNT(*) FROM outbox").fetchone()[0]
+
+
+outbox = Outbox(OUTBOX_FILE)
+CallbackMetric("bot_outbox_depth", "Notifications not yet delivered", "gauge", outbox.depth)
+
+
+def deliver_notification(
+    item_id: int,
+    chat_id: int,
+    rendered: RenderedEmail,
+    attempts: int,
+    trace: Optional[EmailTrace] = None,
+    progress: Optional[SendProgress] = None,
+) -> None:
+    """
+    Отправить уведомление из outbox. При ошибке — повтор с экспоненциальной
+    задержкой, после OUTBOX_MAX_ATTEMPTS попыток уведомление выбрасывается.
+    trace — отметки времени письма; после отправки доставка попадает в tracer.
+    ChatBusy пробрасывается диспетчеру: это не ошибка, а «продолжить позже».
+    """
+    try:
+        send_rendered(chat_id, rendered, progress)
+    except ChatBusy:
+        raise
+    except Exception as e:
+        notification_failed(item_id, chat_id, rendered, attempts, trace, e, progress)
+        return
+
+    outbox.done(item_id)
+    if trace is not None:
+        tracer.record(trace, chat_id, attempts)
+
+
+def notification_retry_delay(attempts: int, error_code: Optional[int]) -> Optional[float]:
+    """
+    Через сколько секунд повторить неудачную отправку (None — выбросить уведомление).
+    error_code — код ошибки Bot API (None — сеть и прочее).
+    """
+    # 400/403: чата нет или бота выгнали — повторять бесполезно
+    if error_code in (400, 403) or attempts >= OUTBOX_MAX_ATTEMPTS:
+        return None
+    return min(OUTBOX_RETRY_BASE * 2 ** (attempts - 1), OUTBOX_RETRY_MAX)
+
+
+def notification_failed(
+    item_id: int,
+    chat_id: int,
+    rendered: RenderedEmail,
+    attempts: int,
+    trace: Optional[EmailTrace],
+    error: Exception,
+    progress: Optional[SendProgress] = None,
+) -> None:
+    """
+    Отправка записи outbox не удалась: повтор позже или выброс.
+    progress переходит в повтор, чтобы уже отправленные сообщения не ушли в чат ещё раз.
+    """
+    attempts += 1
+    error_code = error.error_code if isinstance(error, ApiTelegramException) else None
+    delay = notification_retry_delay(attempts, error_code)
+    if delay is None:
+        print(f"[outbox] drop notification for chat {chat_id} after {attempts} attempts:", error)
+        outbox.done(item_id)
+        return
+
+    print(f"[outbox] chat {chat_id} failed ({error}), retry #{attempts} in {delay:.0f}s")
+    outbox.retry_later(item_id, attempts, time.time() + delay)
+    schedule_notification(item_id, chat_id, rendered, attempts, delay, trace, progress)
+
+
+class DigestItem(NamedTuple):
+    """Запись outbox, ждущая в окне дайджеста."""
+
+    item_id: int
+    rendered: RenderedEmail
+    attempts: int
+    trace: Optional[EmailTrace]
+
+
+class DigestBuffer:
+    """
+    Окна склейки уведомлений для чатов с дайджестом. Первое уведомление чата
+    запускает таймер на окно этого чата; всё, что придёт до срабатывания,
+    уходит в flush(chat_id, items) одной пачкой (по порядку записей outbox).
+
+    Таймер и flush задаёт движок: scheduler в bot.py, event loop в bot_async.py.
+    """
+
+    def __init__(
+        self,
+        call_later: Callable[[float, Callable[[], None]], Any],
+        flush: Callable[[int, List[DigestItem]], None],
+    ) -> None:
+        self._call_later = call_later
+        self._flush = flush
+        self._lock = threading.Lock()
+        self._pending: Dict[int, List[DigestItem]] = {}
+
+    def add(self, chat_id: int, window: float, item: DigestItem) -> None:
+        with self._lock:
+            items = self._pending.get(chat_id)
+            if items is not None:
+                items.append(item)
+                return
+            self._pending[chat_id] = [item]
+        self._call_later(window, partial(self._fire, chat_id))
+
+    def _fire(self, chat_id: int) -> None:
+        with self._lock:
+            items = self._pending.pop(chat_id, [])
+        if items:
+            items.sort(key=lambda item: item.item_id)
+            self._flush(chat_id, items)
+
+    def pending(self) -> int:
+        with self._lock:
+            return sum(len(items) for items in self._pending.values())
+
+
+DIGEST_MESSAGES = Counter("bot_digest_messages_total", "Digest messages sent")
+DIGEST_EMAILS = Counter("bot_digest_emails_total", "Notifications merged into digest messages")
+
+
+def deliver_digest(chat_id: int, items: List[DigestItem], progress: Optional[SendProgress] = None) -> None:
+    """
+    Отправить уведомления, накопленные за окно дайджеста: одно — обычным
+    сообщением, несколько — дайджестами по DIGEST_MAX_ITEMS писем.
+    """
+    progress = progress or SendProgress()
+    if len(items) == 1:
+        item = items[0]
+        deliver_notification(item.item_id, chat_id, item.rendered, item.attempts, item.trace, progress)
+        return
+
+    for idx, start in enumerate(range(0, len(items), DIGEST_MAX_ITEMS)):
+        if idx < progress.sent:
+            continue
+        batch = items[start:start + DIGEST_MAX_ITEMS]
+        text, reply_markup = render_digest([item.rendered for item in batch])
+        try:
+            tg_send_message(chat_id, text, reply_markup=reply_markup)
+        except ChatBusy:
+            raise
+        except Exception as e:
+            progress.sent = idx + 1
+            for item in batch:
+                notification_failed(item.item_id, chat_id, item.rendered, item.attempts, item.trace, e)
+            continue
+        progress.sent = idx + 1
+
+        outbox.done(*(item.item_id for item in batch))
+        DIGEST_MESSAGES.inc()
+        DIGEST_EMAILS.inc(len(batch))
+        for item in batch:
+            if item.trace is not None:
+                tracer.record(item.trace, chat_id, item.attempts)
+
+
+digests = DigestBuffer(
+    scheduler.call_later,
+    lambda chat_id, items: dispatcher.submit(chat_id, partial(deliver_digest, chat_id, items, SendProgress())),
+)
+CallbackMetric("bot_digest_pending", "Notifications waiting for their digest window", "gauge", digests.pending)
+
+
+def schedule_notification(
+    item_id: int,
+    chat_id: int,
+    rendered: RenderedEmail,
+    attempts: int,
+    delay: float = 0.0,
+    trace: Optional[EmailTrace] = None,
+    progress: Optional[SendProgress] = None,
+) -> None:
+    """
+    Поставить запись outbox в рассылку (сразу или через delay секунд).
+    У чатов с дайджестом запись сначала ждёт в окне склейки — кроме
+    недоотправленной: её начало уже в чате, и она дослается как есть.
+    """
+    if delay > 0:
+        scheduler.call_later(
+            delay, partial(schedule_notification, item_id, chat_id, rendered, attempts, 0.0, trace, progress)
+        )
+        return
+
+    progress = progress or SendProgress()
+    window = get_chat_config(chat_id).digest
+    if window > 0 and not progress.sent:
+        digests.add(chat_id, window, DigestItem(item_id, rendered, attempts, trace))
+        return
+    dispatcher.submit(chat_id, partial(deliver_notification, item_id, chat_id, rendered, attempts, trace, progress))
 
-    bot.send_message(chat_id, header, reply_markup=reply_markup)
 
-    max_chunk = 3500
-    text = body_text if body_text else "[Письмо без текста]"
+def enqueue_notifications(
+    source: str,
+    uid: str,
+    rendered: RenderedEmail,
+    chat_ids: List[int],
+    trace: Optional[EmailTrace] = None,
+) -> None:
+    """Записать уведомления в outbox и сразу отдать их в рассылку."""
+    if not chat_ids:
+        return
+    for item_id, chat_id in outbox.add(source, uid, rendered, chat_ids):
+        schedule_notification(item_id, chat_id, rendered, 0, trace=trace)
+
+
+def resume_outbox() -> None:
+    """После перезапуска доотправить всё, что осталось в outbox."""
+    try:
+        items = outbox.pending()
+    except sqlite3.Error as e:
+        print("resume_outbox error:", e)
+        return
 
-    start = 0
-    while start < len(text):
-        chunk = text[start:start + max_chunk]
-        start += max_chunk
-        chunk_html = "<pre>" + escape_html(chunk) + "</pre>"
-        bot.send_message(chat_id, chunk_html)
+    now = time.time()
+    for item_id, chat_id, rendered, attempts, next_try in items:
+        schedule_notification(item_id, chat_id, rendered, attempts, next_try - now)
+    if items:
+        print(f"[outbox] resumed {len(items)} pending notifications")
 
 
 def get_source_info(source: str) -> Tuple[str, str]:
@@ -625,15 +2802,124 @@ def make_source_keyboard() -> InlineKeyboardMarkup:
     return kb
 
 
+class SingleFlight:
+    """
+    Пул потоков для IMAP-запросов от кнопок со схлопыванием одинаковых:
+    пока задача с ключом выполняется, повторные submit() с тем же ключом
+    получают тот же Future, а не качают письмо ещё раз.
+    """
+
+    def __init__(self, workers: int) -> None:
+        self._executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="fetch")
+        self._lock = threading.Lock()
+        self._inflight: Dict[Tuple[str, ...], "Future[Any]"] = {}
+
+    def submit(self, key: Tuple[str, ...], fn: Callable[[], Any]) -> "Future[Any]":
+        """key[0] — вид запроса ("list" / "mail"), для метрики."""
+        with self._lock:
+            future = self._inflight.get(key)
+            if future is not None:
+                CALLBACK_FETCHES_MERGED.inc(kind=key[0])
+                return future
+            future = self._executor.submit(fn)
+            self._inflight[key] = future
+        future.add_done_callback(lambda f: self._forget(key, f))
+        return future
+
+    def _forget(self, key: Tuple[str, ...], future: "Future[Any]") -> None:
+        with self._lock:
+            if self._inflight.get(key) is future:
+                del self._inflight[key]
+
+    def inflight(self) -> int:
+        with self._lock:
+            return len(self._inflight)
+
+
+mail_fetches = SingleFlight(CALLBACK_WORKERS)
+CallbackMetric("bot_callback_fetches_inflight", "IMAP fetches started by buttons and not finished yet", "gauge",
+               mail_fetches.inflight)
+
+
+# Ответы на кнопки: свой диспетчер, чтобы не стоять в очередях рассылки за
+# уведомлениями; ответы одного чата по-прежнему идут по одному
+reply_dispatcher = NotificationDispatcher(REPLY_WORKERS, name="reply")
+CallbackMetric("bot_reply_queue_depth", "Button replies waiting to be sent", "gauge", reply_dispatcher.pending)
+
+
+def reply_when_done(
+    chat_id: int,
+    future: "Future[Any]",
+    send: Callable[[Any, SendProgress], None],
+    error_text: str,
+) -> None:
+    """
+    Когда future готов, отправить ответ в чат. Отправка идёт в reply_dispatcher,
+    чтобы поток IMAP-пула не ждал Telegram, а ответ — рассылку уведомлений.
+    send(result, progress) должна продолжать с места, где остановился progress:
+    задание, отложенное на ChatBusy, запускается заново.
+    """
+    progress = SendProgress()
+
+    def job() -> None:
+        try:
+            result = future.result()
+        except Exception as e:
+            print(f"[fetch] error for chat {chat_id}:", e)
+            progress.step(0, partial(tg_send_message, chat_id, error_text))
+            return
+        send(result, progress)
+
+    future.add_done_callback(lambda _: reply_dispatcher.submit(chat_id, job))
+
+
 def show_mail_list(chat_id: int, source: str) -> None:
-    title, from_email = get_source_info(source)
+    """Список писем источника в чат. Не ждёт IMAP: ответ придёт из пула."""
+    _, from_email = get_source_info(source)
+
+    bot.send_chat_action(chat_id, "typing")
+
+    def send(mails: List[Dict[str, str]], progress: SendProgress) -> None:
+        text, kb = build_mail_list(source, mails)
+        progress.step(0, partial(tg_send_message, chat_id, text, reply_markup=kb))
 
+    future = mail_fetches.submit(("list", source), partial(list_last_emails, from_email, MAILS_LIMIT))
+    reply_when_done(chat_id, future, send, "Не удалось получить список писем.")
+
+
+def show_email(chat_id: int, source: str, uid: str) -> None:
+    """Письмо целиком в чат. Не ждёт IMAP: ответ придёт из пула."""
     bot.send_chat_action(chat_id, "typing")
 
-    mails = list_last_emails(from_email, limit=MAILS_LIMIT)
+    def send(
+        result: Tuple[Optional[str], Optional[str], Optional[str], Optional[str]], progress: SendProgress
+    ) -> None:
+        subject, from_, date, body = result
+        if not subject:
+            progress.step(0, partial(tg_send_message, chat_id, "Не удалось прочитать письмо."))
+            return
+        send_email_pretty(
+            chat_id=chat_id,
+            source=source,
+            subject=subject or "",
+            from_=from_ or "",
+            date=date or "",
+            body_text=body or "",
+            uid=uid,
+            progress=progress,
+        )
+
+    future = mail_fetches.submit(("mail", source, uid), partial(get_email_by_uid, uid))
+    reply_when_done(chat_id, future, send, "Не удалось прочитать письмо.")
+
+
+def build_mail_list(
+    source: str, mails: List[Dict[str, str]]
+) -> Tuple[str, Optional[InlineKeyboardMarkup]]:
+    """Текст и кнопки списка писем для /mails."""
+    title, from_email = get_source_info(source)
     if not mails:
-        bot.send_message(chat_id, f"Писем от <b>{escape_html(from_email)}</b> не найдено.")
-        return
+        return f"Писем от <b>{escape_html(from_email)}</b> не найдено.", None
 
     kb = InlineKeyboardMarkup(row_width=1)
     lines = [f"<b>Последние письма с {escape_html(title)}:</b>\n"]
@@ -653,129 +2939,385 @@ def show_mail_list(chat_id: int, source: str) -> None:
 
         lines.append(f"{idx}. {escape_html(short_subject)}")
 
-    text = "\n".join(lines)
-    bot.send_message(chat_id, text, reply_markup=kb)
+    return "\n".join(lines), kb
 
 
 # ======================= ВОТЧЕР ПОЧТЫ =======================
 
+def source_for_sender(from_header: Optional[str]) -> Optional[str]:
+    """Определить источник по заголовку From."""
+    addr = parseaddr(from_header or "")[1].lower()
+    source = SENDER_TO_SOURCE.get(addr)
+    if source is None and addr:
+        # FROM в IMAP ищет по подстроке, так что и здесь допускаем частичное совпадение
+        for sender, src in SENDER_TO_SOURCE.items():
+            if sender in addr:
+                return src
+    return source
+
+
+def build_sources_search(senders: List[str]) -> str:
+    """Критерий поиска по всем отправителям сразу: OR FROM a OR FROM b FROM c."""
+    keys = [f'FROM "{sender}"' for sender in senders]
+    criteria = keys[-1]
+    for key in reversed(keys[:-1]):
+        criteria = f"OR {key} {criteria}"
+    return criteria
+
+
+SOURCES_SEARCH = build_sources_search(list(SOURCES.values()))
+
+
+def load_watcher_state() -> Dict[str, Tuple[int, int]]:
+    """Чекпоинт вотчера из JSON-файла: {source: (uidvalidity, last_uid)}."""
+    if not os.path.exists(WATCHER_STATE_FILE):
+        return {}
+
+    try:
+        with open(WATCHER_STATE_FILE, "r", encoding="utf-8") as f:
+            raw = json.load(f)
+    except Exception as e:
+        print("load_watcher_state error:", e)
+        return {}
+
+    state: Dict[str, Tuple[int, int]] = {}
+    for source, cp in raw.items():
+        try:
+            state[source] = (int(cp["uidvalidity"]), int(cp["last_uid"]))
+        except (KeyError, TypeError, ValueError):
+            continue
+    return state
+
+
+def save_watcher_state() -> None:
+    """Атомарно сохранить чекпоинт вотчера (через временный файл)."""
+    if mailbox_uidvalidity is None:
+        return
+
+    to_save = {
+        source: {"uidvalidity": mailbox_uidvalidity, "last_uid": last}
+        for source, last in last_uids.items()
+        if last is not None
+    }
+    try:
+        tmp_file = WATCHER_STATE_FILE + ".tmp"
+        with open(tmp_file, "w", encoding="utf-8") as f:
+            json.dump(to_save, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, WATCHER_STATE_FILE)
+    except Exception as e:
+        print("save_watcher_state error:", e)
+
+
 def init_last_uids() -> None:
-    """При старте просто запоминаем последнюю почту по каждому источнику."""
-    global last_uids
+    """
+    При старте продолжаем с сохранённого чекпоинта, чтобы не потерять письма,
+    пришедшие, пока бот был выключен. Если чекпоинта нет или UIDVALIDITY ящика
+    сменилась, берём границу ящика (UIDNEXT - 1): всё, что придёт позже, — новое.
+    """
     try:
-        imap = get_imap_connection()
-        status, _ = imap.select("INBOX")
-        if status != "OK":
-            imap.logout()
+        with imap_pool.session() as imap:
+            uidvalidity, uidnext = get_mailbox_status(imap)
+        if uidnext is None:
             return
+        restore_last_uids(uidvalidity, uidnext)
+    except Exception as e:
+        print("init_last_uids error:", e)
 
-        for source, sender in SOURCES.items():
-            search_criteria = f'(FROM "{sender}")'
-            status, data = imap.uid("search", None, search_criteria)
-            if status == "OK" and data and data[0]:
-                uids = data[0].split()
-                if uids:
-                    last_uids[source] = int(uids[-1])
-                    print(f"[watcher] init {source} last_uid = {last_uids[source]}")
 
-        imap.close()
-        imap.logout()
+def restore_last_uids(uidvalidity: Optional[int], uidnext: int) -> None:
+    """Выставить last_uids по чекпоинту и ответу STATUS (см. init_last_uids())."""
+    global mailbox_uidvalidity
+    saved = load_watcher_state()
+    for source in SOURCES:
+        checkpoint = saved.get(source)
+        if checkpoint is not None and checkpoint[0] == uidvalidity:
+            last_uids[source] = min(checkpoint[1], uidnext - 1)
+            print(f"[watcher] init {source} last_uid = {last_uids[source]} (checkpoint)")
+        else:
+            if checkpoint is not None:
+                print(f"[watcher] {source}: UIDVALIDITY changed, resync")
+            last_uids[source] = uidnext - 1
+            print(f"[watcher] init {source} last_uid = {last_uids[source]}")
+
+    mailbox_uidvalidity = uidvalidity
+    save_watcher_state()
+
+
+def check_new_mail() -> None:
+    """
+    Одна проверка почты: ищет новые письма и раскидывает уведомления по чатам.
+
+    Независимо от числа источников это NOOP, один UID SEARCH по всем
+    отправителям сразу и (если есть новые письма) один FETCH их заголовков From.
+    """
+    global last_uids, mailbox_uidvalidity
+
+    if not chat_registry.subscribed_count():
+        # Никто не подписан — можно не дергать Gmail
+        return
+
+    with imap_pool.session() as imap:
+        # NOOP подтягивает от сервера EXISTS по только что пришедшим письмам
+        with IMAP_COMMAND_SECONDS.time(command="noop"):
+            imap.noop()
+
+        if (
+            imap_pool.uidvalidity is not None
+            and mailbox_uidvalidity is not None
+            and imap_pool.uidvalidity != mailbox_uidvalidity
+        ):
+            # Ящик пересоздан — старые UID ничего не значат
+            print("[watcher] UIDVALIDITY changed, resync")
+            for source in last_uids:
+                last_uids[source] = None
+
+        if any(last is None for last in last_uids.values()):
+            uidvalidity, uidnext = get_mailbox_status(imap)
+            if uidnext is None:
+                return
+            for source, last in last_uids.items():
+                if last is None:
+                    last_uids[source] = uidnext - 1
+                    print(f"[watcher] {source}: last_saved=None, set to {last_uids[source]}")
+            mailbox_uidvalidity = uidvalidity
+            save_watcher_state()
+            return
+
+        # Ищем только среди писем новее последнего увиденного,
+        # а не по всей истории отправителей
+        floor = min(uid for uid in last_uids.values() if uid is not None)
+        search_criteria = f"(UID {floor + 1}:* {SOURCES_SEARCH})"
+        status, data = imap_uid(imap, "search", None, search_criteria)
+        if status != "OK" or not data or not data[0]:
+            return
+
+        # "N:*" всегда включает последнее письмо ящика, даже если его UID < N
+        uids = sorted(u for u in map(int, data[0].split()) if u > floor)
+        if not uids:
+            return
+
+        internaldates: Dict[str, float] = {}
+        headers = fetch_header_fields(imap, [str(u) for u in uids], "FROM", internaldates)
+        if headers is None:
+            # Не сдвигаем last_uids: следующий тик найдёт эти письма снова
+            return
+        detected = time.time()
+        new_by_source = group_new_uids(uids, headers)
+
+        for source in SOURCE_ORDER:
+            new_uids = new_by_source.get(source)
+            sender = SOURCES[source]
+            if new_uids:
+                print(f"[watcher] {source} new_uids: {new_uids}")
+                NEW_EMAILS.inc(len(new_uids), source=source)
+                email_cache.invalidate_lists(sender)
+                for u in new_uids:
+                    uid_str = str(u)
+                    trace = EmailTrace(source, uid_str, internaldates.get(uid_str), detected)
+                    # Для уведомления хватает начала письма; целиком его
+                    # скачает кнопка «Показать полностью»
+                    preview = fetch_email_preview(imap, uid_str)
+                    trace.parsed = time.time()
+                    rendered = prepare_notification(source, uid_str, preview, trace)
+                    if rendered is not None:
+                        recipients = list(chat_registry.subscribers(source))
+
+                        # Сначала outbox, потом сдвиг last_uids: письмо не потеряется,
+                        # даже если процесс упадёт посреди рассылки
+                        enqueue_notifications(source, uid_str, rendered, recipients, trace)
+
+                    last_uids[source] = u
+                    save_watcher_state()
+
+        # Поиск шёл сразу по всем отправителям, так что все источники
+        # просмотрены до одного и того же UID
+        for source in last_uids:
+            last_uids[source] = max(last_uids[source] or 0, uids[-1])
+
+    save_watcher_state()
+
+
+def group_new_uids(uids: List[int], headers: Dict[str, Message]) -> Dict[str, List[int]]:
+    """Раскидать найденные UID по источникам (по From), отбросив уже виденные."""
+    new_by_source: Dict[str, List[int]] = {}
+    for u in uids:
+        msg = headers.get(str(u))
+        if msg is None:
+            continue
+        source = source_for_sender(msg.get("From"))
+        if source is None or u <= (last_uids.get(source) or 0):
+            continue
+        new_by_source.setdefault(source, []).append(u)
+    return new_by_source
+
+
+def prepare_notification(
+    source: str,
+    uid: str,
+    preview: Tuple[Optional[str], Optional[str], Optional[str], Optional[str], bool],
+    trace: EmailTrace,
+    uidvalidity: Optional[int] = None,
+) -> Optional[RenderedEmail]:
+    """
+    Результат fetch_email_preview() -> уведомление (None, если письмо не прочиталось).
+    Необрезанное письмо заодно кладётся в кэш и хранилище, у обрезанного
+    сохраняются только заголовки — текст допишется, когда письмо откроют.
+    """
+    subject, from_, date, body, truncated = preview
+    if not truncated:
+        store_email(uid, (subject, from_, date, body), uidvalidity)
+    else:
+        if uidvalidity is None:
+            uidvalidity = imap_pool.uidvalidity
+        if subject is not None and uidvalidity is not None:
+            mail_store.put_headers(uidvalidity, [(int(uid), subject, from_ or "", date or "")])
+    if not subject:
+        return None
+
+    # Собираем уведомление один раз, в чаты уходит одна и та же копия
+    rendered = render_email(
+        source=source,
+        subject=subject or "",
+        from_=from_ or SOURCES[source],
+        date=date or "",
+        body_text=body or "",
+        uid=uid,
+        as_notification=True,
+        truncated=truncated,
+    )
+    trace.rendered = time.time()
+    return rendered
+
+
+def run_mail_check() -> None:
+    """check_new_mail(), который не роняет вотчер при ошибках."""
+    try:
+        with WATCHER_TICK_SECONDS.time():
+            check_new_mail()
     except Exception as e:
-        print("init_last_uids error:", e)
+        WATCHER_ERRORS.inc()
+        print("watcher_loop error:", e)
 
 
-def watcher_loop(poll_interval: int = 5) -> None:
-    """Фоновый цикл: проверяет новые письма и раскидывает уведомления по чатам."""
-    global last_uids
+_IDLE_EXISTS_RE = re.compile(rb"^\* \d+ EXISTS", re.IGNORECASE)
 
-    init_last_uids()
 
-    while True:
-        try:
-            with chat_ids_lock:
-                targets = list(chat_ids)
+def imap_has_buffered(imap: imaplib.IMAP4) -> bool:
+    """
+    Есть ли ответ сервера, который уже прочитан из сокета в буфер imap.file
+    (например, EXISTS пришёл одним пакетом с "+ idling"). select() его не видит.
+    """
+    sock = imap.sock
+    timeout = sock.gettimeout()
+    sock.setblocking(False)
+    try:
+        return bool(imap.file.peek(1))
+    except (BlockingIOError, ssl.SSLWantReadError):
+        return False
+    finally:
+        sock.settimeout(timeout)
+
+
+def imap_idle_wait(imap: imaplib.IMAP4, timeout: float) -> bool:
+    """
+    Одна команда IDLE (RFC 2177) на сессии с выбранным INBOX.
 
-            if not targets:
-                # Никто не подписан — можно не дергать Gmail
-                time.sleep(poll_interval)
+    Ждёт до timeout секунд, пока сервер не пришлёт EXISTS, затем завершает
+    IDLE через DONE. Возвращает True, если в ящике появились новые письма.
+    """
+    tag = imap._new_tag()
+    imap.send(tag + b" IDLE\r\n")
+    line = imap.readline()
+    if not line.startswith(b"+"):
+        imap.tagged_commands.pop(tag, None)
+        raise imaplib.IMAP4.error(f"IDLE rejected: {line!r}")
+
+    has_new = False
+    sock = imap.sock
+    deadline = time.monotonic() + timeout
+    while not has_new:
+        left = deadline - time.monotonic()
+        if left <= 0:
+            break
+        # У TLS-сокета расшифрованные данные могут уже лежать в буфере
+        pending = getattr(sock, "pending", None)
+        if not (pending and pending()) and not imap_has_buffered(imap):
+            ready, _, _ = select.select([sock], [], [], left)
+            if not ready:
                 continue
+        line = imap.readline()
+        if not line or line.startswith(b"* BYE"):
+            raise imaplib.IMAP4.abort("connection closed during IDLE")
+        if _IDLE_EXISTS_RE.match(line):
+            has_new = True
+
+    imap.send(b"DONE\r\n")
+    while True:
+        line = imap.readline()
+        if not line:
+            raise imaplib.IMAP4.abort("connection closed after IDLE")
+        if line.startswith(tag):
+            break
+        if _IDLE_EXISTS_RE.match(line):
+            has_new = True
+    imap.tagged_commands.pop(tag, None)
+
+    if not line.startswith(tag + b" OK"):
+        raise imaplib.IMAP4.error(f"IDLE failed: {line!r}")
+    return has_new
 
-            print(f"[watcher] check, targets={targets}")
 
+def idle_watcher_loop(poll_interval: int = 5) -> None:
+    """
+    Вотчер на IMAP IDLE: держит отдельную сессию на INBOX и проверяет почту,
+    как только сервер сообщает о новом письме. IDLE перевыставляется каждые
+    IMAP_IDLE_RENEW секунд, чтобы сервер не оборвал его по 29-минутному таймауту.
+
+    Возвращается, только если сервер не поддерживает IDLE.
+    """
+    while True:
+        imap = None
+        try:
             imap = get_imap_connection()
+            if "IDLE" not in imap.capabilities:
+                print("[watcher] сервер не поддерживает IDLE, работаем опросом")
+                return
+
             status, _ = imap.select("INBOX")
             if status != "OK":
-                imap.logout()
-                time.sleep(poll_interval)
-                continue
+                raise imaplib.IMAP4.error("INBOX select failed")
+            print("[watcher] IDLE-сессия открыта")
+
+            # Письма, пришедшие, пока IDLE-сессии не было
+            run_mail_check()
+            while True:
+                if imap_idle_wait(imap, IMAP_IDLE_RENEW):
+                    run_mail_check()
+        except Exception as e:
+            print("idle_watcher_loop error:", e)
+        finally:
+            if imap is not None:
+                close_imap_connection(imap)
 
-            for source, sender in SOURCES.items():
-                search_criteria = f'(FROM "{sender}")'
-                status, data = imap.uid("search", None, search_criteria)
-                if status != "OK" or not data or not data[0]:
-                    continue
+        time.sleep(poll_interval)
 
-                uids = data[0].split()
-                if not uids:
-                    continue
 
-                uids_int = sorted(int(u) for u in uids)
-                last_saved = last_uids.get(source)
-                new_uids: List[int] = []
+def watcher_loop(poll_interval: int = 5, use_idle: bool = IMAP_USE_IDLE) -> None:
+    """
+    Фоновый цикл: проверяет новые письма и раскидывает уведомления по чатам.
 
-                if last_saved is None:
-                    last_uids[source] = uids_int[-1]
-                    print(f"[watcher] {source}: last_saved=None, set to {last_uids[source]}")
-                else:
-                    for u in uids_int:
-                        if u > last_saved:
-                            new_uids.append(u)
-                    if uids_int:
-                        last_uids[source] = uids_int[-1]
-
-                if new_uids:
-                    print(f"[watcher] {source} new_uids: {new_uids}")
-                    for u in new_uids:
-                        uid_str = str(u)
-                        subject, from_, date, body = get_email_by_uid(uid_str)
-                        if not subject:
-                            continue
-                        try:
-                            for chat_id in targets:
-                                cfg = get_chat_config(chat_id)
-                                if not cfg.get("notifications", True):
-                                    continue
-                                enabled_sources = set(
-                                    cfg.get("sources", list(SOURCES.keys()))
-                                )
-                                if source not in enabled_sources:
-                                    continue
-
-                                try:
-                                    send_email_pretty(
-                                        chat_id=chat_id,
-                                        source=source,
-                                        subject=subject or "",
-                                        from_=from_ or sender,
-                                        date=date or "",
-                                        body_text=body or "",
-                                        uid=uid_str,
-                                        as_notification=True,
-                                    )
-                                except Exception as send_err:
-                                    print(
-                                        f"[watcher] Error sending notification to chat {chat_id}:",
-                                        send_err,
-                                    )
-                        except Exception as e:
-                            print("[watcher] Error sending notification:", e)
-
-            imap.close()
-            imap.logout()
+    При use_idle сначала пробует IDLE-режим; если сервер его не умеет,
+    опрашивает почту каждые poll_interval секунд.
+    """
+    init_last_uids()
 
-        except Exception as e:
-            print("watcher_loop error:", e)
+    if use_idle:
+        idle_watcher_loop(poll_interval)
 
+    while True:
+        run_mail_check()
         time.sleep(poll_interval)
 
 
@@ -791,7 +3333,12 @@ def handle_start(message):
     ensure_chat_config(chat_id, title=title, chat_type=chat_type)
     set_chat_notifications(chat_id, True)
 
-    text = (
+    bot.reply_to(message, build_start_text(), reply_markup=make_source_keyboard())
+
+
+def build_start_text() -> str:
+    """Текст /start и /help."""
+    return (
         "👋 <b>Привет!</b>\n\n"
         "Я бот <b>memes4u1337</b>. Слежу за почтой Gmail "
         "и отправляю письма/уведомления сюда — в этот чат (может быть и группа).\n\n"
@@ -808,8 +3355,6 @@ def handle_start(message):
         "➤ <b>/stop</b> — быстро выключить уведомления в чате.\n"
     )
 
-    bot.reply_to(message, text, reply_markup=make_source_keyboard())
-
 
 @bot.message_handler(commands=["mails", "lastmail"])
 def handle_mails(message):
@@ -846,17 +3391,37 @@ def handle_status(message):
     bot.reply_to(message, txt)
 
 
+@bot.message_handler(commands=["lag"])
+def handle_lag(message):
+    """/lag [минут] — задержки доставки уведомлений (только для ADMIN_IDS)."""
+    if message.from_user is None or message.from_user.id not in ADMIN_IDS:
+        bot.reply_to(message, "⛔ Команда только для админов бота.")
+        return
+
+    bot.reply_to(message, build_lag_text(parse_lag_minutes(message.text)))
+
+
+def parse_lag_minutes(text: Optional[str]) -> int:
+    """/lag [минут] -> окно в минутах (по умолчанию 60)."""
+    parts = (text or "").split()
+    if len(parts) > 1 and parts[1].isdigit():
+        return max(1, int(parts[1]))
+    return 60
+
+
 @bot.message_handler(commands=["chatid"])
 def handle_chatid(message):
-    chat = message.chat
-    chat_id = chat.id
-    text = (
+    bot.reply_to(message, build_chatid_text(message.chat))
+
+
+def build_chatid_text(chat: Any) -> str:
+    """Текст /chatid."""
+    return (
         f"🧾 <b>ID этого чата:</b>\n"
-        f"<code>{chat_id}</code>\n\n"
+        f"<code>{chat.id}</code>\n\n"
         f"Тип: <b>{chat.type}</b>\n"
         f"Название / username: <code>{escape_html(chat.title or chat.username or '')}</code>"
     )
-    bot.reply_to(message, text)
 
 
 @bot.message_handler(commands=["testnotify"])
@@ -864,30 +3429,36 @@ def handle_testnotify(message):
     """Тестовое уведомление в ТЕКУЩИЙ чат, тем же механизмом, что и вотчер."""
     chat_id = message.chat.id
     try:
-        send_email_pretty(
-            chat_id=chat_id,
-            source="kwork",
-            subject="Тестовое уведомление",
-            from_="test@example.com",
-            date=time.strftime("%Y-%m-%d %H:%M:%S"),
-            body_text="Это тестовое уведомление, отправленное командой /testnotify.",
-            uid=None,
-            as_notification=True,
-        )
+        send_rendered(chat_id, render_test_notification())
     except Exception as e:
         print(f"[testnotify] error sending to chat {chat_id}:", e)
         bot.reply_to(message, f"Ошибка при отправке тестового уведомления: <code>{escape_html(str(e))}</code>")
 
 
+def render_test_notification() -> RenderedEmail:
+    """Письмо для /testnotify."""
+    return render_email(
+        source="kwork",
+        subject="Тестовое уведомление",
+        from_="test@example.com",
+        date=time.strftime("%Y-%m-%d %H:%M:%S"),
+        body_text="Это тестовое уведомление, отправленное командой /testnotify.",
+        uid=None,
+        as_notification=True,
+    )
+
+
+STOP_TEXT = (
+    "🔕 Уведомления для этого чата выключены.\n"
+    "Включить обратно — /settings (кнопка «Уведомления») или снова /start."
+)
+
+
 @bot.message_handler(commands=["stop"])
 def handle_stop(message):
     chat_id = message.chat.id
     set_chat_notifications(chat_id, False)
-    bot.reply_to(
-        message,
-        "🔕 Уведомления для этого чата выключены.\n"
-        "Включить обратно — /settings (кнопка «Уведомления») или снова /start.",
-    )
+    bot.reply_to(message, STOP_TEXT)
 
 
 # ======================= CALLBACK-КНОПКИ =======================
@@ -905,58 +3476,17 @@ def handle_mail_choice(call):
     title, _ = get_source_info(source)
 
     bot.answer_callback_query(call.id, f"Открываю письмо с {title}…")
-    bot.send_chat_action(call.message.chat.id, "typing")
-
-    subject, from_, date, body = get_email_by_uid(uid)
-    if not subject:
-        bot.send_message(call.message.chat.id, "Не удалось прочитать письмо.")
-        return
-
-    send_email_pretty(
-        chat_id=call.message.chat.id,
-        source=source,
-        subject=subject or "",
-        from_=from_ or "",
-        date=date or "",
-        body_text=body or "",
-        uid=uid,
-    )
+    show_email(call.message.chat.id, source, uid)
 
 
 @bot.callback_query_handler(func=lambda c: c.data and c.data.startswith("cfg:"))
 def handle_settings_callback(call):
     chat_id = call.message.chat.id
-    data = call.data.split(":")
-
-    if len(data) < 2:
-        bot.answer_callback_query(call.id, "Неизвестное действие.")
-        return
-
-    action = data[1]
-
-    if action == "src" and len(data) == 3:
-        source = data[2]
-        enabled = toggle_chat_source(chat_id, source)
-        meta = SOURCE_META.get(source, {"name": source})
-        name = meta["name"]
-        bot.answer_callback_query(
-            call.id,
-            f"{'Включено' if enabled else 'Выключено'}: {name}",
-            show_alert=False,
-        )
-    elif action == "notify":
-        cfg = get_chat_config(chat_id)
-        now = bool(cfg.get("notifications", True))
-        new_state = not now
-        set_chat_notifications(chat_id, new_state)
-        bot.answer_callback_query(
-            call.id,
-            f"Уведомления: {'ВКЛ' if new_state else 'ВЫКЛ'}",
-            show_alert=False,
-        )
-    else:
+    answer = apply_settings_action(chat_id, call.data)
+    if answer is None:
         bot.answer_callback_query(call.id, "Неизвестное действие.")
         return
+    bot.answer_callback_query(call.id, answer, show_alert=False)
 
     # Перерисовываем сообщение с актуальными настройками
     try:
@@ -973,22 +3503,193 @@ def handle_settings_callback(call):
         print("edit settings message error:", e)
 
 
+def apply_settings_action(chat_id: int, data: str) -> Optional[str]:
+    """
+    Кнопка из /settings (cfg:src:<source> / cfg:notify / cfg:digest) -> текст для всплывашки.
+    None — действие неизвестно, настройки не менялись.
+    """
+    parts = data.split(":")
+    if len(parts) < 2:
+        return None
+
+    action = parts[1]
+    if action == "src" and len(parts) == 3:
+        source = parts[2]
+        enabled = toggle_chat_source(chat_id, source)
+        meta = SOURCE_META.get(source, {"name": source})
+        return f"{'Включено' if enabled else 'Выключено'}: {meta['name']}"
+    if action == "notify":
+        new_state = not get_chat_config(chat_id).notifications
+        set_chat_notifications(chat_id, new_state)
+        return f"Уведомления: {'ВКЛ' if new_state else 'ВЫКЛ'}"
+    if action == "digest":
+        return f"Дайджест: {format_digest_window(cycle_chat_digest(chat_id))}"
+    return None
+
+
+# ======================= ВЕБХУК =======================
+
+WEBHOOK_REQUESTS = Counter("bot_webhook_requests_total", "Webhook HTTP requests by result", ("result",))
+UPDATE_SECONDS = Histogram("bot_update_seconds", "Time to process one Telegram update (webhook mode)")
+# Апдейт от Telegram — несколько килобайт; больше — точно не он
+WEBHOOK_MAX_BODY = 1024 * 1024
+
+
+def update_chat_id(update: telebot.types.Update) -> int:
+    """Чат, к которому относится апдейт (у апдейтов без чата — update_id)."""
+    if update.message is not None:
+        return update.message.chat.id
+    if update.callback_query is not None and update.callback_query.message is not None:
+        return update.callback_query.message.chat.id
+    return update.update_id
+
+
+class UpdateDispatcher:
+    """
+    Обработка апдейтов вебхука пулом потоков: как NotificationDispatcher,
+    апдейты одного чата всегда попадают в один поток и идут по порядку,
+    а разные чаты обрабатываются параллельно.
+
+    Очереди ограничены: если всё забито, submit() возвращает False,
+    вебхук отвечает 503 и Telegram повторит запрос позже.
+    """
+
+    def __init__(self, workers: int, queue_size: int) -> None:
+        workers = max(1, workers)
+        self._queues: List["queue.Queue[telebot.types.Update]"] = [
+            queue.Queue(maxsize=max(1, queue_size // workers)) for _ in range(workers)
+        ]
+        self._started = False
+        self._start_lock = threading.Lock()
+
+    def _ensure_started(self) -> None:
+        with self._start_lock:
+            if self._started:
+                return
+            for idx, q in enumerate(self._queues):
+                threading.Thread(
+                    target=self._worker, args=(q,), name=f"update-{idx}", daemon=True
+                ).start()
+            self._started = True
+
+    def _worker(self, q: "queue.Queue[telebot.types.Update]") -> None:
+        while True:
+            update = q.get()
+            try:
+                with UPDATE_SECONDS.time():
+                    bot.process_new_updates([update])
+            except Exception as e:
+                print(f"[webhook] update {update.update_id} error:", e)
+            finally:
+                q.task_done()
+
+    def submit(self, update: telebot.types.Update) -> bool:
+        self._ensure_started()
+        try:
+            self._queues[hash(update_chat_id(update)) % len(self._queues)].put_nowait(update)
+        except queue.Full:
+            return False
+        return True
+
+    def pending(self) -> int:
+        return sum(q.qsize() for q in self._queues)
+
+
+update_dispatcher = UpdateDispatcher(WEBHOOK_WORKERS, WEBHOOK_QUEUE_SIZE)
+CallbackMetric("bot_webhook_queue_depth", "Updates waiting in the webhook queues", "gauge", update_dispatcher.pending)
+
+
+class _WebhookHandler(BaseHTTPRequestHandler):
+    # Telegram и reverse proxy держат соединения открытыми
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def _reply(self, status: int, result: str) -> None:
+        WEBHOOK_REQUESTS.inc(result=result)
+        self.send_response(status)
+        if status == 503:
+            self.send_header("Retry-After", "1")
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_POST(self) -> None:
+        try:
+            length = int(self.headers.get("Content-Length") or 0)
+        except ValueError:
+            length = -1
+        if length < 0 or length > WEBHOOK_MAX_BODY:
+            self.close_connection = True
+            self._reply(413, "too_large")
+            return
+        body = self.rfile.read(length)
+
+        if self.path.split("?", 1)[0] != WEBHOOK_PATH:
+            self._reply(404, "not_found")
+            return
+        token = self.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+        if not hmac.compare_digest(token.encode(), WEBHOOK_SECRET.encode()):
+            self._reply(403, "forbidden")
+            return
+
+        try:
+            update = telebot.types.Update.de_json(body.decode("utf-8"))
+        except Exception as e:
+            print("[webhook] bad update:", e)
+            self._reply(400, "bad_request")
+            return
+
+        # Отвечаем сразу, обработка — в пуле; Telegram не ждёт хендлеры
+        if not update_dispatcher.submit(update):
+            self._reply(503, "busy")
+            return
+        self._reply(200, "ok")
+
+    def log_message(self, format: str, *args: Any) -> None:
+        pass
+
+
+def make_webhook_server(host: str = WEBHOOK_HOST, port: int = WEBHOOK_PORT) -> ThreadingHTTPServer:
+    """HTTP-сервер вебхука (ещё не запущен: serve_forever() вызывает тот, кто создал)."""
+    # Хендлеры выполняются прямо в потоках UpdateDispatcher, а не в пуле telebot
+    bot.threaded = False
+    server = ThreadingHTTPServer((host, port), _WebhookHandler)
+    server.daemon_threads = True
+    return server
+
+
+def run_webhook() -> None:
+    """Поднять сервер, зарегистрировать WEBHOOK_URL в Telegram и обслуживать апдейты."""
+    server = make_webhook_server()
+    host, port = server.server_address[:2]
+    bot.set_webhook(
+        url=WEBHOOK_URL,
+        secret_token=WEBHOOK_SECRET,
+        max_connections=WEBHOOK_MAX_CONNECTIONS,
+        allowed_updates=["message", "callback_query"],
+        drop_pending_updates=True,
+    )
+    print(f"Бот запущен, вебхук {WEBHOOK_URL} -> http://{host}:{port}{WEBHOOK_PATH}")
+    server.serve_forever()
+
+
 # ======================= ЗАПУСК БОТА =======================
 
+BOT_COMMANDS = [
+    BotCommand("start", "Запуск бота и справка"),
+    BotCommand("help", "Справка по боту"),
+    BotCommand("mails", "Выбрать площадку и посмотреть письма"),
+    BotCommand("settings", "Настройки уведомлений и источников"),
+    BotCommand("status", "Статус мониторинга почты"),
+    BotCommand("chatid", "Показать ID этого чата"),
+    BotCommand("testnotify", "Тестовое уведомление в этот чат"),
+    BotCommand("stop", "Выключить уведомления в этом чате"),
+]
+
+
 def set_bot_commands() -> None:
     """Регистрируем команды, чтобы при вводе '/' Telegram их показывал."""
-    commands = [
-        BotCommand("start", "Запуск бота и справка"),
-        BotCommand("help", "Справка по боту"),
-        BotCommand("mails", "Выбрать площадку и посмотреть письма"),
-        BotCommand("settings", "Настройки уведомлений и источников"),
-        BotCommand("status", "Статус мониторинга почты"),
-        BotCommand("chatid", "Показать ID этого чата"),
-        BotCommand("testnotify", "Тестовое уведомление в этот чат"),
-        BotCommand("stop", "Выключить уведомления в этом чате"),
-    ]
     try:
-        bot.set_my_commands(commands)
+        bot.set_my_commands(BOT_COMMANDS)
         print("[bot] команды зарегистрированы")
     except Exception as e:
         print("set_my_commands error:", e)
@@ -999,6 +3700,8 @@ if __name__ == "__main__":
 
     load_chat_settings()
     set_bot_commands()
+    resume_outbox()
+    start_metrics_server()
 
     watcher_thread = threading.Thread(
         target=watcher_loop,
@@ -1007,5 +3710,10 @@ if __name__ == "__main__":
     )
     watcher_thread.start()
 
-    print("Бот запущен, начинаем polling...")
-    bot.infinity_polling(skip_pending=True)
+    if WEBHOOK_URL:
+        run_webhook()
+    else:
+        # Пока у бота висит вебхук, getUpdates отвечает 409
+        bot.remove_webhook()
+        print("Бот запущен, начинаем polling...")
+        bot.infinity_polling(skip_pending=True)
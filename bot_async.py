@@ -0,0 +1,1173 @@
+"""
+Асинхронный вариант бота: хендлеры, вотчер почты и рассылка живут в одном
+event loop (AsyncTeleBot + свой IMAP-клиент на asyncio streams).
+
+Настройки, хранилища, рендеринг писем и лимиты Telegram — общие с bot.py,
+отсюда отличается только ввод-вывод. Запуск вместо bot.py:
+
+    python bot_async.py
+
+Нужен aiohttp (его использует AsyncTeleBot).
+"""
+
+import asyncio
+import email
+import imaplib
+import io
+import os
+import re
+import ssl
+import time
+from contextlib import asynccontextmanager
+from functools import partial
+from email.message import Message
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+import telebot.asyncio_helper
+from telebot.async_telebot import AsyncTeleBot
+from telebot.asyncio_helper import ApiTelegramException
+
+import bot
+from bot import (
+    ADMIN_IDS,
+    BOT_COMMANDS,
+    BOT_TOKEN,
+    CALLBACK_FETCHES_MERGED,
+    CALLBACK_WORKERS,
+    DIGEST_EMAILS,
+    DIGEST_MAX_ITEMS,
+    DIGEST_MESSAGES,
+    GMAIL_APP_PASSWORD,
+    GMAIL_USER,
+    IMAP_BROKEN_SESSIONS,
+    IMAP_COMMAND_SECONDS,
+    IMAP_HOST,
+    IMAP_IDLE_RENEW,
+    IMAP_LOGIN_SECONDS,
+    IMAP_MAX_IDLE,
+    IMAP_NOOP_AFTER,
+    IMAP_POOL_SIZE,
+    IMAP_PORT,
+    IMAP_SSL,
+    IMAP_USE_IDLE,
+    MAILS_LIMIT,
+    NEW_EMAILS,
+    NOTIFY_PREVIEW_BYTES,
+    SOURCES,
+    SOURCES_SEARCH,
+    SOURCE_ORDER,
+    STOP_TEXT,
+    TG_API_URL,
+    TG_MAX_RETRIES,
+    TG_SEND_ERRORS,
+    TG_SEND_SECONDS,
+    WATCHER_ERRORS,
+    WATCHER_TICK_SECONDS,
+    CallbackMetric,
+    DigestBuffer,
+    DigestItem,
+    EmailTrace,
+    MimePart,
+    RenderedEmail,
+    SendProgress,
+    apply_settings_action,
+    build_chatid_text,
+    build_lag_text,
+    build_mail_list,
+    build_mail_rows,
+    build_settings_text,
+    build_start_text,
+    build_status_text,
+    chat_registry,
+    email_cache,
+    ensure_chat_config,
+    escape_html,
+    get_chat_config,
+    get_source_info,
+    group_new_uids,
+    load_chat_settings,
+    mail_store,
+    make_settings_keyboard,
+    notification_retry_delay,
+    make_source_keyboard,
+    outbox,
+    parse_email_structure,
+    parse_fetch_items,
+    parse_lag_minutes,
+    parse_rfc822,
+    part_body_text,
+    part_fetch_items,
+    prepare_notification,
+    render_digest,
+    render_email,
+    render_test_notification,
+    restore_last_uids,
+    save_watcher_state,
+    set_chat_notifications,
+    start_metrics_server,
+    store_email,
+    tg_limiter,
+    tracer,
+)
+
+
+# ======================= НАСТРОЙКИ =======================
+
+# Корутин рассылки (очередей по чатам); в отличие от потоков они почти ничего не стоят
+ASYNC_SEND_WORKERS = int(os.getenv("ASYNC_SEND_WORKERS", "64"))
+# Сколько секунд ждать ответа IMAP-сервера (кроме IDLE)
+IMAP_TIMEOUT = float(os.getenv("IMAP_TIMEOUT", "60"))
+
+abot = AsyncTeleBot(BOT_TOKEN, parse_mode="HTML")
+if TG_API_URL:
+    telebot.asyncio_helper.API_URL = TG_API_URL
+
+
+# ======================= IMAP НА ASYNCIO =======================
+
+class AsyncImapError(Exception):
+    """Сервер ответил не так, как ожидалось."""
+
+
+class AsyncImapAbort(AsyncImapError):
+    """Соединение оборвалось — сессию можно только выбросить."""
+
+
+_LITERAL_RE = re.compile(rb"\{(\d+)\}\r\n$")
+_UIDVALIDITY_RE = re.compile(rb"\[UIDVALIDITY (\d+)\]", re.IGNORECASE)
+_IDLE_EXISTS_RE = re.compile(rb"^\* \d+ EXISTS", re.IGNORECASE)
+
+
+def imap_quote(value: str) -> str:
+    """Строка в кавычках для аргумента IMAP-команды."""
+    return '"' + value.replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+
+class AsyncImap:
+    """
+    Минимальный IMAP4rev1-клиент на asyncio streams: ровно те команды,
+    что нужны боту (LOGIN, SELECT, STATUS, NOOP, UID SEARCH/FETCH, IDLE).
+
+    Команды на одной сессии идут по очереди; параллельность — за счёт пула сессий.
+    """
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        self._reader = reader
+        self._writer = writer
+        self._tag = 0
+        self._lock = asyncio.Lock()
+        self.capabilities: Set[str] = set()
+        # UIDVALIDITY из ответа на последний SELECT
+        self.uidvalidity: Optional[int] = None
+        self.last_used = time.monotonic()
+
+    @classmethod
+    async def connect(cls) -> "AsyncImap":
+        """Соединение + LOGIN + CAPABILITY."""
+        with IMAP_LOGIN_SECONDS.time():
+            reader, writer = await asyncio.wait_for(
+                asyncio.open_connection(
+                    IMAP_HOST,
+                    IMAP_PORT,
+                    ssl=ssl.create_default_context() if IMAP_SSL else None,
+                    # Длинный ответ SEARCH приходит одной строкой
+                    limit=16 * 1024 * 1024,
+                ),
+                IMAP_TIMEOUT,
+            )
+            imap = cls(reader, writer)
+            try:
+                greeting = await imap._read_line()
+                if not greeting.startswith(b"* OK"):
+                    raise AsyncImapError(f"bad greeting: {greeting!r}")
+
+                status, _ = await imap.command("LOGIN", imap_quote(GMAIL_USER or ""), imap_quote(GMAIL_APP_PASSWORD or ""))
+                if status != "OK":
+                    raise AsyncImapError("LOGIN failed")
+
+                status, lines = await imap.command("CAPABILITY")
+                for line in lines:
+                    if line.upper().startswith(b"CAPABILITY "):
+                        imap.capabilities.update(line.decode("ascii", "ignore").upper().split()[1:])
+            except BaseException:
+                imap.close()
+                raise
+        return imap
+
+    async def _read_line(self, timeout: Optional[float] = IMAP_TIMEOUT) -> bytes:
+        try:
+            line = await asyncio.wait_for(self._reader.readline(), timeout)
+        except asyncio.TimeoutError:
+            raise AsyncImapAbort("IMAP read timeout") from None
+        if not line:
+            raise AsyncImapAbort("connection closed")
+        return line
+
+    async def _read_response(self) -> bytes:
+        """Одна строка ответа вместе с литералами {n} — в том виде, что ест parse_imap_list()."""
+        line = await self._read_line()
+        out = line
+        while True:
+            m = _LITERAL_RE.search(line)
+            if not m:
+                break
+            try:
+                out += await asyncio.wait_for(self._reader.readexactly(int(m.group(1))), IMAP_TIMEOUT)
+            except (asyncio.TimeoutError, asyncio.IncompleteReadError):
+                raise AsyncImapAbort("connection closed inside literal") from None
+            line = await self._read_line()
+            out += line
+        return out.rstrip(b"\r\n")
+
+    def _next_tag(self) -> bytes:
+        self._tag += 1
+        return b"A%04d" % self._tag
+
+    async def command(self, name: str, *args: str) -> Tuple[str, List[bytes]]:
+        """
+        Выполнить команду. Возвращает (OK/NO/BAD, нетегированные ответы без "* ").
+        """
+        async with self._lock:
+            tag = self._next_tag()
+            self._writer.write(tag + b" " + " ".join((name,) + args).encode() + b"\r\n")
+            await self._writer.drain()
+
+            untagged: List[bytes] = []
+            while True:
+                resp = await self._read_response()
+                if resp.startswith(tag + b" "):
+                    self.last_used = time.monotonic()
+                    return resp[len(tag) + 1:].split(b" ", 1)[0].decode("ascii", "ignore").upper(), untagged
+                if resp.startswith(b"* BYE"):
+                    raise AsyncImapAbort(resp.decode("utf-8", "ignore"))
+                if resp.startswith(b"* "):
+                    untagged.append(resp[2:])
+                elif resp.startswith(b"+"):
+                    raise AsyncImapError(f"unexpected continuation: {resp!r}")
+
+    async def uid(self, command: str, *args: str) -> Tuple[str, List[bytes]]:
+        """UID-команда с замером времени (bot_imap_command_seconds)."""
+        with IMAP_COMMAND_SECONDS.time(command=command.lower()):
+            return await self.command("UID", command.upper(), *args)
+
+    async def select(self, mailbox: str = "INBOX") -> str:
+        with IMAP_COMMAND_SECONDS.time(command="select"):
+            status, lines = await self.command("SELECT", mailbox)
+        for line in lines:
+            m = _UIDVALIDITY_RE.search(line)
+            if m:
+                self.uidvalidity = int(m.group(1))
+        return status
+
+    async def noop(self) -> str:
+        with IMAP_COMMAND_SECONDS.time(command="noop"):
+            status, _ = await self.command("NOOP")
+        return status
+
+    async def mailbox_status(self) -> Tuple[Optional[int], Optional[int]]:
+        """(UIDVALIDITY, UIDNEXT) для INBOX одной командой STATUS."""
+        with IMAP_COMMAND_SECONDS.time(command="status"):
+            status, lines = await self.command("STATUS", "INBOX", "(UIDVALIDITY UIDNEXT)")
+        if status != "OK" or not lines:
+            return None, None
+
+        validity = re.search(rb"UIDVALIDITY (\d+)", lines[0])
+        uidnext = re.search(rb"UIDNEXT (\d+)", lines[0])
+        return (
+            int(validity.group(1)) if validity else None,
+            int(uidnext.group(1)) if uidnext else None,
+        )
+
+    async def uid_search(self, criteria: str) -> List[int]:
+        status, lines = await self.uid("search", criteria)
+        if status != "OK":
+            return []
+        uids: List[int] = []
+        for line in lines:
+            if line.upper().startswith(b"SEARCH"):
+                uids.extend(int(u) for u in line.split()[1:])
+        return uids
+
+    async def uid_fetch(self, uids: str, items: str) -> Tuple[str, List[Dict[str, Any]]]:
+        """UID FETCH -> (статус, [{"UID": b"5", "BODY[1]": b"...", ...}] по письму)."""
+        status, lines = await self.uid("fetch", uids, items)
+        rows: List[Dict[str, Any]] = []
+        for line in lines:
+            head = line.split(b" ", 2)
+            if len(head) > 1 and head[1].upper() == b"FETCH":
+                rows.append(parse_fetch_items([line]))
+        return status, rows
+
+    async def idle(self, timeout: float) -> bool:
+        """
+        Одна команда IDLE (RFC 2177): ждёт до timeout секунд, пока сервер не пришлёт
+        EXISTS, и завершает её через DONE. True — в ящике появились новые письма.
+        """
+        async with self._lock:
+            tag = self._next_tag()
+            self._writer.write(tag + b" IDLE\r\n")
+            await self._writer.drain()
+            line = await self._read_line()
+            if not line.startswith(b"+"):
+                raise AsyncImapError(f"IDLE rejected: {line!r}")
+
+            has_new = False
+            deadline = time.monotonic() + timeout
+            while not has_new:
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    break
+                try:
+                    line = await self._read_line(timeout=left)
+                except AsyncImapAbort:
+                    if self._reader.at_eof():
+                        raise
+                    break  # таймаут — пора перевыставить IDLE
+                if line.startswith(b"* BYE"):
+                    raise AsyncImapAbort("connection closed during IDLE")
+                if _IDLE_EXISTS_RE.match(line):
+                    has_new = True
+
+            self._writer.write(b"DONE\r\n")
+            await self._writer.drain()
+            while True:
+                line = await self._read_line()
+                if line.startswith(tag):
+                    break
+                if _IDLE_EXISTS_RE.match(line):
+                    has_new = True
+            self.last_used = time.monotonic()
+
+        if not line.startswith(tag + b" OK"):
+            raise AsyncImapError(f"IDLE failed: {line!r}")
+        return has_new
+
+    def close(self) -> None:
+        """Закрыть сокет без LOGOUT (сессия либо сломана, либо больше не нужна)."""
+        try:
+            self._writer.close()
+        except Exception:
+            pass
+
+
+class AsyncImapPool:
+    """
+    Пул IMAP-сессий с выбранным INBOX — как ImapPool в bot.py, только
+    ожидание свободной сессии не занимает поток.
+    """
+
+    def __init__(self, size: int, max_idle: float, noop_after: float) -> None:
+        self.max_idle = max_idle
+        self.noop_after = noop_after
+        self._slots = asyncio.Semaphore(size)
+        self._idle: List[AsyncImap] = []
+        # UIDVALIDITY из ответа на последний SELECT
+        self.uidvalidity: Optional[int] = None
+
+    async def _open(self) -> AsyncImap:
+        imap = await AsyncImap.connect()
+        try:
+            if await imap.select("INBOX") != "OK":
+                raise AsyncImapError("INBOX select failed")
+        except BaseException:
+            imap.close()
+            raise
+        if imap.uidvalidity is not None:
+            self.uidvalidity = imap.uidvalidity
+        return imap
+
+    async def _acquire(self) -> AsyncImap:
+        now = time.monotonic()
+        expired = [imap for imap in self._idle if now - imap.last_used > self.max_idle]
+        self._idle = [imap for imap in self._idle if now - imap.last_used <= self.max_idle]
+        for imap in expired:
+            imap.close()
+
+        while self._idle:
+            imap = self._idle.pop()
+            if time.monotonic() - imap.last_used < self.noop_after:
+                return imap
+            # Давно не пользовались — проверяем, что сервер нас ещё не выкинул
+            try:
+                if await imap.noop() == "OK":
+                    return imap
+            except Exception:
+                pass
+            imap.close()
+
+        return await self._open()
+
+    @asynccontextmanager
+    async def session(self) -> AsyncIterator[AsyncImap]:
+        """
+        async with aimap_pool.session() as imap: ...
+
+        Если внутри блока вылетело исключение (в том числе отмена задачи),
+        сессия считается испорченной и закрывается.
+        """
+        async with self._slots:
+            imap = await self._acquire()
+            try:
+                yield imap
+            except BaseException:
+                IMAP_BROKEN_SESSIONS.inc()
+                imap.close()
+                raise
+            else:
+                self._idle.append(imap)
+
+    def close_all(self) -> None:
+        idle, self._idle = self._idle, []
+        for imap in idle:
+            imap.close()
+
+
+aimap_pool = AsyncImapPool(IMAP_POOL_SIZE, IMAP_MAX_IDLE, IMAP_NOOP_AFTER)
+
+
+# ======================= ПОЧТА =======================
+
+async def fetch_header_fields_async(
+    imap: AsyncImap,
+    uids: List[str],
+    fields: str,
+    internaldates: Optional[Dict[str, float]] = None,
+) -> Optional[Dict[str, Message]]:
+    """То же, что fetch_header_fields() в bot.py: {uid: Message} одним UID FETCH, None при сбое."""
+    result: Dict[str, Message] = {}
+    if not uids:
+        return result
+
+    items = f"BODY.PEEK[HEADER.FIELDS ({fields})]"
+    if internaldates is not None:
+        items = "INTERNALDATE " + items
+    status, rows = await imap.uid_fetch(",".join(uids), f"({items})")
+    if status != "OK":
+        print("fetch_header_fields_async error:", status)
+        return None
+
+    for row in rows:
+        uid = row.get("UID")
+        if not isinstance(uid, bytes):
+            continue
+        headers = next((v for k, v in row.items() if k.startswith("BODY[HEADER")), None)
+        result[uid.decode()] = email.message_from_bytes(headers or b"")
+
+        stamp_raw = row.get("INTERNALDATE")
+        if internaldates is not None and isinstance(stamp_raw, bytes):
+            stamp = imaplib.Internaldate2tuple(b'INTERNALDATE "' + stamp_raw + b'"')
+            if stamp is not None:
+                internaldates[uid.decode()] = time.mktime(stamp)
+    return result
+
+
+async def fetch_email_text_async(
+    imap: AsyncImap, uid: str, max_bytes: Optional[int] = None
+) -> Tuple[Optional[str], Optional[str], Optional[str], Optional[str], bool]:
+    """fetch_email_text() из bot.py: BODYSTRUCTURE, затем только текстовая часть."""
+    status, rows = await imap.uid_fetch(uid, bot.EMAIL_STRUCTURE_ITEMS)
+    if status != "OK" or not rows:
+        return None, None, None, None, False
+
+    try:
+        subject, from_, date, part = parse_email_structure(rows[0])
+    except Exception as e:
+        # Сервер прислал что-то, что мы не понимаем — качаем письмо целиком
+        print("bodystructure parse error:", e)
+        return (*await fetch_email_rfc822_async(imap, uid), False)
+
+    body_text = ""
+    truncated = False
+    if part is not None:
+        body = await fetch_part_async(imap, uid, part, max_bytes)
+        if body is not None and body[1] and not body[0].strip():
+            # В начало HTML влез только <head> со стилями — качаем часть целиком
+            body = await fetch_part_async(imap, uid, part, None)
+        if body is None:
+            return (*await fetch_email_rfc822_async(imap, uid), False)
+        body_text, truncated = body
+
+    body_text = (body_text or "").strip()
+    if not body_text:
+        body_text = "[Письмо без текста]"
+
+    return subject, from_, date, body_text, truncated
+
+
+async def fetch_part_async(
+    imap: AsyncImap, uid: str, part: MimePart, max_bytes: Optional[int]
+) -> Optional[Tuple[str, bool]]:
+    """Текст одной части письма: (текст, обрезан ли). None — сервер не отдал часть."""
+    items, truncated = part_fetch_items(part, max_bytes)
+    status, rows = await imap.uid_fetch(uid, items)
+    if status != "OK" or not rows:
+        return None
+    return part_body_text(rows[0], part, truncated), truncated
+
+
+async def fetch_email_rfc822_async(
+    imap: AsyncImap, uid: str
+) -> Tuple[Optional[str], Optional[str], Optional[str], Optional[str]]:
+    """Запасной путь: полное письмо (RFC822)."""
+    status, rows = await imap.uid_fetch(uid, "(RFC822)")
+    raw = rows[0].get("RFC822") if status == "OK" and rows else None
+    if not isinstance(raw, bytes):
+        return None, None, None, None
+    return parse_rfc822(raw)
+
+
+async def list_last_emails_async(from_filter: str, limit: int = 10) -> List[Dict[str, str]]:
+    """Список последних писем от указанного отправителя (list_last_emails() в bot.py)."""
+    if aimap_pool.uidvalidity is not None:
+        cached = email_cache.get_list(from_filter, limit, aimap_pool.uidvalidity)
+        if cached is not None:
+            return cached
+
+    async with aimap_pool.session() as imap:
+        found = await imap.uid_search(f'(FROM "{from_filter}")')
+        if not found:
+            return []
+
+        uids = [str(uid) for uid in found[-limit:]]  # последние N
+
+        # Что уже есть в локальном хранилище, с сервера не качаем
+        uidvalidity = aimap_pool.uidvalidity
+        known: Dict[int, Tuple[str, str, str]] = {}
+        if uidvalidity is not None:
+            known = await asyncio.to_thread(mail_store.get_headers, uidvalidity, [int(uid) for uid in uids])
+
+        missing = [uid for uid in uids if int(uid) not in known]
+        headers = await fetch_header_fields_async(imap, missing, "SUBJECT FROM DATE") or {}
+
+    # mail_store пишет на диск — не в event loop
+    emails_list = await asyncio.to_thread(build_mail_rows, uids, known, headers, uidvalidity)
+    if uidvalidity is not None:
+        email_cache.put_list(from_filter, limit, uidvalidity, emails_list)
+    return emails_list
+
+
+async def get_email_by_uid_async(uid: str) -> Tuple[Optional[str], Optional[str], Optional[str], Optional[str]]:
+    """Полное письмо по UID: из кэша, из локального хранилища или с сервера."""
+    uidvalidity = aimap_pool.uidvalidity
+    if uidvalidity is not None:
+        cached = email_cache.get_email(uidvalidity, int(uid))
+        if cached is not None:
+            return cached
+
+        stored = await asyncio.to_thread(mail_store.get_email, uidvalidity, int(uid))
+        if stored is not None:
+            email_cache.put_email(uidvalidity, int(uid), stored)
+            return stored
+
+    async with aimap_pool.session() as imap:
+        subject, from_, date, body, _ = await fetch_email_text_async(imap, uid)
+    result = (subject, from_, date, body)
+    await asyncio.to_thread(store_email, uid, result, aimap_pool.uidvalidity)
+    return result
+
+
+class AsyncSingleFlight:
+    """
+    SingleFlight из bot.py для корутин: одинаковые запросы от кнопок
+    ждут одну и ту же задачу, одновременно выполняется не больше limit задач.
+    """
+
+    def __init__(self, limit: int) -> None:
+        self._slots = asyncio.Semaphore(max(1, limit))
+        self._inflight: Dict[Tuple[str, ...], "asyncio.Task[Any]"] = {}
+
+    async def _limited(self, factory: Callable[[], Awaitable[Any]]) -> Any:
+        async with self._slots:
+            return await factory()
+
+    async def run(self, key: Tuple[str, ...], factory: Callable[[], Awaitable[Any]]) -> Any:
+        """key[0] — вид запроса ("list" / "mail"), для метрики."""
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.create_task(self._limited(factory))
+            self._inflight[key] = task
+            task.add_done_callback(lambda t: self._inflight.pop(key) if self._inflight.get(key) is t else None)
+        else:
+            CALLBACK_FETCHES_MERGED.inc(kind=key[0])
+        # shield: если один из ждущих отменён, остальные всё равно получат результат
+        return await asyncio.shield(task)
+
+
+amail_fetches = AsyncSingleFlight(CALLBACK_WORKERS)
+
+
+# ======================= ОТПРАВКА В TELEGRAM =======================
+
+async def tg_send_message_async(chat_id: int, text: str, **kwargs: Any) -> Any:
+    """tg_send_message() из bot.py: те же лимиты (tg_limiter) и повторы на 429."""
+    return await tg_request_async(chat_id, partial(abot.send_message, chat_id, text, **kwargs))
+
+
+async def tg_send_document_async(chat_id: int, name: str, content: str, **kwargs: Any) -> Any:
+    """tg_send_document() из bot.py: content уходит файлом name."""
+
+    def send() -> Awaitable[Any]:
+        return abot.send_document(chat_id, io.BytesIO(content.encode("utf-8")), visible_file_name=name, **kwargs)
+
+    return await tg_request_async(chat_id, send)
+
+
+async def tg_request_async(chat_id: int, send: Callable[[], Awaitable[Any]]) -> Any:
+    """tg_request() из bot.py: лимиты, повторы на 429 и метрики."""
+    for attempt in range(TG_MAX_RETRIES):
+        while True:
+            wait = tg_limiter.try_acquire(chat_id)
+            if wait <= 0:
+                break
+            await asyncio.sleep(wait)
+
+        started = time.perf_counter()
+        try:
+            return await send()
+        except ApiTelegramException as e:
+            TG_SEND_ERRORS.inc(code=str(e.error_code))
+            if e.error_code != 429 or attempt == TG_MAX_RETRIES - 1:
+                raise
+            retry_after = (e.result_json.get("parameters") or {}).get("retry_after", 1)
+            print(f"[send] 429 for chat {chat_id}, retry after {retry_after}s")
+            tg_limiter.penalize(chat_id, retry_after)
+        except Exception:
+            TG_SEND_ERRORS.inc(code="network")
+            raise
+        finally:
+            TG_SEND_SECONDS.observe(time.perf_counter() - started)
+
+
+async def send_rendered_async(
+    chat_id: int, rendered: RenderedEmail, progress: Optional[SendProgress] = None
+) -> None:
+    """Отправить заранее собранное письмо в чат (с места, где остановился progress)."""
+    progress = progress or SendProgress()
+    sends: List[Callable[[], Awaitable[Any]]] = [
+        partial(tg_send_message_async, chat_id, rendered.header, reply_markup=rendered.reply_markup)
+    ]
+    sends.extend(partial(tg_send_message_async, chat_id, chunk_html) for chunk_html in rendered.chunks)
+    if rendered.document is not None:
+        name, content = rendered.document
+        sends.append(partial(tg_send_document_async, chat_id, name, content, caption="📄 Полный текст письма"))
+
+    for idx in range(progress.sent, len(sends)):
+        await sends[idx]()
+        progress.sent = idx + 1
+
+
+class AsyncDispatcher:
+    """
+    Рассылка на корутинах: как NotificationDispatcher в bot.py, но очередь
+    обслуживает корутина, а не поток. Все задания одного чата попадают
+    в одну очередь, поэтому сообщения внутри чата не перемешиваются.
+    """
+
+    def __init__(self, workers: int) -> None:
+        self._queues: List["asyncio.Queue[Tuple[int, Callable[[], Awaitable[None]]]]"] = [
+            asyncio.Queue() for _ in range(max(1, workers))
+        ]
+        self._tasks: List["asyncio.Task[None]"] = []
+
+    def _ensure_started(self) -> None:
+        if self._tasks:
+            return
+        self._tasks = [asyncio.create_task(self._worker(q)) for q in self._queues]
+
+    async def _worker(self, q: "asyncio.Queue[Tuple[int, Callable[[], Awaitable[None]]]]") -> None:
+        while True:
+            chat_id, job = await q.get()
+            try:
+                await job()
+            except Exception as e:
+                print(f"[dispatch] Error sending notification to chat {chat_id}:", e)
+            finally:
+                q.task_done()
+
+    def submit(self, chat_id: int, job: Callable[[], Awaitable[None]]) -> None:
+        self._ensure_started()
+        self._queues[hash(chat_id) % len(self._queues)].put_nowait((chat_id, job))
+
+    def pending(self) -> int:
+        return sum(q.qsize() for q in self._queues)
+
+    async def join(self) -> None:
+        """Дождаться, пока все поставленные задания будут отправлены."""
+        for q in self._queues:
+            await q.join()
+
+
+adispatcher = AsyncDispatcher(ASYNC_SEND_WORKERS)
+CallbackMetric("bot_async_dispatch_queue_depth", "Send jobs waiting in the asyncio dispatcher queues", "gauge",
+               adispatcher.pending)
+
+
+async def deliver_notification_async(
+    item_id: int,
+    chat_id: int,
+    rendered: RenderedEmail,
+    attempts: int,
+    trace: Optional[EmailTrace] = None,
+    progress: Optional[SendProgress] = None,
+) -> None:
+    """deliver_notification() из bot.py: отправка записи outbox с повторами."""
+    progress = progress or SendProgress()
+    try:
+        await send_rendered_async(chat_id, rendered, progress)
+    except Exception as e:
+        await notification_failed_async(item_id, chat_id, rendered, attempts, trace, e, progress)
+        return
+
+    await asyncio.to_thread(outbox.done, item_id)
+    if trace is not None:
+        await record_delivery_async([(trace, chat_id, attempts)])
+
+
+async def record_delivery_async(records: List[Tuple[EmailTrace, int, int]]) -> None:
+    """tracer.record() для пачки доставок; с TRACE_LOG_FILE он пишет на диск — уводим в поток."""
+    def write() -> None:
+        for trace, chat_id, attempts in records:
+            tracer.record(trace, chat_id, attempts)
+
+    if not records:
+        return
+    if tracer.log_file:
+        await asyncio.to_thread(write)
+    else:
+        write()
+
+
+async def notification_failed_async(
+    item_id: int,
+    chat_id: int,
+    rendered: RenderedEmail,
+    attempts: int,
+    trace: Optional[EmailTrace],
+    error: Exception,
+    progress: Optional[SendProgress] = None,
+) -> None:
+    """notification_failed() из bot.py: повтор позже или выброс, повтор продолжает progress."""
+    attempts += 1
+    error_code = error.error_code if isinstance(error, ApiTelegramException) else None
+    delay = notification_retry_delay(attempts, error_code)
+    if delay is None:
+        print(f"[outbox] drop notification for chat {chat_id} after {attempts} attempts:", error)
+        await asyncio.to_thread(outbox.done, item_id)
+        return
+
+    print(f"[outbox] chat {chat_id} failed ({error}), retry #{attempts} in {delay:.0f}s")
+    await asyncio.to_thread(outbox.retry_later, item_id, attempts, time.time() + delay)
+    schedule_notification_async(item_id, chat_id, rendered, attempts, delay, trace, progress)
+
+
+async def deliver_digest_async(chat_id: int, items: List[DigestItem]) -> None:
+    """deliver_digest() из bot.py: одно уведомление — как обычно, несколько — дайджестом."""
+    if len(items) == 1:
+        item = items[0]
+        await deliver_notification_async(item.item_id, chat_id, item.rendered, item.attempts, item.trace)
+        return
+
+    for start in range(0, len(items), DIGEST_MAX_ITEMS):
+        batch = items[start:start + DIGEST_MAX_ITEMS]
+        text, reply_markup = render_digest([item.rendered for item in batch])
+        try:
+            await tg_send_message_async(chat_id, text, reply_markup=reply_markup)
+        except Exception as e:
+            for item in batch:
+                await notification_failed_async(item.item_id, chat_id, item.rendered, item.attempts, item.trace, e)
+            continue
+
+        await asyncio.to_thread(outbox.done, *(item.item_id for item in batch))
+        DIGEST_MESSAGES.inc()
+        DIGEST_EMAILS.inc(len(batch))
+        await record_delivery_async([(item.trace, chat_id, item.attempts) for item in batch if item.trace is not None])
+
+
+adigests = DigestBuffer(
+    lambda delay, fn: asyncio.get_running_loop().call_later(delay, fn),
+    lambda chat_id, items: adispatcher.submit(chat_id, partial(deliver_digest_async, chat_id, items)),
+)
+CallbackMetric("bot_async_digest_pending", "Notifications waiting for their digest window (asyncio engine)",
+               "gauge", adigests.pending)
+
+
+def schedule_notification_async(
+    item_id: int,
+    chat_id: int,
+    rendered: RenderedEmail,
+    attempts: int,
+    delay: float = 0.0,
+    trace: Optional[EmailTrace] = None,
+    progress: Optional[SendProgress] = None,
+) -> None:
+    """
+    Поставить запись outbox в рассылку (сразу или через delay секунд).
+    У чатов с дайджестом запись сначала ждёт в окне склейки, кроме недоотправленной.
+    """
+    if delay > 0:
+        asyncio.get_running_loop().call_later(
+            delay, schedule_notification_async, item_id, chat_id, rendered, attempts, 0.0, trace, progress
+        )
+        return
+
+    progress = progress or SendProgress()
+    window = get_chat_config(chat_id).digest
+    if window > 0 and not progress.sent:
+        adigests.add(chat_id, window, DigestItem(item_id, rendered, attempts, trace))
+        return
+
+    def job() -> Awaitable[None]:
+        return deliver_notification_async(item_id, chat_id, rendered, attempts, trace, progress)
+
+    adispatcher.submit(chat_id, job)
+
+
+async def enqueue_notifications_async(
+    source: str,
+    uid: str,
+    rendered: RenderedEmail,
+    chat_ids: List[int],
+    trace: Optional[EmailTrace] = None,
+) -> None:
+    """Записать уведомления в outbox и сразу отдать их в рассылку."""
+    if not chat_ids:
+        return
+    items = await asyncio.to_thread(outbox.add, source, uid, rendered, chat_ids)
+    for item_id, chat_id in items:
+        schedule_notification_async(item_id, chat_id, rendered, 0, trace=trace)
+
+
+async def resume_outbox_async() -> None:
+    """После перезапуска доотправить всё, что осталось в outbox."""
+    try:
+        items = await asyncio.to_thread(outbox.pending)
+    except Exception as e:
+        print("resume_outbox error:", e)
+        return
+
+    now = time.time()
+    for item_id, chat_id, rendered, attempts, next_try in items:
+        schedule_notification_async(item_id, chat_id, rendered, attempts, next_try - now)
+    if items:
+        print(f"[outbox] resumed {len(items)} pending notifications")
+
+
+# ======================= ВОТЧЕР ПОЧТЫ =======================
+
+async def init_last_uids_async() -> None:
+    """init_last_uids() из bot.py: продолжаем с чекпоинта или с границы ящика."""
+    try:
+        async with aimap_pool.session() as imap:
+            uidvalidity, uidnext = await imap.mailbox_status()
+        if uidnext is None:
+            return
+        await asyncio.to_thread(restore_last_uids, uidvalidity, uidnext)
+    except Exception as e:
+        print("init_last_uids error:", e)
+
+
+async def fetch_preview_async(trace: EmailTrace) -> Tuple[Optional[str], Optional[str], Optional[str], Optional[str], bool]:
+    """Начало письма для уведомления на своей сессии пула."""
+    async with aimap_pool.session() as imap:
+        preview = await fetch_email_text_async(imap, trace.uid, NOTIFY_PREVIEW_BYTES or None)
+    trace.parsed = time.time()
+    return preview
+
+
+async def check_new_mail_async() -> None:
+    """
+    check_new_mail() из bot.py. Поиск и заголовки — на одной сессии,
+    превью новых писем качаются параллельно на сессиях пула.
+    """
+    last_uids = bot.last_uids
+
+    if not chat_registry.subscribed_count():
+        # Никто не подписан — можно не дергать Gmail
+        return
+
+    async with aimap_pool.session() as imap:
+        # NOOP подтягивает от сервера EXISTS по только что пришедшим письмам
+        await imap.noop()
+
+        if (
+            aimap_pool.uidvalidity is not None
+            and bot.mailbox_uidvalidity is not None
+            and aimap_pool.uidvalidity != bot.mailbox_uidvalidity
+        ):
+            # Ящик пересоздан — старые UID ничего не значат
+            print("[watcher] UIDVALIDITY changed, resync")
+            for source in last_uids:
+                last_uids[source] = None
+
+        if any(last is None for last in last_uids.values()):
+            uidvalidity, uidnext = await imap.mailbox_status()
+            if uidnext is None:
+                return
+            for source, last in last_uids.items():
+                if last is None:
+                    last_uids[source] = uidnext - 1
+                    print(f"[watcher] {source}: last_saved=None, set to {last_uids[source]}")
+            bot.mailbox_uidvalidity = uidvalidity
+            await asyncio.to_thread(save_watcher_state)
+            return
+
+        floor = min(uid for uid in last_uids.values() if uid is not None)
+        found = await imap.uid_search(f"(UID {floor + 1}:* {SOURCES_SEARCH})")
+
+        # "N:*" всегда включает последнее письмо ящика, даже если его UID < N
+        uids = sorted(u for u in found if u > floor)
+        if not uids:
+            return
+
+        internaldates: Dict[str, float] = {}
+        headers = await fetch_header_fields_async(imap, [str(u) for u in uids], "FROM", internaldates)
+        if headers is None:
+            # Не сдвигаем last_uids: следующий тик найдёт эти письма снова
+            return
+
+    detected = time.time()
+    new_by_source = group_new_uids(uids, headers)
+
+    traces: List[EmailTrace] = []
+    for source in SOURCE_ORDER:
+        new_uids = new_by_source.get(source)
+        if new_uids:
+            print(f"[watcher] {source} new_uids: {new_uids}")
+            NEW_EMAILS.inc(len(new_uids), source=source)
+            email_cache.invalidate_lists(SOURCES[source])
+            traces.extend(EmailTrace(source, str(u), internaldates.get(str(u)), detected) for u in new_uids)
+
+    previews = await asyncio.gather(*(fetch_preview_async(t) for t in traces), return_exceptions=True)
+
+    # Уведомления ставятся по порядку UID; на первом сбое тик обрывается,
+    # и следующий начнёт с этого письма
+    for trace, preview in zip(traces, previews):
+        if isinstance(preview, BaseException):
+            raise preview
+        rendered = await asyncio.to_thread(
+            prepare_notification, trace.source, trace.uid, preview, trace, aimap_pool.uidvalidity
+        )
+        if rendered is not None:
+            recipients = list(chat_registry.subscribers(trace.source))
+            # Сначала outbox, потом сдвиг last_uids
+            await enqueue_notifications_async(trace.source, trace.uid, rendered, recipients, trace)
+
+        last_uids[trace.source] = int(trace.uid)
+        await asyncio.to_thread(save_watcher_state)
+
+    # Поиск шёл сразу по всем отправителям, так что все источники
+    # просмотрены до одного и того же UID
+    for source in last_uids:
+        last_uids[source] = max(last_uids[source] or 0, uids[-1])
+    await asyncio.to_thread(save_watcher_state)
+
+
+async def run_mail_check_async() -> None:
+    """check_new_mail_async(), который не роняет вотчер при ошибках."""
+    try:
+        with WATCHER_TICK_SECONDS.time():
+            await check_new_mail_async()
+    except Exception as e:
+        WATCHER_ERRORS.inc()
+        print("watcher_loop error:", e)
+
+
+async def idle_watcher_loop_async(poll_interval: int = 5) -> None:
+    """
+    Вотчер на IMAP IDLE (idle_watcher_loop() в bot.py) на отдельной сессии.
+    Возвращается, только если сервер не поддерживает IDLE.
+    """
+    while True:
+        imap = None
+        try:
+            imap = await AsyncImap.connect()
+            if "IDLE" not in imap.capabilities:
+                print("[watcher] сервер не поддерживает IDLE, работаем опросом")
+                return
+
+            if await imap.select("INBOX") != "OK":
+                raise AsyncImapError("INBOX select failed")
+            print("[watcher] IDLE-сессия открыта")
+
+            # Письма, пришедшие, пока IDLE-сессии не было
+            await run_mail_check_async()
+            while True:
+                if await imap.idle(IMAP_IDLE_RENEW):
+                    await run_mail_check_async()
+        except Exception as e:
+            print("idle_watcher_loop error:", e)
+        finally:
+            if imap is not None:
+                imap.close()
+
+        await asyncio.sleep(poll_interval)
+
+
+async def watcher_loop_async(poll_interval: int = 5, use_idle: bool = IMAP_USE_IDLE) -> None:
+    """Фоновая задача: IDLE, если сервер умеет, иначе опрос каждые poll_interval секунд."""
+    await init_last_uids_async()
+
+    if use_idle:
+        await idle_watcher_loop_async(poll_interval)
+
+    while True:
+        await run_mail_check_async()
+        await asyncio.sleep(poll_interval)
+
+
+# ======================= ХЕНДЛЕРЫ КОМАНД =======================
+
+@abot.message_handler(commands=["start", "help"])
+async def handle_start(message):
+    chat = message.chat
+    ensure_chat_config(chat.id, title=chat.title or chat.username or "", chat_type=chat.type)
+    set_chat_notifications(chat.id, True)
+    await abot.reply_to(message, build_start_text(), reply_markup=make_source_keyboard())
+
+
+@abot.message_handler(commands=["mails", "lastmail"])
+async def handle_mails(message):
+    await abot.reply_to(
+        message,
+        "Выбери площадку, откуда смотреть письма:",
+        reply_markup=make_source_keyboard(),
+    )
+
+
+@abot.message_handler(commands=["settings"])
+async def handle_settings(message):
+    chat = message.chat
+    ensure_chat_config(chat.id, title=chat.title or chat.username or "", chat_type=chat.type)
+    await abot.reply_to(message, build_settings_text(chat.id), reply_markup=make_settings_keyboard(chat.id))
+
+
+@abot.message_handler(commands=["status"])
+async def handle_status(message):
+    chat = message.chat
+    ensure_chat_config(chat.id, title=chat.title or chat.username or "", chat_type=chat.type)
+    await abot.reply_to(message, build_status_text(chat.id))
+
+
+@abot.message_handler(commands=["lag"])
+async def handle_lag(message):
+    """/lag [минут] — задержки доставки уведомлений (только для ADMIN_IDS)."""
+    if message.from_user is None or message.from_user.id not in ADMIN_IDS:
+        await abot.reply_to(message, "⛔ Команда только для админов бота.")
+        return
+    await abot.reply_to(message, build_lag_text(parse_lag_minutes(message.text)))
+
+
+@abot.message_handler(commands=["chatid"])
+async def handle_chatid(message):
+    await abot.reply_to(message, build_chatid_text(message.chat))
+
+
+@abot.message_handler(commands=["testnotify"])
+async def handle_testnotify(message):
+    """Тестовое уведомление в ТЕКУЩИЙ чат, тем же механизмом, что и вотчер."""
+    chat_id = message.chat.id
+    try:
+        await send_rendered_async(chat_id, render_test_notification())
+    except Exception as e:
+        print(f"[testnotify] error sending to chat {chat_id}:", e)
+        await abot.reply_to(message, f"Ошибка при отправке тестового уведомления: <code>{escape_html(str(e))}</code>")
+
+
+@abot.message_handler(commands=["stop"])
+async def handle_stop(message):
+    set_chat_notifications(message.chat.id, False)
+    await abot.reply_to(message, STOP_TEXT)
+
+
+# ======================= CALLBACK-КНОПКИ =======================
+
+@abot.callback_query_handler(func=lambda c: c.data and c.data.startswith("src:"))
+async def handle_source_choice(call):
+    source = call.data.split(":", 1)[1]
+    chat_id = call.message.chat.id
+    _, from_email = get_source_info(source)
+
+    await abot.answer_callback_query(call.id)
+    await abot.send_chat_action(chat_id, "typing")
+
+    try:
+        mails = await amail_fetches.run(("list", source), lambda: list_last_emails_async(from_email, MAILS_LIMIT))
+    except Exception as e:
+        print(f"[fetch] error for chat {chat_id}:", e)
+        await abot.send_message(chat_id, "Не удалось получить список писем.")
+        return
+    text, kb = build_mail_list(source, mails)
+    await abot.send_message(chat_id, text, reply_markup=kb)
+
+
+@abot.callback_query_handler(func=lambda c: c.data and c.data.startswith("mail:"))
+async def handle_mail_choice(call):
+    _, source, uid = call.data.split(":", 2)
+    chat_id = call.message.chat.id
+    title, _ = get_source_info(source)
+
+    await abot.answer_callback_query(call.id, f"Открываю письмо с {title}…")
+    await abot.send_chat_action(chat_id, "typing")
+
+    try:
+        subject, from_, date, body = await amail_fetches.run(("mail", source, uid), lambda: get_email_by_uid_async(uid))
+    except Exception as e:
+        print(f"[fetch] error for chat {chat_id}:", e)
+        subject = None
+    if not subject:
+        await abot.send_message(chat_id, "Не удалось прочитать письмо.")
+        return
+
+    await send_rendered_async(
+        chat_id,
+        render_email(source, subject or "", from_ or "", date or "", body or "", uid),
+    )
+
+
+@abot.callback_query_handler(func=lambda c: c.data and c.data.startswith("cfg:"))
+async def handle_settings_callback(call):
+    chat_id = call.message.chat.id
+    answer = apply_settings_action(chat_id, call.data)
+    if answer is None:
+        await abot.answer_callback_query(call.id, "Неизвестное действие.")
+        return
+    await abot.answer_callback_query(call.id, answer, show_alert=False)
+
+    # Перерисовываем сообщение с актуальными настройками
+    try:
+        await abot.edit_message_text(
+            chat_id=chat_id,
+            message_id=call.message.message_id,
+            text=build_settings_text(chat_id),
+            reply_markup=make_settings_keyboard(chat_id),
+            parse_mode="HTML",
+        )
+    except Exception as e:
+        print("edit settings message error:", e)
+
+
+# ======================= ЗАПУСК БОТА =======================
+
+async def main() -> None:
+    load_chat_settings()
+    try:
+        await abot.set_my_commands(BOT_COMMANDS)
+        print("[bot] команды зарегистрированы")
+    except Exception as e:
+        print("set_my_commands error:", e)
+    await resume_outbox_async()
+    start_metrics_server()
+
+    watcher = asyncio.create_task(watcher_loop_async(poll_interval=5))
+    try:
+        print("Бот запущен (asyncio), начинаем polling...")
+        await abot.infinity_polling(skip_pending=True)
+    finally:
+        watcher.cancel()
+        aimap_pool.close_all()
+        await abot.close_session()
+
+
+if __name__ == "__main__":
+    print("Бот запускается (asyncio)...")
+    asyncio.run(main())